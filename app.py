@@ -1,21 +1,93 @@
 from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import DeclarativeBase
 import os
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 
+class Base(DeclarativeBase):
+    pass
+
+db = SQLAlchemy(model_class=Base)
+
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "simple-email-sender-key")
 
+# Database configuration
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", "sqlite:///email_sender.db")
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_recycle": 300,
+    "pool_pre_ping": True,
+}
+db.init_app(app)
+
 # File upload configuration
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 512)) * 1024 * 1024  # Uploads are streamed, see upload_ingest.py
+app.config['MAX_CSV_SIZE'] = int(os.environ.get('MAX_CSV_MB', 2048)) * 1024 * 1024  # Limit on a recipient CSV once decompressed
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['INCOMING_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'incoming')  # Saved uploads; cleanup_uploads owns everything in it
+app.config['RECIPIENT_CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')  # Validated recipient sets
+app.config['UPLOAD_RETENTION_HOURS'] = float(os.environ.get('UPLOAD_RETENTION_HOURS', 24))
+app.config['CAMPAIGN_CACHE_SIZE'] = int(os.environ.get('CAMPAIGN_CACHE_SIZE', 256))  # Campaigns kept in memory by the state store
+
+# Key(s) encrypting registered sender account passwords, kept out of the database.
+# Comma-separated Fernet keys; the first encrypts, all decrypt (for key rotation).
+app.config['SENDER_SECRET_KEY'] = os.environ.get('SENDER_SECRET_KEY', '')
 
 # Email configuration (these will be set by user input)
 app.config['SMTP_SERVER'] = 'smtp.office365.com'
 app.config['SMTP_PORT'] = 587
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Send engine configuration
+app.config['SMTP_POOL_SIZE'] = int(os.environ.get('SMTP_POOL_SIZE', 4))  # Open connections per campaign
+app.config['SMTP_CONNECTION_CONCURRENCY'] = int(os.environ.get('SMTP_CONNECTION_CONCURRENCY', 2))  # Workers per connection
+app.config['SMTP_RATE_PER_SECOND'] = float(os.environ.get('SMTP_RATE_PER_SECOND', 5))  # Shared per-sender budget
+app.config['SMTP_RATE_PER_MINUTE'] = int(os.environ.get('SMTP_RATE_PER_MINUTE', 120))
+app.config['SMTP_PIPELINING'] = os.environ.get('SMTP_PIPELINING', '1') == '1'  # Used when the server supports it
+app.config['SMTP_STARTTLS'] = os.environ.get('SMTP_STARTTLS', '1') == '1'  # Off only for local relays and the SMTP sink
+app.config['SMTP_DAILY_QUOTA'] = int(os.environ.get('SMTP_DAILY_QUOTA', 0))  # Recipients per day for the main sender, 0 for no limit
+app.config['SMTP_CACHE_NOOP_AFTER'] = float(os.environ.get('SMTP_CACHE_NOOP_AFTER', 30))  # Idle seconds before a NOOP check on reuse
+app.config['SMTP_CACHE_MAX_IDLE'] = float(os.environ.get('SMTP_CACHE_MAX_IDLE', 120))  # Idle seconds before a warm connection is closed
+app.config['SMTP_CACHE_IDLE_PER_SENDER'] = int(os.environ.get('SMTP_CACHE_IDLE_PER_SENDER', 4))  # Warm connections kept per sender
+app.config['SEND_INTERACTIVE_TARGET'] = float(os.environ.get('SEND_INTERACTIVE_TARGET', 1.0))  # Max seconds a test send queues behind campaigns
+app.config['SEND_TRANSACTIONAL_WEIGHT'] = float(os.environ.get('SEND_TRANSACTIONAL_WEIGHT', 4))  # Slot share of verification mail against one campaign
+app.config['BCC_CHUNK_SIZE'] = int(os.environ.get('BCC_CHUNK_SIZE', 500))  # Recipients per BCC message
+app.config['BCC_CHUNK_RETRIES'] = int(os.environ.get('BCC_CHUNK_RETRIES', 2))  # Retries for a chunk, or its 4xx-refused recipients, after a transient error
+app.config['DRY_RUN_TRANSPORT'] = os.environ.get('DRY_RUN_TRANSPORT', 'maildir')  # maildir, mbox or null, see transports.py
+app.config['SPOOL_FOLDER'] = os.environ.get('SPOOL_FOLDER', 'spool')  # Where dry runs write their messages
+app.config['SPOOL_RETENTION_HOURS'] = float(os.environ.get('SPOOL_RETENTION_HOURS', 24))  # Dry-run spools are deleted after this
+
+# Delivery log batching
+app.config['LOG_BATCH_SIZE'] = int(os.environ.get('LOG_BATCH_SIZE', 500))  # Outcomes per bulk INSERT
+app.config['LOG_FLUSH_INTERVAL'] = float(os.environ.get('LOG_FLUSH_INTERVAL', 2))  # Max seconds between flushes
+
+# Background campaign workers
+app.config['EMBEDDED_WORKERS'] = int(os.environ.get('EMBEDDED_WORKERS', 1))  # Worker threads started with the web app
+app.config['WORKER_POLL_INTERVAL'] = float(os.environ.get('WORKER_POLL_INTERVAL', 2))  # Seconds between queue polls
+app.config['WORKER_HEARTBEAT_INTERVAL'] = float(os.environ.get('WORKER_HEARTBEAT_INTERVAL', 5))  # Seconds between liveness updates
+app.config['WORKER_STALE_AFTER'] = float(os.environ.get('WORKER_STALE_AFTER', 30))  # Resume 'sending' campaigns silent this long
+app.config['CAMPAIGN_SHARDS'] = int(os.environ.get('CAMPAIGN_SHARDS', 1))  # Processes a personalized campaign is sent from
+
+# Progress streams
+app.config['PROGRESS_POLL_INTERVAL'] = float(os.environ.get('PROGRESS_POLL_INTERVAL', 2))  # DB re-read for out-of-process workers
+app.config['PROGRESS_MIN_INTERVAL'] = float(os.environ.get('PROGRESS_MIN_INTERVAL', 0.25))  # Max event rate per stream
+app.config['PROGRESS_STREAM_TIMEOUT'] = float(os.environ.get('PROGRESS_STREAM_TIMEOUT', 20))  # Browser reconnects after this; a stream holds a server thread
+
+# Warm SMTP connections shared by requests and send pools in this process
+from smtp_pool import connection_cache  # noqa: E402
+connection_cache.configure(app.config['SMTP_CACHE_NOOP_AFTER'], app.config['SMTP_CACHE_MAX_IDLE'],
+                           app.config['SMTP_CACHE_IDLE_PER_SENDER'])
+
+# Priority lanes for send slots
+import dispatch  # noqa: E402
+dispatch.configure(app.config['SEND_INTERACTIVE_TARGET'], app.config['SEND_TRANSACTIONAL_WEIGHT'])
+
+# Ensure upload directories exist
+os.makedirs(app.config['INCOMING_FOLDER'], exist_ok=True)
+
+with app.app_context():
+    import models  # noqa: F401
+    db.create_all()
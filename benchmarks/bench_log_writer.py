@@ -0,0 +1,67 @@
+"""Benchmark EmailLog writes: per-row commits versus the batched EmailLogWriter.
+
+    python benchmarks/bench_log_writer.py --rows 5000
+    DATABASE_URL=postgresql://... python benchmarks/bench_log_writer.py
+
+Uses a throwaway SQLite file unless DATABASE_URL is set. Each run creates
+its own campaign row and deletes its logs afterwards.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import app, db  # noqa: E402
+from log_writer import EmailLogWriter  # noqa: E402
+from models import EmailCampaign, EmailLog  # noqa: E402
+
+def new_campaign():
+    campaign = EmailCampaign(subject='bench', template_filename='', csv_filename='bench.csv',
+                             mode='personalized', status='sending')
+    db.session.add(campaign)
+    db.session.commit()
+    return campaign
+
+def per_row_commits(campaign, rows):
+    """What send_bulk_emails did before: one ORM object and one commit per recipient"""
+    for i in range(rows):
+        db.session.add(EmailLog(campaign_id=campaign.id, recipient_email=f"learner{i}@example.com", status='sent'))
+        campaign.sent_emails = i + 1
+        db.session.commit()
+
+def batched_writer(campaign, rows, batch_size):
+    with EmailLogWriter(campaign, batch_size=batch_size) as log_writer:
+        for i in range(rows):
+            log_writer.record(f"learner{i}@example.com")
+
+def run(label, func, rows, *args):
+    campaign = new_campaign()
+    start = time.perf_counter()
+    func(campaign, rows, *args)
+    elapsed = time.perf_counter() - start
+    logged = EmailLog.query.filter_by(campaign_id=campaign.id).count()
+    print(f"{label:>22}: {rows:,} rows in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s), logged {logged:,}")
+    EmailLog.query.filter_by(campaign_id=campaign.id).delete()
+    db.session.delete(campaign)
+    db.session.commit()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    with app.app_context():
+        print(f"database: {db.engine.url.render_as_string(hide_password=True)}")
+        old = run('per-row commit', per_row_commits, args.rows)
+        new = run(f'batched ({args.batch_size}/flush)', batched_writer, args.rows, args.batch_size)
+        print(f"speed-up: {old / new:.0f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Benchmark the campaign send paths end to end against the local SMTP sink.
+
+    python benchmarks/bench_send.py
+    python benchmarks/bench_send.py --modes bcc --rows 100000 --latency 0.02
+    python benchmarks/bench_send.py --refuse-rate 0.01 --drop-after 1000
+    python benchmarks/bench_send.py --modes personalized --shards 4
+    python benchmarks/bench_send.py --transport null
+    python benchmarks/bench_send.py --save baseline.json
+    python benchmarks/bench_send.py --baseline baseline.json
+
+Each case generates a recipient CSV and sends it through
+worker.run_campaign, the code path a queued campaign takes: CSV streaming,
+suppression filter, rendering, SMTP and EmailLog writes. The sink runs in
+the same process, and each case runs in a fresh interpreter so its peak
+memory is its own. Reported per case:
+
+- recipients and SMTP messages per second;
+- SMTP transaction latency percentiles, from the campaign's ``smtp_send``
+  phase timings (bucket estimates, shards included);
+- peak RSS, and its growth over the interpreter after imports;
+- with ``--phases``, the campaign's per-phase timing summary.
+
+Uses a throwaway SQLite file unless DATABASE_URL is set. The sender rate
+limits are lifted unless SMTP_RATE_PER_SECOND/SMTP_RATE_PER_MINUTE are set.
+With ``--baseline``, a case whose recipients per second dropped by more than
+``--tolerance`` is flagged and the script exits with status 1.
+
+``--transport maildir|mbox|null`` runs the cases as dry runs (see
+transports.py) instead of against the sink, which measures everything but
+the SMTP exchange; message counts then come from the ``smtp_send`` phase.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEMPLATE = (
+    "Dear <Name>,\n\n"
+    "Your next module in <Course> opens on Monday. "
+    "Log in to the learning platform to get started.\n\n"
+    "Regards,\nStudent Success\n"
+)
+
+def generate_csv(path, rows):
+    with open(path, 'w') as f:
+        f.write('Email,Name,Course\n')
+        for i in range(rows):
+            f.write(f'learner{i}@example.com,Learner {i},Data Science\n')
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_case(mode, rows, args):
+    """Run one case in this process and return its results"""
+    workdir = tempfile.mkdtemp()
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    os.environ.setdefault('SMTP_RATE_PER_SECOND', '1000000')
+    os.environ.setdefault('SMTP_RATE_PER_MINUTE', '60000000')
+    os.environ['SMTP_STARTTLS'] = '0'
+    os.environ['SMTP_PIPELINING'] = '0' if args.no_pipelining else '1'
+    os.environ['CAMPAIGN_SHARDS'] = str(args.shards)
+    os.environ['SPOOL_FOLDER'] = os.path.join(workdir, 'spool')
+
+    from app import app, db
+    from models import EmailCampaign
+    from sender_accounts import encrypt_campaign_password
+    from smtp_sink import SMTPSink
+    from worker import run_campaign
+
+    csv_path = os.path.join(workdir, 'recipients.csv')
+    generate_csv(csv_path, rows)
+    base_rss = peak_rss_mb()
+
+    sink = SMTPSink(latency=args.latency, pipelining=not args.no_pipelining, keep_messages=False,
+                    max_recipients=args.max_recipients, refuse_rate=args.refuse_rate,
+                    transient_rate=args.transient_rate, drop_after=args.drop_after, seed=0)
+    with sink, app.app_context():
+        host, port = sink.address
+        campaign = EmailCampaign(
+            subject='Your next module', template_filename='bench.html', csv_filename='recipients.csv',
+            mode=mode, status='sending', template=TEMPLATE, placeholders=['Name', 'Course'],
+            csv_path=csv_path, smtp_server=host, smtp_port=port,
+            sender_email='sender@example.com', sender_password=encrypt_campaign_password('secret'),
+            transport=None if args.transport == 'smtp' else args.transport,
+        )
+        db.session.add(campaign)
+        db.session.commit()
+
+        start = time.perf_counter()
+        run_campaign(campaign)
+        elapsed = time.perf_counter() - start
+
+        campaign = db.session.get(EmailCampaign, campaign.id)
+        phases = campaign.timing_summary or {}
+        smtp_send = phases.get('smtp_send', {})
+        messages = sink.message_count if args.transport == 'smtp' else smtp_send.get('count', 0)
+        return {
+            'mode': mode,
+            'rows': rows,
+            'status': campaign.status,
+            'seconds': elapsed,
+            'sent': campaign.sent_emails,
+            'failed': campaign.failed_emails,
+            'recipients_per_second': (campaign.sent_emails + campaign.failed_emails) / elapsed,
+            'messages': messages,
+            'messages_per_second': messages / elapsed,
+            'connections': sink.connection_count,
+            'latency_ms': {key: smtp_send.get(f'{key}_ms', 0.0) for key in ('p50', 'p95', 'p99', 'max')},
+            'peak_rss_mb': peak_rss_mb(),
+            'rss_growth_mb': peak_rss_mb() - base_rss,
+            'phases': phases,
+        }
+
+def case_args(args):
+    """The options to pass on to a case's interpreter"""
+    forwarded = ['--latency', str(args.latency), '--refuse-rate', str(args.refuse_rate),
+                 '--transient-rate', str(args.transient_rate), '--shards', str(args.shards),
+                 '--transport', args.transport]
+    if args.max_recipients is not None:
+        forwarded += ['--max-recipients', str(args.max_recipients)]
+    if args.drop_after is not None:
+        forwarded += ['--drop-after', str(args.drop_after)]
+    if args.no_pipelining:
+        forwarded.append('--no-pipelining')
+    return forwarded
+
+def print_result(result, baseline=None):
+    latency = result['latency_ms']
+    line = (f"{result['mode']:>12} {result['rows']:>8,}: {result['seconds']:7.2f}s "
+            f"{result['recipients_per_second']:9,.0f} rcpt/s {result['messages_per_second']:9,.0f} msg/s  "
+            f"p50 {latency['p50']:6.2f}ms p95 {latency['p95']:6.2f}ms p99 {latency['p99']:7.2f}ms  "
+            f"rss {result['peak_rss_mb']:6.0f}MB (+{result['rss_growth_mb']:.0f})  "
+            f"sent {result['sent']:,} failed {result['failed']:,}")
+    if baseline is not None:
+        change = result['recipients_per_second'] / baseline['recipients_per_second'] - 1
+        line += f"  {change:+.0%} vs baseline"
+    print(line, flush=True)
+
+def print_phases(result):
+    for phase, timing in result.get('phases', {}).items():
+        print(f"{'':>22}{phase:>16}: {timing['count']:>8,} x {timing['mean_ms']:8.3f}ms = {timing['total_seconds']:8.2f}s  "
+              f"p95 {timing['p95_ms']:8.3f}ms max {timing['max_ms']:8.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['personalized', 'bcc'], choices=['personalized', 'bcc'])
+    parser.add_argument('--rows', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.0, help="sink seconds per round trip")
+    parser.add_argument('--refuse-rate', type=float, default=0.0, help="fraction of recipients refused with 550")
+    parser.add_argument('--transient-rate', type=float, default=0.0, help="fraction of RCPTs answered with 451")
+    parser.add_argument('--max-recipients', type=int, help="sink cap on recipients per message")
+    parser.add_argument('--drop-after', type=int, help="messages per sink connection before a 421")
+    parser.add_argument('--no-pipelining', action='store_true')
+    parser.add_argument('--shards', type=int, default=1, help="processes per personalized campaign")
+    parser.add_argument('--transport', default='smtp', choices=['smtp', 'maildir', 'mbox', 'null'],
+                        help="send to the sink, or dry-run into a spool or nowhere")
+    parser.add_argument('--phases', action='store_true', help="print each case's per-phase timings")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against results saved with --save")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed drop in rcpt/s against the baseline")
+    parser.add_argument('--case', nargs=2, metavar=('MODE', 'ROWS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # Child interpreter: run one case and report it as JSON on the last line
+        mode, rows = args.case
+        print(json.dumps(run_case('bulk' if mode == 'bcc' else mode, int(rows), args)))
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(r['mode'], r['rows']): r for r in json.load(f)}
+
+    results = []
+    regressions = []
+    for mode in args.modes:
+        for rows in args.rows:
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--case', mode, str(rows)] + case_args(args),
+                cwd=ROOT, capture_output=True, text=True,
+            )
+            if proc.returncode != 0:
+                print(f"{mode} {rows:,}: failed\n{proc.stderr}", file=sys.stderr)
+                sys.exit(proc.returncode)
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            result['mode'] = mode
+            previous = baseline.get((mode, rows))
+            print_result(result, previous)
+            if args.phases:
+                print_phases(result)
+            results.append(result)
+            if previous and result['recipients_per_second'] < previous['recipients_per_second'] * (1 - args.tolerance):
+                regressions.append(f"{mode} {rows:,}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
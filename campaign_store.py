@@ -0,0 +1,124 @@
+"""Server-side campaign state.
+
+``/process_campaign`` saves its result as an ``EmailCampaign`` row with
+``status='draft'`` and the session only remembers the row's ID. Preview,
+test sends and ``/send_campaign`` read the draft back through
+``CampaignStore``, which keeps recently used campaigns in an in-memory LRU
+of plain dicts so those requests do not each hit the database. The cache
+is per process and only holds what a draft was created with; progress
+counters are always read from the database or the progress bus.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app import app, db
+from models import EmailCampaign
+
+HISTORY_LIMIT = 10
+
+def campaign_dict(campaign):
+    """The draft fields of a campaign, in the shape the templates expect"""
+    counts = campaign.validation_counts or {}
+    return {
+        'id': campaign.id,
+        'sender_email': campaign.sender_email,
+        'subject': campaign.subject,
+        'template': campaign.template,
+        'template_filename': campaign.template_filename,
+        'mode': campaign.mode,
+        'csv_path': campaign.csv_path,
+        'recipients_key': campaign.recipients_key,
+        'placeholders': campaign.placeholders or [],
+        'valid_count': campaign.total_emails or 0,
+        'invalid_count': counts.get('invalid', 0),
+        'missing_fields': counts.get('missing_fields', {}),
+        'duplicate_count': counts.get('duplicate', 0),
+        'suppressed_count': counts.get('suppressed', 0),
+        'sample_data': campaign.sample_data or {},
+    }
+
+def history_entry(campaign):
+    total = campaign.total_emails or 0
+    sent_count = campaign.sent_emails or 0
+    return {
+        'id': campaign.id,
+        'subject': campaign.subject,
+        'date': campaign.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'total_recipients': total,
+        'sent_successfully': sent_count,
+        'failed_to_send': campaign.failed_emails or 0,
+        'success_rate': (sent_count / total * 100) if total > 0 else 0,
+        'dry_run': bool(campaign.transport),
+    }
+
+class CampaignStore:
+    """Campaign drafts in the database with an LRU cache in front"""
+
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, data):
+        with self._lock:
+            self._cache[data['id']] = data
+            self._cache.move_to_end(data['id'])
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def create_draft(self, sender_email, **fields):
+        """Save a processed campaign as a draft and return its ID"""
+        campaign = EmailCampaign(status='draft', sender_email=sender_email, **fields)
+        db.session.add(campaign)
+        db.session.commit()
+        self._remember(campaign_dict(campaign))
+        return campaign.id
+
+    def get(self, campaign_id, sender_email):
+        """The campaign's draft fields, or None if it is missing or not this sender's"""
+        if campaign_id is None:
+            return None
+        with self._lock:
+            data = self._cache.get(campaign_id)
+            if data is not None:
+                self._cache.move_to_end(campaign_id)
+        if data is None:
+            campaign = db.session.get(EmailCampaign, campaign_id)
+            if campaign is None:
+                return None
+            data = campaign_dict(campaign)
+            self._remember(data)
+        return data if data['sender_email'] == sender_email else None
+
+    def invalidate(self, campaign_id):
+        with self._lock:
+            self._cache.pop(campaign_id, None)
+
+    def history(self, sender_email, limit=HISTORY_LIMIT):
+        """The sender's most recent finished campaigns"""
+        campaigns = (
+            EmailCampaign.query
+            .filter(EmailCampaign.sender_email == sender_email,
+                    EmailCampaign.status.in_(('completed', 'failed')))
+            .order_by(EmailCampaign.id.desc())
+            .limit(limit)
+        )
+        return [history_entry(campaign) for campaign in campaigns]
+
+    def purge_drafts(self, max_age_seconds):
+        """Delete drafts that were never sent, returning how many"""
+        cutoff = datetime.now() - timedelta(seconds=max_age_seconds)
+        stale = [campaign_id for (campaign_id,) in db.session.query(EmailCampaign.id).filter(
+            EmailCampaign.status == 'draft', EmailCampaign.created_at < cutoff
+        )]
+        if stale:
+            EmailCampaign.query.filter(EmailCampaign.id.in_(stale), EmailCampaign.status == 'draft').delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+            for campaign_id in stale:
+                self.invalidate(campaign_id)
+        return len(stale)
+
+store = CampaignStore(app.config['CAMPAIGN_CACHE_SIZE'])
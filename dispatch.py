@@ -0,0 +1,142 @@
+"""Priority lanes for a sender's send slots.
+
+Everything sent from one account waits for the same rate limiter (see
+rate_limiter.limiter_for), so without ordering an operator's test email
+queues behind whatever campaign happens to be running. Each send declares
+a lane:
+
+- ``interactive``: test sends someone is waiting on. Always served first,
+  and allowed to borrow a slot from the rate budget once waiting longer
+  would miss ``LATENCY_TARGETS['interactive']``; campaigns repay the
+  borrowed slot by waiting a little longer.
+- ``transactional``: one-off system mail such as the login verification.
+- ``bulk``: campaigns.
+
+Transactional sends and campaigns share the remaining slots by weighted
+fair queuing: each (lane, flow) pair, where the flow is the campaign,
+gets slots in proportion to ``LANE_WEIGHTS[lane] * weight``, so two
+campaigns from the same account each get half and a new one is not stuck
+behind an old one. ``dispatching(lane, flow)`` sets the lane for the sends
+in its block; run_windowed's context copy carries it to send workers.
+Time spent queued is recorded per lane as ``queue_wait_seconds``.
+"""
+import contextvars
+import itertools
+from collections import deque
+from contextlib import contextmanager
+
+INTERACTIVE = 'interactive'
+TRANSACTIONAL = 'transactional'
+BULK = 'bulk'
+LANES = (INTERACTIVE, TRANSACTIONAL, BULK)
+
+LANE_WEIGHTS = {TRANSACTIONAL: 4.0, BULK: 1.0}
+LATENCY_TARGETS = {INTERACTIVE: 1.0}  # Seconds a lane may wait before borrowing a slot
+
+def configure(interactive_target=None, transactional_weight=None):
+    if interactive_target is not None:
+        LATENCY_TARGETS[INTERACTIVE] = interactive_target
+    if transactional_weight is not None:
+        LANE_WEIGHTS[TRANSACTIONAL] = transactional_weight
+
+_current = contextvars.ContextVar('dispatch_lane', default=(BULK, None, 1.0))
+
+@contextmanager
+def dispatching(lane, flow=None, weight=1.0):
+    """Send from this block in ``lane``, as part of ``flow`` (e.g. a campaign id)"""
+    if lane not in LANES:
+        raise ValueError(f"Unknown send lane {lane!r}")
+    token = _current.set((lane, flow, weight))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+def current_lane():
+    """``(lane, flow, weight)`` of the calling context"""
+    return _current.get()
+
+class Waiter:
+    __slots__ = ('lane', 'key', 'since', 'seq')
+
+    def __init__(self, lane, key, since, seq):
+        self.lane = lane
+        self.key = key
+        self.since = since
+        self.seq = seq
+
+class _Flow:
+    __slots__ = ('weight', 'finish', 'waiters')
+
+    def __init__(self, weight, finish):
+        self.weight = weight
+        self.finish = finish  # Virtual time this flow's next slot starts at
+        self.waiters = deque()
+
+class LaneQueue:
+    """Who gets a sender's next slot: interactive first, then weighted fair queuing.
+
+    Not thread-safe; the owning rate limiter calls it under its lock.
+    """
+
+    def __init__(self):
+        self._interactive = deque()
+        self._flows = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._interactive) + sum(len(flow.waiters) for flow in self._flows.values())
+
+    def push(self, lane, flow, weight, now):
+        waiter = Waiter(lane, (lane, flow), now, next(self._seq))
+        if lane == INTERACTIVE:
+            self._interactive.append(waiter)
+            return waiter
+        entry = self._flows.get(waiter.key)
+        if entry is None:
+            entry = self._flows[waiter.key] = _Flow(LANE_WEIGHTS.get(lane, 1.0) * weight, self._virtual_time)
+        elif not entry.waiters:
+            # A flow coming back from idle does not get credit for the time it sat out
+            entry.finish = max(entry.finish, self._virtual_time)
+        entry.waiters.append(waiter)
+        return waiter
+
+    def head(self):
+        """The waiter to serve next, or None"""
+        if self._interactive:
+            return self._interactive[0]
+        best = None
+        for entry in self._flows.values():
+            if entry.waiters and (best is None or (entry.finish, entry.waiters[0].seq)
+                                  < (best.finish, best.waiters[0].seq)):
+                best = entry
+        return best.waiters[0] if best is not None else None
+
+    def grant(self, waiter):
+        """Remove the head ``waiter`` once it has its slot"""
+        if waiter.lane == INTERACTIVE:
+            self._interactive.remove(waiter)
+            return
+        entry = self._flows[waiter.key]
+        entry.waiters.remove(waiter)
+        self._virtual_time = entry.finish
+        entry.finish += 1.0 / entry.weight
+        self._forget_idle()
+
+    def cancel(self, waiter):
+        """Remove a waiter that gave up, e.g. on an exception while waiting"""
+        if waiter.lane == INTERACTIVE:
+            if waiter in self._interactive:
+                self._interactive.remove(waiter)
+            return
+        entry = self._flows.get(waiter.key)
+        if entry is not None and waiter in entry.waiters:
+            entry.waiters.remove(waiter)
+            self._forget_idle()
+
+    def _forget_idle(self):
+        # Idle flows that are not ahead of the clock would restart at it anyway
+        for key in [key for key, entry in self._flows.items()
+                    if not entry.waiters and entry.finish <= self._virtual_time]:
+            del self._flows[key]
@@ -1,54 +1,153 @@
-import smtplib
+import numpy as np
 import pandas as pd
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import re
-import os
-import time
 from datetime import datetime
 from models import EmailCampaign, EmailLog
 from app import db
+from log_writer import EmailLogWriter, resume_checkpoint
+from message_builder import MessageSkeleton
+from metrics import campaign_timings, timed
+from dispatch import BULK, INTERACTIVE, dispatching
+from rate_limiter import limiter_for, rate_limited
+from send_engine import send_bcc, send_personalized
+from sender_accounts import campaign_accounts, record_usage
+from sender_pool import SenderRotation, combine_usage
+from sharding import ShardedRecipients, send_sharded
+from smtp_pool import connection_cache
+from template_engine import compile_template
+from transports import is_dry_run
 
 def extract_placeholders(template):
     """Extract placeholders in the format <Placeholder> from template"""
-    all_phs = re.findall(r'<([^<>]+)>', template)
-    unique_phs = list(dict.fromkeys(all_phs))
-    return all_phs, unique_phs
+    compiled = compile_template(template)
+    return compiled.all_placeholders, compiled.placeholders
+
+EMAIL_PATTERN = r'^[\w\.-]+@[\w\.-]+\.\w+$'
+EMAIL_RE = re.compile(EMAIL_PATTERN)
+EMAIL_INVALID = 'Email (Invalid)'
 
 def is_valid_email(email):
     """Validate email format"""
-    pattern = r'^[\w\.-]+@[\w\.-]+\.\w+$'
-    return re.match(pattern, str(email)) is not None
+    return EMAIL_RE.match(str(email)) is not None
+
+# EMAIL_PATTERN as a DFA over character classes, so a column can be checked
+# one character position at a time for all its values at once
+_END, _WORD, _DOT, _DASH, _AT, _NEWLINE, _OTHER = range(7)
+_CHAR_CLASS = np.full(129, _OTHER, dtype=np.uint8)  # Codes above 127 are clipped to 128
+_CHAR_CLASS[0] = _END  # numpy's padding after the end of a shorter value
+for _lo, _hi in ('AZ', 'az', '09', '__'):
+    _CHAR_CLASS[ord(_lo):ord(_hi) + 1] = _WORD
+_CHAR_CLASS[[ord('.'), ord('-'), ord('@'), ord('\n')]] = [_DOT, _DASH, _AT, _NEWLINE]
+
+_DEAD, _START, _LOCAL, _DOMAIN_START, _DOMAIN, _SEPARATOR, _SUFFIX, _TRAILING, _ACCEPT = range(9)
+_TRANSITIONS = {
+    _START: {_WORD: _LOCAL, _DOT: _LOCAL, _DASH: _LOCAL},
+    _LOCAL: {_WORD: _LOCAL, _DOT: _LOCAL, _DASH: _LOCAL, _AT: _DOMAIN_START},
+    _DOMAIN_START: {_WORD: _DOMAIN, _DOT: _DOMAIN, _DASH: _DOMAIN},
+    _DOMAIN: {_WORD: _DOMAIN, _DASH: _DOMAIN, _DOT: _SEPARATOR},
+    # A dot with something before it, then word characters to the end
+    _SEPARATOR: {_WORD: _SUFFIX, _DOT: _SEPARATOR, _DASH: _DOMAIN},
+    _SUFFIX: {_WORD: _SUFFIX, _DOT: _SEPARATOR, _DASH: _DOMAIN, _NEWLINE: _TRAILING, _END: _ACCEPT},
+    _TRAILING: {_END: _ACCEPT},  # '$' also matches before a final newline
+    _ACCEPT: {_END: _ACCEPT},
+}
+_STEP = np.zeros(256, dtype=np.uint8)  # Next state at (state << 3) | class; _DEAD is 0
+for _state, _moves in _TRANSITIONS.items():
+    for _cls, _next in _moves.items():
+        _STEP[(_state << 3) | _cls] = _next
+
+EMAIL_MASK_BLOCK = 8192  # Values per DFA pass
+EMAIL_MAX_LENGTH = 254  # Longer values skip the DFA (and are not valid addresses anyway)
+
+def _dfa_email_mask(values, lengths):
+    """EMAIL_PATTERN over ASCII strings of at most EMAIL_MAX_LENGTH characters"""
+    block = values.astype('U')
+    width = block.dtype.itemsize // 4
+    codes = block.view(np.uint32).reshape(len(block), width)
+    classes = _CHAR_CLASS.take(np.minimum(codes, 128)).T.copy()
+    state = np.full(len(block), _START, dtype=np.uint8)
+    for column in classes:
+        state = _STEP.take((state << 3) | column)
+    # numpy drops trailing NULs, which the regex would reject
+    return (_STEP.take((state << 3) | _END) == _ACCEPT) & (np.char.str_len(block) == lengths)
+
+def valid_email_mask(emails):
+    """Vectorized is_valid_email over a whole column.
+
+    Values are run through a table-driven DFA equivalent to EMAIL_PATTERN
+    for ASCII text, one character position at a time across a block of
+    values. The few it rejects, which include any with non-ASCII word
+    characters, are checked again with the regex, so the result is exactly
+    is_valid_email's.
+    """
+    values = emails.to_numpy(dtype=object)
+    missing = pd.isna(values)
+    if missing.any():
+        values = np.where(missing, '', values)
+    try:
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    except TypeError:
+        # Numbers or other non-strings, checked as is_valid_email sees them
+        values = np.array([str(value) for value in values], dtype=object)
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    valid = np.zeros(len(values), dtype=bool)
+    short = np.flatnonzero(lengths <= EMAIL_MAX_LENGTH)
+    for start in range(0, len(short), EMAIL_MASK_BLOCK):
+        rows = short[start:start + EMAIL_MASK_BLOCK]
+        valid[rows] = _dfa_email_mask(values[rows], lengths[rows])
+    recheck = np.flatnonzero(~valid)
+    if len(recheck):
+        valid[recheck] = [EMAIL_RE.match(value) is not None for value in values[recheck]]
+    return pd.Series(valid, index=emails.index)
+
+def blank_mask(values):
+    """True where a column value is missing or only whitespace"""
+    blank = values.isna().to_numpy().copy()
+    present = np.flatnonzero(~blank)
+    cells = values.to_numpy(dtype=object)[present]
+    try:
+        blank[present] = [cell == '' or cell.isspace() for cell in cells]
+    except AttributeError:
+        # Not all strings (a DataFrame that was not read with dtype=str)
+        blank[present] = [str(cell).strip() == '' for cell in cells]
+    return blank
+
+def missing_fields_mask(df, placeholders):
+    """What each row fails, column by column: 'Email (Invalid)' and each blank placeholder"""
+    checks = {EMAIL_INVALID: ~valid_email_mask(df['Email']).to_numpy()}
+    for ph in placeholders:
+        if ph in df.columns and ph != 'Email':
+            checks[ph] = blank_mask(df[ph])
+    return pd.DataFrame(checks, index=df.index)
+
+def missing_fields(failed):
+    """Per-row lists of the checks a missing_fields_mask row failed, [] where it passed"""
+    labels = np.array(list(failed.columns), dtype=object)
+    flags = failed.to_numpy()
+    fields = [[] for _ in range(len(failed))]
+    for pos in np.flatnonzero(flags.any(axis=1)):
+        fields[pos] = list(labels[flags[pos]])
+    return fields
 
 def validate_csv_data(df, placeholders):
-    """Validate CSV data and return valid/invalid rows"""
-    def row_missing_fields(row, placeholders):
-        missing = []
-        if not is_valid_email(row['Email']):
-            missing.append('Email (Invalid)')
-        for ph in placeholders:
-            if ph in row and (pd.isna(row[ph]) or str(row[ph]).strip() == ''):
-                missing.append(ph)
-        return missing
-
-    df['MissingFields'] = df.apply(lambda row: row_missing_fields(row, placeholders), axis=1)
-    df_valid = df[df['MissingFields'].apply(lambda x: len(x) == 0)]
-    df_invalid = df[df['MissingFields'].apply(lambda x: len(x) > 0)]
-    
-    return df_valid, df_invalid
+    """Validate CSV data and return valid/invalid rows
+
+    Checks run column-at-a-time with boolean masks. Each row gets a
+    MissingFields list naming what failed: 'Email (Invalid)' and/or the
+    placeholder columns that are blank.
+    """
+    failed = missing_fields_mask(df, placeholders)
+    invalid = failed.any(axis=1).to_numpy()
+    df['MissingFields'] = missing_fields(failed)
+    return df[~invalid], df[invalid]
 
 def send_test_email(template, placeholders, sample_data, subject, test_email, smtp_config):
     """Send a test email with sample data"""
     try:
         # Replace placeholders with sample data
-        body = template
-        for ph in placeholders:
-            if ph in sample_data:
-                body = body.replace(f"<{ph}>", str(sample_data[ph]))
-        
-        server = smtplib.SMTP(smtp_config['server'], smtp_config['port'])
-        server.starttls()
-        server.login(smtp_config['email'], smtp_config['password'])
+        body = compile_template(template).render(sample_data)
         
         msg = MIMEMultipart()
         msg['From'] = smtp_config['email']
@@ -56,139 +155,224 @@ def send_test_email(template, placeholders, sample_data, subject, test_email, sm
         msg['Subject'] = f"[TEST] {subject}"
         msg.attach(MIMEText(body, 'plain'))
         
-        server.send_message(msg)
-        server.quit()
+        with rate_limited(limiter_for(smtp_config), INTERACTIVE):
+            connection_cache.run(smtp_config, lambda server: server.send_message(msg))
         return True, "Test email sent successfully"
     except Exception as e:
         return False, str(e)
 
-def send_bulk_emails(campaign_id, template, placeholders, df_valid, subject, mode, smtp_config):
-    """Send bulk emails and update campaign status"""
+def iter_rows(recipients, chunksize=5000):
+    """Row dicts from a DataFrame (blank cells as '') or any iterable of row dicts"""
+    if isinstance(recipients, pd.DataFrame):
+        for start in range(0, len(recipients), chunksize):
+            yield from recipients.iloc[start:start + chunksize].fillna('').to_dict('records')
+    else:
+        yield from recipients
+
+def personalized_builder(template, subject):
+    """``build_message(row, sender)`` for send_personalized: the rendered message for one recipient"""
+    compiled = compile_template(template)
+    skeletons = {}
+    
+    def build_message(learner, sender):
+        email_addr = learner['Email']
+        skeleton = skeletons.get(sender)
+        if skeleton is None:
+            skeleton = skeletons.setdefault(sender, MessageSkeleton(sender, subject))
+        with timed('render'):
+            body = compiled.render(learner, default='')
+        with timed('mime_build'):
+            return email_addr, skeleton.build(email_addr, body)
+    
+    return build_message
+
+def bcc_builder(template, subject):
+    """``build_message(sender)`` for send_bcc: the one message, as wire bytes or a string"""
+    messages = {}
+    
+    def build_message(sender):
+        msg = messages.get(sender)
+        if msg is None:
+            with timed('mime_build'):
+                msg = MessageSkeleton(sender, subject).build(sender, template)
+                if not isinstance(msg, bytes):
+                    msg = msg.as_string()
+            msg = messages.setdefault(sender, msg)
+        return msg
+    
+    return build_message
+
+def send_bulk_emails(campaign_id, template, placeholders, recipients, subject, mode, smtp_config):
+    """Send bulk emails and update campaign status
+
+    ``recipients`` is a DataFrame of valid rows or an iterable of row dicts,
+    such as the stream from recipients.iter_recipients, which is consumed
+    lazily as messages go out. A sharding.ShardedRecipients list is sent
+    from one process per shard (personalized mode only).
+    
+    Safe to call again for a campaign that was interrupted: recipients
+    already logged as sent are skipped (see log_writer.resume_checkpoint).
+    
+    Sends rotate over the sender's registered accounts (see
+    sender_accounts); what each one sent is stored on the campaign and
+    counted against its daily quota, unless the campaign is a dry run
+    (see transports.py).
+    """
     campaign = EmailCampaign.query.get(campaign_id)
     campaign.status = 'sending'
-    campaign.total_emails = len(df_valid)
-    db.session.commit()
+    if hasattr(recipients, '__len__'):
+        campaign.total_emails = len(recipients)
+    already_sent = resume_checkpoint(campaign)
     
-    try:
-        server = smtplib.SMTP(smtp_config['server'], smtp_config['port'])
-        server.starttls()
-        server.login(smtp_config['email'], smtp_config['password'])
-        
-        sent_count = 0
-        failed_count = 0
-        
-        if mode == 'personalized':
-            # Send personalized emails
-            for _, row in df_valid.iterrows():
-                learner = row.to_dict()
-                email_addr = learner['Email']
-                
-                try:
-                    body = template
-                    for ph in placeholders:
-                        body = body.replace(f"<{ph}>", str(learner[ph]))
-                    
-                    msg = MIMEMultipart()
-                    msg['From'] = smtp_config['email']
-                    msg['To'] = email_addr
-                    msg['Subject'] = subject
-                    msg.attach(MIMEText(body, 'plain'))
-                    
-                    server.send_message(msg)
-                    sent_count += 1
-                    
-                    # Log success
-                    log = EmailLog(
-                        campaign_id=campaign_id,
-                        recipient_email=email_addr,
-                        status='sent'
-                    )
-                    db.session.add(log)
-                    
-                except Exception as e:
-                    failed_count += 1
+    rows = iter_rows(recipients)
+    if already_sent:
+        rows = (row for row in rows if row['Email'] not in already_sent)
+    
+    # Every account the campaign may send from, with today's quota left
+    smtp_config = dict(smtp_config, accounts=campaign_accounts(smtp_config))
+    senders = SenderRotation.from_config(smtp_config)
+    dry_run = is_dry_run(smtp_config)
+    
+    # Phase timings of this run, stored on the campaign when it ends; sends
+    # share the accounts' slots fairly with other campaigns (see dispatch.py)
+    with campaign_timings() as timings, dispatching(BULK, flow=campaign_id):
+        try:
+            with EmailLogWriter(campaign) as log_writer:
+                if mode == 'personalized':
+                    # Send personalized emails over the pooled connections
+                    build_message = personalized_builder(template, subject)
                     
-                    # Log failure
-                    log = EmailLog(
-                        campaign_id=campaign_id,
-                        recipient_email=email_addr,
-                        status='failed',
-                        error_message=str(e)
-                    )
-                    db.session.add(log)
-                
-                # Update campaign progress
-                campaign.sent_emails = sent_count
-                campaign.failed_emails = failed_count
-                db.session.commit()
+                    # Outcomes are logged and counted in batches by the writer
+                    if isinstance(recipients, ShardedRecipients):
+                        send_sharded(recipients, build_message, smtp_config, log_writer.record,
+                                     skip=already_sent, senders=senders)
+                    else:
+                        send_personalized(rows, build_message, smtp_config, log_writer.record, senders)
                 
-                time.sleep(1)  # Rate limiting
-        
-        else:
-            # Bulk BCC mode
-            try:
-                msg = MIMEMultipart()
-                msg['From'] = smtp_config['email']
-                msg['To'] = smtp_config['email']
-                msg['Subject'] = subject
-                msg.attach(MIMEText(template, 'plain'))
-                
-                bcc_list = df_valid['Email'].tolist()
-                server.sendmail(smtp_config['email'], bcc_list, msg.as_string())
-                
-                sent_count = len(bcc_list)
-                
-                # Log success for all emails
-                for email_addr in bcc_list:
-                    log = EmailLog(
-                        campaign_id=campaign_id,
-                        recipient_email=email_addr,
-                        status='sent'
-                    )
-                    db.session.add(log)
-                
-            except Exception as e:
-                failed_count = len(df_valid)
-                
-                # Log failure for all emails
-                for _, row in df_valid.iterrows():
-                    log = EmailLog(
-                        campaign_id=campaign_id,
-                        recipient_email=row['Email'],
-                        status='failed',
-                        error_message=str(e)
-                    )
-                    db.session.add(log)
-        
-        server.quit()
-        
-        # Update final campaign status
-        campaign.sent_emails = sent_count
-        campaign.failed_emails = failed_count
-        campaign.status = 'completed'
-        campaign.completed_at = datetime.now()
-        db.session.commit()
-        
-        return True, f"Campaign completed. Sent: {sent_count}, Failed: {failed_count}"
-        
-    except Exception as e:
-        campaign.status = 'failed'
-        db.session.commit()
-        return False, str(e)
+                else:
+                    # Bulk BCC mode: one message, sent in parallel recipient chunks
+                    send_bcc((row['Email'] for row in rows), bcc_builder(template, subject), smtp_config,
+                             log_writer.record, senders)
+            
+            sent_count = log_writer.sent_count
+            failed_count = log_writer.failed_count
+            
+            # Update final campaign status
+            campaign.status = 'completed'
+            campaign.completed_at = datetime.now()
+            campaign.timing_summary = timings.summary()
+            usage = senders.usage()
+            campaign.sender_usage = combine_usage(campaign.sender_usage, usage)
+            db.session.commit()
+            if not dry_run:
+                record_usage(usage)
+            
+            return True, f"Campaign completed. Sent: {sent_count}, Failed: {failed_count}"
+            
+        except Exception as e:
+            db.session.rollback()
+            campaign.status = 'failed'
+            campaign.timing_summary = timings.summary()
+            usage = senders.usage()
+            campaign.sender_usage = combine_usage(campaign.sender_usage, usage)
+            db.session.commit()
+            if not dry_run:
+                record_usage(usage)
+            return False, str(e)
 
-def generate_report(campaign_id):
-    """Generate email campaign report"""
-    campaign = EmailCampaign.query.get(campaign_id)
-    logs = EmailLog.query.filter_by(campaign_id=campaign_id).all()
+REPORT_PAGE_SIZE = 100
+REPORT_STATUSES = ('sent', 'failed')
+
+def report_summary(campaign_id):
+    """Per-status counts, first/last send time and the top failure reasons, computed in SQL"""
+    counts = dict(
+        db.session.query(EmailLog.status, db.func.count(EmailLog.id))
+        .filter(EmailLog.campaign_id == campaign_id)
+        .group_by(EmailLog.status)
+    )
+    first_sent_at, last_sent_at = db.session.query(
+        db.func.min(EmailLog.sent_at), db.func.max(EmailLog.sent_at)
+    ).filter(EmailLog.campaign_id == campaign_id).one()
+    failure_reasons = (
+        db.session.query(EmailLog.error_message, db.func.count(EmailLog.id).label('count'))
+        .filter(EmailLog.campaign_id == campaign_id, EmailLog.status == 'failed')
+        .group_by(EmailLog.error_message)
+        .order_by(db.desc('count'))
+        .limit(10)
+        .all()
+    )
+    return {
+        'sent': counts.get('sent', 0),
+        'failed': counts.get('failed', 0),
+        'first_sent_at': first_sent_at,
+        'last_sent_at': last_sent_at,
+        'failure_reasons': failure_reasons,
+    }
+
+def log_query(campaign_id, status=None):
+    query = EmailLog.query.filter(EmailLog.campaign_id == campaign_id)
+    if status in REPORT_STATUSES:
+        query = query.filter(EmailLog.status == status)
+    return query
+
+def log_page(campaign_id, status=None, after_id=None, before_id=None, page_size=REPORT_PAGE_SIZE):
+    """One page of logs by keyset on ``id``: the page after ``after_id`` or before ``before_id``.
+
+    Returns ``(logs, has_previous, has_next)``. Served from the
+    email_logs(campaign_id, status, id) index whatever page is asked for.
+    """
+    query = log_query(campaign_id, status)
+    if before_id is not None:
+        logs = query.filter(EmailLog.id < before_id).order_by(EmailLog.id.desc()).limit(page_size + 1).all()
+        has_previous = len(logs) > page_size
+        logs = logs[:page_size][::-1]
+        has_next = True
+    else:
+        if after_id is not None:
+            query = query.filter(EmailLog.id > after_id)
+        logs = query.order_by(EmailLog.id).limit(page_size + 1).all()
+        has_next = len(logs) > page_size
+        logs = logs[:page_size]
+        has_previous = after_id is not None
+    return logs, has_previous, has_next
+
+def iter_log_rows(campaign_id, status=None, batch_size=5000):
+    """Stream ``(recipient_email, status, sent_at, error_message)`` tuples in keyset batches"""
+    query = db.session.query(
+        EmailLog.id, EmailLog.recipient_email, EmailLog.status, EmailLog.sent_at, EmailLog.error_message
+    ).filter(EmailLog.campaign_id == campaign_id)
+    if status in REPORT_STATUSES:
+        query = query.filter(EmailLog.status == status)
+    
+    last_id = 0
+    while True:
+        batch = query.filter(EmailLog.id > last_id).order_by(EmailLog.id).limit(batch_size).all()
+        if not batch:
+            return
+        for row in batch:
+            yield row[1:]
+        last_id = batch[-1].id
+
+def generate_report(campaign_id, status=None, after_id=None, before_id=None, page_size=REPORT_PAGE_SIZE):
+    """Generate email campaign report: SQL summary plus one page of logs"""
+    campaign = db.session.get(EmailCampaign, campaign_id)
+    summary = report_summary(campaign_id)
+    logs, has_previous, has_next = log_page(campaign_id, status, after_id, before_id, page_size)
     
     report_data = {
         'campaign': campaign,
         'logs': logs,
+        'status': status if status in REPORT_STATUSES else 'all',
+        'has_previous': has_previous,
+        'has_next': has_next,
         'summary': {
-            'total': campaign.total_emails,
-            'sent': campaign.sent_emails,
-            'failed': campaign.failed_emails
-        }
+            'total': campaign.total_emails or 0,
+            'sent': summary['sent'],
+            'failed': summary['failed'],
+            'first_sent_at': summary['first_sent_at'],
+            'last_sent_at': summary['last_sent_at'],
+        },
+        'failure_reasons': summary['failure_reasons'],
     }
     
     return report_data
@@ -0,0 +1,13 @@
+"""Gunicorn settings, read automatically when gunicorn is started from this directory.
+
+Progress pages keep a Server-Sent Events stream open (see progress_bus.py),
+so the web app needs threaded (or gevent) workers: a sync worker would be
+blocked by each open stream. ``WEB_CONCURRENCY`` sets the worker processes
+and ``GUNICORN_THREADS`` the requests each serves at once.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
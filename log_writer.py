@@ -0,0 +1,135 @@
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from app import app, db
+from metrics import inc, timed
+from models import EmailCampaign, EmailLog
+from progress_bus import bus
+from send_engine import SendFailure
+
+class EmailLogWriter:
+    """Buffers per-recipient outcomes and writes them to the database in batches.
+
+    Outcomes are held in memory and flushed with one multi-row INSERT into
+    ``email_logs`` once ``batch_size`` of them are buffered or
+    ``flush_interval`` seconds have passed since the last flush, whichever
+    comes first. The campaign's ``sent_emails``/``failed_emails`` counters
+    are updated in the same transaction, so they always match the logged
+    rows. Every outcome is also published to the progress bus straight
+    away, so progress streams do not wait for the next flush.
+
+    Crash safety: a flush is all-or-nothing. If the process dies, the
+    outcomes buffered since the last flush (at most one batch, or
+    ``flush_interval`` seconds of sending) are lost, even though those
+    messages may have been delivered. Everything flushed before that is
+    durable and counted, so a resumed campaign re-sends at most that last
+    unflushed window.
+    """
+
+    def __init__(self, campaign, batch_size=None, flush_interval=None, clock=time.monotonic):
+        self.campaign = campaign
+        self.campaign_id = campaign.id
+        self.batch_size = batch_size or app.config['LOG_BATCH_SIZE']
+        self.flush_interval = flush_interval if flush_interval is not None else app.config['LOG_FLUSH_INTERVAL']
+        self._clock = clock
+        self._buffer = []
+        self._last_flush = clock()
+        self.sent_count = campaign.sent_emails or 0
+        self.failed_count = campaign.failed_emails or 0
+        self.total_count = campaign.total_emails or 0
+
+    def record(self, email_addr, error=None):
+        """Buffer the outcome for one recipient; ``error`` is None on success.
+
+        The reply code and phase of a failure are logged with it (see
+        send_engine.SendFailure).
+        """
+        if error is None:
+            self.sent_count += 1
+            self._buffer.append({
+                'campaign_id': self.campaign_id,
+                'recipient_email': email_addr,
+                'status': 'sent',
+                'error_message': None,
+                'smtp_code': None,
+                'smtp_status': None,
+                'smtp_phase': None,
+                'sent_at': datetime.now(),
+            })
+        else:
+            self.failed_count += 1
+            failure = SendFailure.from_error(error)
+            self._buffer.append({
+                'campaign_id': self.campaign_id,
+                'recipient_email': email_addr,
+                'status': 'failed',
+                'error_message': str(failure),
+                'smtp_code': failure.code,
+                'smtp_status': failure.status,
+                'smtp_phase': failure.phase,
+                'sent_at': datetime.now(),
+            })
+
+        inc('emails_total', status='sent' if error is None else 'failed')
+        bus.publish(self.campaign_id, {
+            'status': 'sending',
+            'total_emails': self.total_count,
+            'sent_emails': self.sent_count,
+            'failed_emails': self.failed_count,
+        })
+
+        if len(self._buffer) >= self.batch_size or self._clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write buffered outcomes and the campaign counters in one transaction"""
+        with timed('log_flush'):
+            if self._buffer:
+                db.session.execute(insert(EmailLog), self._buffer)
+            db.session.query(EmailCampaign).filter_by(id=self.campaign_id).update(
+                {'sent_emails': self.sent_count, 'failed_emails': self.failed_count},
+                synchronize_session=False,
+            )
+            db.session.commit()
+        self._buffer = []
+        self._last_flush = self._clock()
+
+    def close(self):
+        self.flush()
+        db.session.refresh(self.campaign)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep whatever was recorded before the failure
+            db.session.rollback()
+            self.flush()
+        return False
+
+def resume_checkpoint(campaign):
+    """Prepare a campaign for (re)sending and return the addresses already sent.
+
+    The logged outcomes are the checkpoint: recipients with a 'sent' row
+    are skipped, and earlier 'failed' rows are dropped so those recipients
+    get another attempt. The counters are reset to match what remains
+    logged. One query per call, served by the campaign/status/recipient
+    index.
+    """
+    sent = [
+        email_addr for (email_addr,) in db.session.query(EmailLog.recipient_email).filter_by(
+            campaign_id=campaign.id, status='sent'
+        )
+    ]
+    db.session.query(EmailLog).filter_by(campaign_id=campaign.id, status='failed').delete(
+        synchronize_session=False
+    )
+    campaign.sent_emails = len(sent)
+    campaign.failed_emails = 0
+    db.session.commit()
+    return set(sent)
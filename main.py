@@ -1,5 +1,8 @@
 from app import app
 import routes  # noqa: F401
+from worker import start_embedded_workers
+
+start_embedded_workers(app.config['EMBEDDED_WORKERS'])
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
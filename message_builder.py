@@ -0,0 +1,100 @@
+import random
+import re
+import sys
+from email.base64mime import body_encode
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.policy import compat32
+
+NL = '\r\n'
+NLCRE = re.compile(r'\r\n|\r|\n')
+FROM_LINE_RE = re.compile(r'^From ', re.MULTILINE)
+SIMPLE_ADDRESS_RE = re.compile(r'^[!-~]+$')
+
+# What smtplib.send_message flattens with: compat32 headers, CRLF line ends
+POLICY = compat32.clone(linesep=NL)
+
+def make_boundary():
+    """A boundary in the format email.generator picks for multipart messages"""
+    token = random.randrange(sys.maxsize)
+    width = len(repr(sys.maxsize - 1))
+    return '=' * 15 + ('%0*d' % (width, token)) + '=='
+
+def build_mime_message(sender, to_addr, subject, body):
+    """The per-recipient message the send paths build with the email package"""
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = to_addr
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+def _fold(name, value):
+    return POLICY.fold_binary(name, value)
+
+class MessageSkeleton:
+    """Pre-encoded multipart/mixed + text/plain message for one campaign.
+
+    The top-level headers, subject, boundary and both possible body part
+    headers (us-ascii/7bit and utf-8/base64) are encoded once. ``build``
+    only encodes the ``To`` header and the body for each recipient and
+    splices them in, producing the same bytes ``smtplib.send_message``
+    would send for ``build_mime_message(...)`` with this boundary.
+    """
+
+    def __init__(self, sender, subject, boundary=None):
+        self.sender = sender
+        self.subject = subject
+        self.boundary = boundary or make_boundary()
+
+        skeleton = MIMEMultipart(boundary=self.boundary)
+        skeleton['From'] = sender
+        skeleton['To'] = ''
+        skeleton['Subject'] = subject
+        headers = [(name, _fold(name, value)) for name, value in skeleton.raw_items()]
+        to_index = [name for name, _ in headers].index('To')
+        self._head = b''.join(folded for _, folded in headers[:to_index])
+        self._after_to = (
+            b''.join(folded for _, folded in headers[to_index + 1:])
+            + f'{NL}--{self.boundary}{NL}'.encode('ascii')
+        )
+        self._part_headers = {
+            charset: b''.join(_fold(name, value) for name, value in MIMEText('', 'plain', charset).raw_items())
+            + NL.encode('ascii')
+            for charset in ('us-ascii', 'utf-8')
+        }
+        self._tail = f'{NL}--{self.boundary}--{NL}'.encode('ascii')
+
+    def _to_header(self, to_addr):
+        if len(to_addr) <= 74 and SIMPLE_ADDRESS_RE.match(to_addr):
+            return b'To: ' + to_addr.encode('ascii') + b'\r\n'
+        return _fold('To', to_addr)
+
+    @staticmethod
+    def _write_lines(text):
+        lines = NLCRE.split(text)
+        out = NL.join(lines[:-1])
+        if len(lines) > 1:
+            out += NL
+        return out + lines[-1]
+
+    def _encode_body(self, body):
+        try:
+            body.encode('us-ascii')
+        except UnicodeEncodeError:
+            return self._part_headers['utf-8'], self._write_lines(body_encode(body.encode('utf-8'))).encode('ascii')
+        return self._part_headers['us-ascii'], self._write_lines(FROM_LINE_RE.sub('>From ', body)).encode('ascii')
+
+    def build(self, to_addr, body):
+        """Wire bytes for one recipient.
+
+        Falls back to a ``MIMEMultipart`` (for ``send_message``) when the
+        address needs SMTPUTF8 or the body happens to contain the boundary.
+        """
+        if not to_addr.isascii() or self.boundary in body:
+            return build_mime_message(self.sender, to_addr, self.subject, body)
+        part_headers, encoded_body = self._encode_body(body)
+        return b''.join((
+            self._head, self._to_header(to_addr), self._after_to,
+            part_headers, encoded_body, self._tail,
+        ))
@@ -31,7 +31,7 @@ class OAuth(OAuthConsumerMixin, db.Model):
 class EmailCampaign(db.Model):
     __tablename__ = 'email_campaigns'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.String, db.ForeignKey(User.id), nullable=False)
+    user_id = db.Column(db.String, db.ForeignKey(User.id), nullable=True)
     subject = db.Column(db.String, nullable=False)
     template_filename = db.Column(db.String, nullable=False)
     csv_filename = db.Column(db.String, nullable=False)
@@ -39,10 +39,31 @@ class EmailCampaign(db.Model):
     total_emails = db.Column(db.Integer, default=0)
     sent_emails = db.Column(db.Integer, default=0)
     failed_emails = db.Column(db.Integer, default=0)
-    status = db.Column(db.String, default='draft')  # draft, sending, completed, failed
+    status = db.Column(db.String, default='draft', index=True)  # draft, queued, sending, completed, failed
     created_at = db.Column(db.DateTime, default=datetime.now)
     completed_at = db.Column(db.DateTime, nullable=True)
     
+    # Draft state from /process_campaign, kept server-side instead of in the session
+    sample_data = db.Column(db.JSON, nullable=True)  # First valid row, for previews and test sends
+    validation_counts = db.Column(db.JSON, nullable=True)  # Rows removed as invalid, duplicate, suppressed
+    
+    # Job payload for the background workers
+    template = db.Column(db.Text, nullable=True)
+    placeholders = db.Column(db.JSON, nullable=True)
+    csv_path = db.Column(db.String, nullable=True)
+    recipients_key = db.Column(db.String, nullable=True)  # Content hash of the cached recipient set
+    smtp_server = db.Column(db.String, nullable=True)
+    smtp_port = db.Column(db.Integer, nullable=True)
+    sender_email = db.Column(db.String, nullable=True, index=True)
+    sender_password = db.Column(db.String, nullable=True)  # Encrypted, cleared once the job finishes
+    worker_id = db.Column(db.String, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # Refreshed by the worker while it sends
+    error_message = db.Column(db.Text, nullable=True)
+    timing_summary = db.Column(db.JSON, nullable=True)  # Per-phase timings of the last send, see metrics.py
+    sender_usage = db.Column(db.JSON, nullable=True)  # Sent and failed per sender account, see sender_pool.py
+    transport = db.Column(db.String, nullable=True)  # maildir, mbox or null for a dry run (see transports.py); None sends over SMTP
+    
     user = db.relationship(User, backref='campaigns')
 
 class EmailLog(db.Model):
@@ -52,6 +73,60 @@ class EmailLog(db.Model):
     recipient_email = db.Column(db.String, nullable=False)
     status = db.Column(db.String, nullable=False)  # sent, failed
     error_message = db.Column(db.Text, nullable=True)
+    smtp_code = db.Column(db.Integer, nullable=True)  # Reply code of a failure, if the server gave one
+    smtp_status = db.Column(db.String(16), nullable=True)  # Its enhanced status code, e.g. 5.1.1
+    smtp_phase = db.Column(db.String(8), nullable=True)  # rcpt (this recipient refused), mail or data
     sent_at = db.Column(db.DateTime, default=datetime.now)
     
     campaign = db.relationship(EmailCampaign, backref='email_logs')
+    
+    __table_args__ = (
+        # Serves the resume lookup of a campaign's sent recipients from the index alone
+        db.Index('ix_email_logs_campaign_status_recipient', 'campaign_id', 'status', 'recipient_email'),
+        # Report summaries and keyset pages, unfiltered and by status
+        db.Index('ix_email_logs_campaign_id', 'campaign_id', 'id'),
+        db.Index('ix_email_logs_campaign_status_id', 'campaign_id', 'status', 'id'),
+    )
+
+class SuppressedAddress(db.Model):
+    __tablename__ = 'suppressed_addresses'
+    id = db.Column(db.Integer, primary_key=True)
+    email_hash = db.Column(db.BigInteger, nullable=False, unique=True)  # 64-bit hash of the normalized address
+    email = db.Column(db.String, nullable=False)
+    reason = db.Column(db.String, nullable=False)  # bounce, manual, unsubscribe, complaint
+    detail = db.Column(db.Text, nullable=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey(EmailCampaign.id), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+class SenderAccount(db.Model):
+    """An extra account or relay a user's campaigns rotate through"""
+    __tablename__ = 'sender_accounts'
+    id = db.Column(db.Integer, primary_key=True)
+    owner_email = db.Column(db.String, nullable=False, index=True)  # The campaign sender it belongs to
+    email = db.Column(db.String, nullable=False)
+    password = db.Column(db.String, nullable=False)  # Encrypted, see sender_accounts.encrypt_password
+    smtp_server = db.Column(db.String, nullable=False)
+    smtp_port = db.Column(db.Integer, nullable=False)
+    daily_quota = db.Column(db.Integer, nullable=True)  # Recipients per day, None for no limit
+    rate_per_minute = db.Column(db.Float, nullable=True)  # None for the default SMTP_RATE_PER_MINUTE
+    pool_size = db.Column(db.Integer, nullable=True)  # None for the default SMTP_POOL_SIZE
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    disabled_reason = db.Column(db.Text, nullable=True)  # Set when a send disabled it, e.g. failed login
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        UniqueConstraint('owner_email', 'email', 'smtp_server', name='uq_sender_account'),
+    )
+
+class SenderUsage(db.Model):
+    """Recipients each sender address sent to per day, for daily quotas"""
+    __tablename__ = 'sender_usage'
+    id = db.Column(db.Integer, primary_key=True)
+    sender_email = db.Column(db.String, nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        UniqueConstraint('sender_email', 'day', name='uq_sender_usage_day'),
+    )
@@ -0,0 +1,156 @@
+"""In-process campaign progress bus and the Server-Sent Events stream over it.
+
+Campaign senders ``publish`` each counter change; every open progress
+stream for that campaign wakes up and pushes the new counts. Viewers of a
+campaign whose worker runs in another process get no publishes, so their
+streams fall back to re-reading the campaign row, at most once per
+``poll_interval`` for all viewers of that campaign together.
+
+Event IDs carry the counts the client last saw (``status:sent:failed:total``),
+so a reconnecting ``EventSource`` (which sends ``Last-Event-ID``) only gets
+an event if something changed, with deltas against what it already has,
+even when it reconnects to a different process.
+"""
+import json
+import threading
+import time
+
+FINAL_STATUSES = ('completed', 'failed')
+FINISHED_CHANNEL_TTL = 60  # Seconds a finished campaign's state stays for late viewers
+
+def campaign_state(campaign):
+    """The progress fields of an EmailCampaign"""
+    return {
+        'status': campaign.status,
+        'total_emails': campaign.total_emails or 0,
+        'sent_emails': campaign.sent_emails or 0,
+        'failed_emails': campaign.failed_emails or 0,
+    }
+
+class _Channel:
+    def __init__(self, lock):
+        self.seq = 0
+        self.state = None
+        self.updated = 0.0
+        self.listeners = 0
+        self.changed = threading.Condition(lock)
+
+class ProgressBus:
+    """Latest progress per campaign, with waiters woken on every change"""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._seq = 0  # Shared by all channels, so a recreated channel never repeats one
+
+    def _channel(self, campaign_id):
+        channel = self._channels.get(campaign_id)
+        if channel is None:
+            channel = self._channels[campaign_id] = _Channel(self._lock)
+        return channel
+
+    def _sweep(self):
+        """Drop finished campaigns nobody has watched for a while"""
+        cutoff = self._clock() - FINISHED_CHANNEL_TTL
+        for campaign_id, channel in list(self._channels.items()):
+            if (channel.listeners == 0 and channel.updated < cutoff
+                    and channel.state and channel.state['status'] in FINAL_STATUSES):
+                del self._channels[campaign_id]
+
+    def publish(self, campaign_id, state):
+        with self._lock:
+            channel = self._channel(campaign_id)
+            channel.updated = self._clock()
+            if state != channel.state:
+                channel.state = dict(state)
+                self._seq += 1
+                channel.seq = self._seq
+                channel.changed.notify_all()
+                if state['status'] in FINAL_STATUSES:
+                    self._sweep()
+
+    def refresh(self, campaign_id, loader, max_age):
+        """The latest state, publishing ``loader()`` first if nothing was published for ``max_age`` seconds"""
+        with self._lock:
+            channel = self._channels.get(campaign_id)
+            if channel is not None and channel.state is not None and self._clock() - channel.updated < max_age:
+                return channel.state
+        state = loader()
+        self.publish(campaign_id, state)
+        return state
+
+    def wait(self, campaign_id, after_seq, timeout):
+        """Block until the campaign changes past ``after_seq``; returns ``(seq, state)``"""
+        with self._lock:
+            channel = self._channel(campaign_id)
+            channel.listeners += 1
+            try:
+                channel.changed.wait_for(lambda: channel.seq > after_seq, timeout)
+                return channel.seq, channel.state
+            finally:
+                channel.listeners -= 1
+
+bus = ProgressBus()
+
+def format_event_id(state):
+    return f"{state['status']}:{state['sent_emails']}:{state['failed_emails']}:{state['total_emails']}"
+
+def parse_event_id(event_id):
+    try:
+        status, sent, failed, total = event_id.split(':')
+        return {'status': status, 'total_emails': int(total), 'sent_emails': int(sent), 'failed_emails': int(failed)}
+    except (AttributeError, ValueError):
+        return None
+
+def format_event(state, seen):
+    total = state['total_emails']
+    done = state['sent_emails'] + state['failed_emails']
+    data = dict(
+        state,
+        progress=(done / total * 100) if total > 0 else 0,
+        sent_delta=state['sent_emails'] - (seen['sent_emails'] if seen else 0),
+        failed_delta=state['failed_emails'] - (seen['failed_emails'] if seen else 0),
+    )
+    return f"id: {format_event_id(state)}\nevent: progress\ndata: {json.dumps(data)}\n\n"
+
+def progress_events(campaign_id, loader, last_event_id=None, poll_interval=2.0,
+                    min_interval=0.25, timeout=20.0, progress_bus=None):
+    """Yield SSE messages for one campaign until it finishes or ``timeout`` passes.
+
+    ``loader()`` reads the campaign's state from the database; it is only
+    called when no sender in this process has published recently. Bursts of
+    changes are coalesced to at most one event per ``min_interval``.
+    A stream ties up a server thread while it is open, so ``timeout`` is
+    kept short; EventSource reconnects with the last event id and carries
+    on where it left off. With ``timeout=0`` the stream sends the current
+    state and ends, which turns the EventSource into polling.
+    """
+    progress_bus = progress_bus or bus
+    seen = parse_event_id(last_event_id)
+    deadline = time.monotonic() + timeout
+    seq = -1
+
+    yield f"retry: {int(poll_interval * 1000)}\n\n"
+    state = progress_bus.refresh(campaign_id, loader, poll_interval)
+    while True:
+        changed = state != seen
+        if changed:
+            yield format_event(state, seen)
+            seen = state
+        else:
+            yield ": keepalive\n\n"
+        if state['status'] in FINAL_STATUSES:
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if changed:
+            time.sleep(min(min_interval, remaining))
+            remaining = deadline - time.monotonic()
+        new_seq, state = progress_bus.wait(campaign_id, seq, min(poll_interval, remaining))
+        if new_seq == seq or state is None:
+            # Nothing published here; the sender may be in another process
+            state = progress_bus.refresh(campaign_id, loader, poll_interval)
+        else:
+            seq = new_seq
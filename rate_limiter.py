@@ -0,0 +1,220 @@
+import os
+import re
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from dispatch import LATENCY_TARGETS, LaneQueue, current_lane
+from metrics import observe_queue_wait, timed
+
+DEFAULT_PER_SECOND = 5.0
+DEFAULT_PER_MINUTE = 120
+
+# Replies Office 365 and most relays use to ask the client to slow down
+THROTTLE_CODES = {421, 450, 451, 452}
+# A 421 with an RFC 3463 network status (4.4.x) closes the connection without asking for less traffic
+NETWORK_STATUS_RE = re.compile(r"\s*4\.4\.\d{1,3}\b")
+
+def reply_code(exc):
+    """Best-effort SMTP reply code behind a send error, or None if there is none"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        throttled = [code for code in codes if code in THROTTLE_CODES]
+        return (throttled or codes or [None])[0]
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code
+    return None
+
+def is_connection_drop(exc):
+    """True for a 421 whose enhanced status says the connection was dropped, not throttled"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        replies = [resp for code, resp in exc.recipients.values() if code == 421]
+    elif isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code == 421:
+        replies = [exc.smtp_error]
+    else:
+        return False
+    return any(NETWORK_STATUS_RE.match(resp.decode('utf-8', 'replace') if isinstance(resp, bytes) else str(resp))
+               for resp in replies)
+
+class _Bucket:
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = now
+
+    def refill(self, now, factor):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate * factor)
+        self.updated = now
+
+    def wait_time(self, factor):
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / (self.rate * factor)
+
+class AdaptiveRateLimiter:
+    """Token-bucket limiter with a per-second and a per-minute budget.
+
+    Both buckets must have a token before a message may go out. Throttling
+    replies (421/450/451/452, but not a 421 4.4.x connection drop) halve the
+    effective rate and pause sending
+    with an exponential backoff; every successful send then recovers the
+    rate additively until the configured budget is reached again (AIMD).
+
+    Senders waiting for a slot are served in lane order (see dispatch.py)
+    rather than whichever thread wakes first.
+    """
+
+    def __init__(self, per_second=DEFAULT_PER_SECOND, per_minute=DEFAULT_PER_MINUTE,
+                 min_factor=0.05, recovery_step=0.02, base_backoff=2.0, max_backoff=120.0,
+                 clock=time.monotonic):
+        self.per_second = float(per_second)
+        self.per_minute = float(per_minute)
+        self.min_factor = min_factor
+        self.recovery_step = recovery_step
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._slot_changed = threading.Condition(self._lock)
+        self._queue = LaneQueue()
+
+        now = clock()
+        self._buckets = [
+            _Bucket(self.per_second, self.per_second, now),
+            _Bucket(self.per_minute / 60.0, self.per_minute, now),
+        ]
+        self.factor = 1.0
+        self._paused_until = 0.0
+        self._consecutive_throttles = 0
+        self.throttle_count = 0
+
+    @property
+    def current_rate(self):
+        """Effective messages per second after backoff"""
+        return min(bucket.rate for bucket in self._buckets) * self.factor
+
+    @property
+    def queued(self):
+        """Senders waiting for a slot"""
+        with self._lock:
+            return len(self._queue)
+
+    def acquire(self, lane=None, flow=None, weight=1.0):
+        """Block until one message may be sent; returns the seconds spent queued.
+
+        ``lane``, ``flow`` and ``weight`` default to the calling context's
+        (see dispatch.dispatching).
+        """
+        if lane is None:
+            lane, flow, weight = current_lane()
+        target = LATENCY_TARGETS.get(lane)
+        with self._lock:
+            waiter = self._queue.push(lane, flow, weight, self._clock())
+            try:
+                while True:
+                    now = self._clock()
+                    wait = self._paused_until - now
+                    if wait <= 0:
+                        for bucket in self._buckets:
+                            bucket.refill(now, self.factor)
+                        wait = max(bucket.wait_time(self.factor) for bucket in self._buckets)
+                        if self._queue.head() is waiter and (
+                            wait <= 0 or (target is not None and now - waiter.since + wait > target)
+                        ):
+                            # Past its latency target the lane borrows the slot; later sends repay it
+                            for bucket in self._buckets:
+                                bucket.tokens -= 1
+                            self._queue.grant(waiter)
+                            self._slot_changed.notify_all()
+                            return now - waiter.since
+                    # The head sleeps until the next slot; the rest until the head takes it
+                    self._slot_changed.wait(wait if wait > 0 else None)
+            except BaseException:
+                self._queue.cancel(waiter)
+                self._slot_changed.notify_all()
+                raise
+
+    def record_reply(self, code):
+        """Adjust the rate from the reply code of a finished send attempt"""
+        with self._lock:
+            if code in THROTTLE_CODES:
+                self.throttle_count += 1
+                self._consecutive_throttles += 1
+                self.factor = max(self.min_factor, self.factor / 2)
+                backoff = min(self.max_backoff, self.base_backoff * 2 ** (self._consecutive_throttles - 1))
+                self._paused_until = max(self._paused_until, self._clock() + backoff)
+            elif code is not None and 200 <= code < 300:
+                self._consecutive_throttles = 0
+                self.factor = min(1.0, self.factor + self.recovery_step)
+
+    def record_error(self, exc):
+        # A dropped connection is retried on a new one without backing off
+        self.record_reply(None if is_connection_drop(exc) else reply_code(exc))
+
+class UnpacedLimiter:
+    """Limiter for transports that are not paced (see transports.py): never waits"""
+    current_rate = float('inf')
+    queued = 0
+    throttle_count = 0
+
+    def acquire(self, lane=None, flow=None, weight=1.0):
+        return 0.0
+
+    def record_reply(self, code):
+        pass
+
+    def record_error(self, exc):
+        pass
+
+UNPACED = UnpacedLimiter()
+
+@contextmanager
+def rate_limited(limiter, lane=None):
+    """Wait for a send slot, then feed the outcome of the block back to the limiter.
+
+    The slot is queued for in ``lane``, or the calling context's lane.
+    """
+    if lane is None:
+        lane, flow, weight = current_lane()
+    else:
+        flow, weight = None, 1.0
+    with timed('rate_wait'):
+        observe_queue_wait(lane, limiter.acquire(lane, flow, weight))
+    try:
+        yield
+    except Exception as e:
+        limiter.record_error(e)
+        raise
+    else:
+        limiter.record_reply(250)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter_for(smtp_config):
+    """Process-wide limiter shared by every send path for one sender and relay.
+
+    Office 365 enforces its limits per mailbox, so tests, verification mails
+    and campaigns from the same account all draw from the same budget.
+    """
+    key = (smtp_config['server'], smtp_config['port'], smtp_config['email'].lower())
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveRateLimiter(
+                per_second=smtp_config.get('rate_per_second', DEFAULT_PER_SECOND),
+                per_minute=smtp_config.get('rate_per_minute', DEFAULT_PER_MINUTE),
+            )
+            _limiters[key] = limiter
+        return limiter
+
+def _forget_limiters():
+    # A forked child (a campaign shard) gets its own budget, set by its smtp_config
+    global _limiters, _limiters_lock
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_limiters)
@@ -0,0 +1,330 @@
+"""Parse-once cache of validated recipient lists.
+
+An uploaded CSV is parsed and validated once, in ``/process_campaign``, and
+the rows with a valid Email are stored, with duplicate addresses removed, as
+a sequence of pickled DataFrame chunks (pandas keeps each column as one
+contiguous block) plus a small ``meta.json`` and the sorted address hashes
+used to check the set against the suppression list. Rows with an invalid
+Email are kept aside for the invalid rows report.
+
+The upload is validated before the template is known, so which columns a
+campaign needs is not known either. Each part is stored with the blank
+mask of every column (email_service.blank_mask), and reading the entry for
+a campaign drops the rows blank in one of its placeholders; see
+``count_recipients`` and ``iter_invalid_rows`` for the counts and per-row
+reasons. The
+entry is keyed by the SHA-256 of the file's bytes, so re-uploading the same
+list reuses it. Preview, test sends and the campaign worker read from the
+entry instead of re-parsing the CSV, one chunk at a time.
+
+Entries remember which upload files they were built from and are evicted by
+``cleanup_uploads`` once none of those files remain.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from app import app
+from email_service import EMAIL_INVALID, missing_fields, missing_fields_mask
+from recipients import CHUNK_SIZE
+from suppression import RecipientFilter, email_hashes
+
+META_FILE = 'meta.json'
+
+def file_digest(path):
+    """SHA-256 hex digest of a file, read in 1 MB blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def entry_dir(key):
+    return os.path.join(app.config['RECIPIENT_CACHE_FOLDER'], key)
+
+def load_meta(key):
+    """Metadata for a cached recipient set, or None if it is not cached"""
+    try:
+        with open(os.path.join(entry_dir(key), META_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_meta(directory, meta):
+    tmp_path = os.path.join(directory, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(directory, META_FILE))
+
+def _cached(key, source):
+    """The metadata of an existing entry, recording ``source`` as one of its files"""
+    meta = load_meta(key)
+    if meta is not None and 'fields' not in meta:
+        # Built before deduplication or blank checks; rebuild it
+        evict(key)
+        meta = None
+    if meta is not None and source not in meta['sources']:
+        meta['sources'].append(source)
+        _write_meta(entry_dir(key), meta)
+    return meta
+
+class RecipientCacheBuilder:
+    """Validates CSV chunks as they are read and writes the valid rows to a new entry.
+
+    ``add`` each DataFrame chunk (read with ``dtype=str``), then ``finish``
+    with the content's key, or ``abort`` to throw the partial entry away.
+    """
+
+    def __init__(self, source):
+        os.makedirs(app.config['RECIPIENT_CACHE_FOLDER'], exist_ok=True)
+        self.build_dir = tempfile.mkdtemp(prefix='.build-', dir=app.config['RECIPIENT_CACHE_FOLDER'])
+        self.meta = {
+            'key': None,
+            'sources': [source],
+            'columns': [],
+            'fields': [],
+            'parts': 0,
+            'rejected_parts': 0,
+            'valid_count': 0,
+            'invalid_count': 0,
+            'duplicate_count': 0,
+            'sample_data': {},
+        }
+        self.dedupe = RecipientFilter()
+
+    def add(self, chunk):
+        if 'Email' not in chunk.columns:
+            raise ValueError('CSV must contain an "Email" column')
+        meta = self.meta
+        # Every column could be a placeholder; the template is not known yet
+        fields = [col for col in chunk.columns if col != 'Email']
+        failed = missing_fields_mask(chunk, fields)
+        valid = ~failed[EMAIL_INVALID].to_numpy()
+        meta['columns'] = list(chunk.columns)
+        meta['fields'] = fields
+        meta['invalid_count'] += int((~valid).sum())
+        if not valid.all():
+            chunk[~valid].reset_index(drop=True).to_pickle(
+                os.path.join(self.build_dir, f"rejected-{meta['rejected_parts']:05d}.pkl"), compression=None
+            )
+            meta['rejected_parts'] += 1
+
+        chunk_valid = chunk[valid]
+        hashes = pd.Series(email_hashes(chunk_valid['Email']), index=chunk_valid.index)
+        chunk_valid = self.dedupe.apply(chunk_valid, hashes.to_numpy())
+        meta['duplicate_count'] = self.dedupe.removed['duplicate']
+        if len(chunk_valid) == 0:
+            return
+        if meta['valid_count'] == 0:
+            sample = chunk_valid.iloc[0]
+            meta['sample_data'] = {col: (None if pd.isna(val) else val) for col, val in sample.items()}
+        meta['valid_count'] += len(chunk_valid)
+        chunk_valid.reset_index(drop=True).to_pickle(
+            os.path.join(self.build_dir, f"part-{meta['parts']:05d}.pkl"), compression=None
+        )
+        np.save(os.path.join(self.build_dir, f"blank-{meta['parts']:05d}.npy"),
+                failed.loc[chunk_valid.index, fields].to_numpy(dtype=bool))
+        np.save(os.path.join(self.build_dir, f"hashes-{meta['parts']:05d}.npy"), hashes[chunk_valid.index].to_numpy())
+        meta['parts'] += 1
+
+    def finish(self, key):
+        """Publish the entry under ``key`` and return its metadata"""
+        source = self.meta['sources'][0]
+        if load_meta(key) is not None:
+            # Already cached, e.g. the same list uploaded again
+            self.abort()
+            return _cached(key, source)
+        try:
+            self.meta['key'] = key
+            _write_meta(self.build_dir, self.meta)
+            os.rename(self.build_dir, entry_dir(key))
+        except OSError:
+            # Another request cached the same file first
+            self.abort()
+            return _cached(key, source)
+        return self.meta
+
+    def abort(self):
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+
+def cache_recipients(csv_path, chunksize=CHUNK_SIZE):
+    """Validate ``csv_path`` once and cache its valid rows, returning the metadata.
+
+    The returned dict has the cache ``key``, ``columns``, ``valid_count``
+    (rows with a valid Email, before placeholder checks), ``invalid_count``,
+    ``duplicate_count`` and the first valid row as ``sample_data``. Uploads
+    streamed through upload_ingest are cached as they arrive instead.
+    """
+    key = file_digest(csv_path)
+    meta = _cached(key, csv_path)
+    if meta is not None:
+        return meta
+
+    builder = RecipientCacheBuilder(csv_path)
+    try:
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=str):
+            builder.add(chunk)
+    except Exception:
+        builder.abort()
+        raise
+    return builder.finish(key)
+
+def _part_file(key, kind, part, ext='npy'):
+    return os.path.join(entry_dir(key), f"{kind}-{part:05d}.{ext}")
+
+def _iter_blanks(key, meta, placeholders):
+    """Per part, which rows are blank in each of ``placeholders`` the CSV has"""
+    columns = [meta['fields'].index(ph) for ph in placeholders if ph in meta['fields']]
+    for part in range(meta['parts']):
+        yield part, np.load(_part_file(key, 'blank', part))[:, columns]
+
+def _iter_parts(key, meta, placeholders):
+    """``(chunk, blank)`` per part: the rows and which are blank in one of ``placeholders``"""
+    for part, blank in _iter_blanks(key, meta, placeholders):
+        yield pd.read_pickle(_part_file(key, 'part', part, 'pkl'), compression=None), blank
+
+def count_recipients(key, placeholders, suppression):
+    """Counts for a cached set as a campaign with ``placeholders`` would send it.
+
+    Returns a dict with ``missing``, the rows skipped for a blank
+    placeholder, ``missing_fields``, those counts by placeholder (a row
+    blank in several counts under each), and ``suppressed``, the addresses
+    on the suppression list among the other rows.
+    """
+    meta = load_meta(key)
+    fields = [ph for ph in placeholders if ph in meta['fields']]
+    counts = {'missing': 0, 'missing_fields': dict.fromkeys(fields, 0), 'suppressed': 0}
+    for part, blank in _iter_blanks(key, meta, placeholders):
+        skipped = blank.any(axis=1)
+        counts['missing'] += int(skipped.sum())
+        for ph, count in zip(fields, blank.sum(axis=0)):
+            counts['missing_fields'][ph] += int(count)
+        if len(suppression):
+            hashes = np.load(_part_file(key, 'hashes', part))[~skipped]
+            counts['suppressed'] += int(suppression.contains(hashes).sum())
+    counts['missing_fields'] = {ph: count for ph, count in counts['missing_fields'].items() if count}
+    return counts
+
+def iter_cached_chunks(key, placeholders, recipient_filter=None):
+    """Yield the cached rows a campaign with ``placeholders`` sends to, chunk by chunk.
+
+    Rows blank in a placeholder are dropped, blank cells of the others
+    read as '', and ``recipient_filter`` is applied if given.
+    """
+    meta = load_meta(key)
+    if meta is None:
+        raise KeyError(f"Recipient set {key} is not cached")
+    for chunk, blank in _iter_parts(key, meta, placeholders):
+        if blank.any():
+            chunk = chunk[~blank.any(axis=1)]
+        chunk = chunk.fillna('')
+        for ph in placeholders:
+            if ph not in chunk.columns:
+                chunk[ph] = ''
+        if recipient_filter is not None:
+            chunk = recipient_filter.apply(chunk)
+        yield chunk
+
+def iter_cached_recipients(key, placeholders, recipient_filter=None):
+    """Stream the cached valid rows as row dicts, one chunk in memory at a time"""
+    for chunk in iter_cached_chunks(key, placeholders, recipient_filter):
+        yield from chunk.to_dict('records')
+
+def first_recipient(key, placeholders):
+    """The first row a campaign with ``placeholders`` sends to, or None"""
+    for chunk in iter_cached_chunks(key, placeholders):
+        if len(chunk):
+            return chunk.iloc[0].to_dict()
+    return None
+
+def iter_invalid_rows(key, placeholders):
+    """Yield the rows a campaign with ``placeholders`` skips, with a MissingFields column.
+
+    MissingFields names what each row failed, as in
+    email_service.validate_csv_data: 'Email (Invalid)' and/or the blank
+    placeholders. Duplicate rows are not included.
+    """
+    meta = load_meta(key)
+    if meta is None:
+        raise KeyError(f"Recipient set {key} is not cached")
+    for part in range(meta['rejected_parts']):
+        chunk = pd.read_pickle(_part_file(key, 'rejected', part, 'pkl'), compression=None)
+        chunk['MissingFields'] = missing_fields(missing_fields_mask(chunk, placeholders))
+        yield chunk
+    labels = [ph for ph in placeholders if ph in meta['fields']]
+    for chunk, blank in _iter_parts(key, meta, placeholders):
+        skipped = blank.any(axis=1)
+        if skipped.any():
+            chunk = chunk[skipped].copy()
+            chunk['MissingFields'] = missing_fields(pd.DataFrame(blank[skipped], columns=labels))
+            yield chunk
+
+def evict(key):
+    shutil.rmtree(entry_dir(key), ignore_errors=True)
+
+def remove_upload(path, key=None):
+    """Delete an upload and, if it was the last source of cache entry ``key``, the entry"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    meta = load_meta(key) if key else None
+    if meta is None:
+        return
+    sources = [source for source in meta['sources'] if source != path and os.path.exists(source)]
+    if not sources:
+        evict(key)
+    elif sources != meta['sources']:
+        meta['sources'] = sources
+        _write_meta(entry_dir(key), meta)
+
+def cleanup_uploads(max_age_seconds, keep_paths=()):
+    """Delete uploads older than ``max_age_seconds`` and evict stale cache entries.
+
+    Only ``INCOMING_FOLDER``, where every upload is saved, is swept; other
+    files under ``UPLOAD_FOLDER`` are left alone.
+    Files in ``keep_paths`` (e.g. those of queued or sending campaigns) are
+    kept. A cache entry is evicted once none of its source uploads remain.
+    Returns ``(files_removed, entries_evicted)``.
+    """
+    keep = {os.path.abspath(path) for path in keep_paths}
+    cutoff = time.time() - max_age_seconds
+
+    files_removed = 0
+    for path in glob.glob(os.path.join(app.config['INCOMING_FOLDER'], 'temp_*')):
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                files_removed += 1
+        except OSError:
+            pass
+
+    entries_evicted = 0
+    cache_folder = app.config['RECIPIENT_CACHE_FOLDER']
+    if os.path.isdir(cache_folder):
+        for key in os.listdir(cache_folder):
+            meta = load_meta(key)
+            if meta is None:
+                # Leftover from an interrupted build
+                if os.path.getmtime(os.path.join(cache_folder, key)) < cutoff:
+                    evict(key)
+                    entries_evicted += 1
+                continue
+            sources = [path for path in meta['sources'] if os.path.exists(path)]
+            if not sources:
+                evict(key)
+                entries_evicted += 1
+            elif sources != meta['sources']:
+                meta['sources'] = sources
+                _write_meta(entry_dir(key), meta)
+
+    return files_removed, entries_evicted
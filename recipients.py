@@ -0,0 +1,34 @@
+import pandas as pd
+
+from email_service import validate_csv_data
+
+CHUNK_SIZE = 5000
+
+def iter_recipient_chunks(csv_path, placeholders, chunksize=CHUNK_SIZE, recipient_filter=None):
+    """Read a recipient CSV in fixed-size chunks, keeping rows with a valid Email.
+
+    Rows blank in one of ``placeholders`` are dropped too, as
+    validate_csv_data splits them, and the other blank cells read as ''.
+    Values are read as strings so every chunk formats numbers the same way,
+    whatever the other chunks contain. A suppression.RecipientFilter, if
+    given, drops duplicate and suppressed rows.
+    """
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=str):
+        chunk, _ = validate_csv_data(chunk, placeholders)
+        chunk = chunk.drop(columns='MissingFields').fillna('')
+        for ph in placeholders:
+            if ph not in chunk.columns:
+                chunk[ph] = ''
+        if recipient_filter is not None:
+            chunk = recipient_filter.apply(chunk)
+        yield chunk
+
+def iter_recipients(csv_path, placeholders, chunksize=CHUNK_SIZE, recipient_filter=None):
+    """Stream valid recipients from a CSV as row dicts.
+
+    Only one chunk is held in memory at a time, so the first message can go
+    out as soon as the first chunk is parsed and memory stays flat however
+    long the list is.
+    """
+    for chunk in iter_recipient_chunks(csv_path, placeholders, chunksize, recipient_filter):
+        yield from chunk.to_dict('records')
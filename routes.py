@@ -1,14 +1,35 @@
+import csv
+import io
 import os
-import pandas as pd
 import smtplib
 import re
-import time
 from datetime import datetime
-from flask import render_template, request, redirect, url_for, flash, session, jsonify
+import time
+from flask import g, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from app import app
+from app import app, db
+from campaign_store import history_entry, store
+from email_service import generate_report, iter_log_rows
+import metrics
+from models import EmailCampaign, SenderAccount, SuppressedAddress
+from progress_bus import campaign_state, progress_events
+from recipient_cache import (cache_recipients, cleanup_uploads, count_recipients, first_recipient,
+                             iter_invalid_rows, remove_upload)
+from sender_accounts import (account_config, account_overview, encrypt_campaign_password, encrypt_password,
+                             password_encryption_configured)
+from dispatch import INTERACTIVE, TRANSACTIONAL
+from rate_limiter import limiter_for, rate_limited
+from smtp_pool import connection_cache
+from suppression import import_suppression_csv, suppression_index
+from template_engine import compile_template
+from upload_ingest import CSV_UPLOAD_EXTENSIONS, IngestingRequest, UploadIngest, upload_path
+from transports import MAILDIR, MBOX, cleanup_spools
+from worker import enqueue_campaign, enqueue_dry_run, spool_path
+
+# Recipient CSVs are parsed while they upload, see upload_ingest.py
+app.request_class = IngestingRequest
 
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
@@ -18,9 +39,87 @@ def is_valid_email(email):
     return re.match(pattern, str(email)) is not None
 
 def extract_placeholders(template):
-    all_phs = re.findall(r'<([^<>]+)>', template)
-    unique_phs = list(dict.fromkeys(all_phs))
-    return all_phs, unique_phs
+    compiled = compile_template(template)
+    return compiled.all_placeholders, compiled.placeholders
+
+def smtp_config_for(email, password):
+    return {
+        'server': app.config['SMTP_SERVER'],
+        'port': app.config['SMTP_PORT'],
+        'email': email,
+        'password': password,
+        'pool_size': app.config['SMTP_POOL_SIZE'],
+        'connection_concurrency': app.config['SMTP_CONNECTION_CONCURRENCY'],
+        'rate_per_second': app.config['SMTP_RATE_PER_SECOND'],
+        'rate_per_minute': app.config['SMTP_RATE_PER_MINUTE'],
+        'pipelining': app.config['SMTP_PIPELINING'],
+        'starttls': app.config['SMTP_STARTTLS'],
+    }
+
+def session_smtp_config():
+    return smtp_config_for(session['sender_email'], session['sender_password'])
+
+def cleanup_stale_uploads():
+    """Remove expired drafts, uploads and dry-run spools, keeping the files of campaigns still waiting to send"""
+    max_age = app.config['UPLOAD_RETENTION_HOURS'] * 3600
+    store.purge_drafts(max_age)
+    active_paths = [path for (path,) in db.session.query(EmailCampaign.csv_path)
+                    .filter(EmailCampaign.status.in_(('draft', 'queued', 'sending')))]
+    cleanup_uploads(max_age, keep_paths=active_paths)
+    active_spools = [spool_path(campaign) for campaign in EmailCampaign.query.filter(
+        EmailCampaign.transport.in_((MAILDIR, MBOX)), EmailCampaign.status.in_(('queued', 'sending'))
+    )]
+    cleanup_spools(app.config['SPOOL_FOLDER'], app.config['SPOOL_RETENTION_HOURS'] * 3600,
+                   keep_paths=active_spools)
+
+def discard_upload(csv_file, csv_path=None, recipients=None):
+    """Delete a rejected CSV upload and the recipient set cached from it"""
+    if csv_path is None and csv_file and isinstance(csv_file.stream, UploadIngest):
+        csv_path = csv_file.stream.path
+        try:
+            recipients = csv_file.stream.result()
+        except Exception:
+            recipients = None
+    if csv_path is not None:
+        remove_upload(csv_path, recipients['key'] if recipients else None)
+
+def can_hold_streams():
+    """True when an open progress stream leaves this server free for other requests.
+
+    Threaded servers (gunicorn's gthread workers, see gunicorn.conf.py, or
+    the development server) and gevent workers can; a sync worker cannot,
+    so progress streams there end after one event.
+    """
+    if request.environ.get('wsgi.multithread'):
+        return True
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+def current_campaign():
+    """The campaign this session last processed, from the server-side store"""
+    return store.get(session.get('campaign_id'), session.get('sender_email'))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.get('request_started')
+    if started is not None:
+        # Streamed responses are timed until their body starts
+        metrics.registry.histogram('http_request_seconds', endpoint=request.endpoint or 'unmatched').observe(
+            time.perf_counter() - started
+        )
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Phase timings and counters of this process, in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -43,11 +142,6 @@ def setup_email():
     
     # Verify email credentials by sending a test email
     try:
-        # Test the email credentials
-        server = smtplib.SMTP(app.config['SMTP_SERVER'], app.config['SMTP_PORT'])
-        server.starttls()
-        server.login(email, password)
-        
         # Send verification email
         msg = MIMEMultipart()
         msg['From'] = email
@@ -70,8 +164,11 @@ UpGrad Email Sender System
         """.strip()
         
         msg.attach(MIMEText(body, 'plain'))
-        server.send_message(msg)
-        server.quit()
+        
+        # Logging in tests the credentials; the warm connection is kept for later sends
+        smtp_config = smtp_config_for(email, password)
+        with rate_limited(limiter_for(smtp_config), TRANSACTIONAL):
+            connection_cache.run(smtp_config, lambda server: server.send_message(msg))
         
         # Store email credentials in session only after successful verification
         session['sender_email'] = email
@@ -101,12 +198,127 @@ def history():
     if 'email_configured' not in session:
         return redirect(url_for('index'))
     
-    # Get campaign history from session or create empty list
-    campaigns = session.get('campaign_history', [])
+    campaigns = store.history(session['sender_email'])
     return render_template('history.html', campaigns=campaigns)
 
+@app.route('/suppression', methods=['GET', 'POST'])
+def suppression():
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    if request.method == 'POST':
+        csv_file = request.files.get('csv_file')
+        if not csv_file or not allowed_file(csv_file.filename, ['csv']):
+            flash('Please upload a valid CSV file', 'error')
+            return redirect(url_for('suppression'))
+        
+        csv_path = os.path.join(app.config['INCOMING_FOLDER'], secure_filename(
+            f"temp_suppress_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{csv_file.filename}"
+        ))
+        csv_file.save(csv_path)
+        try:
+            added = import_suppression_csv(csv_path, reason=request.form.get('reason') or 'manual')
+            flash(f'Added {added} addresses to the suppression list', 'success')
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error importing suppression list: {str(e)}', 'error')
+        finally:
+            os.remove(csv_path)
+        return redirect(url_for('suppression'))
+    
+    counts = db.session.query(SuppressedAddress.reason, db.func.count(SuppressedAddress.id)).group_by(
+        SuppressedAddress.reason
+    ).all()
+    return render_template('suppression.html', counts=dict(counts), total=sum(n for _, n in counts))
+
+def owned_sender_account(account_id):
+    account = db.session.get(SenderAccount, account_id)
+    if account is None or account.owner_email != session['sender_email'].lower():
+        return None
+    return account
+
+@app.route('/senders', methods=['GET', 'POST'])
+def senders():
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    if request.method == 'POST':
+        if not password_encryption_configured():
+            flash('Set SENDER_SECRET_KEY on the server to register sender accounts', 'error')
+            return redirect(url_for('senders'))
+        email = request.form.get('email', '').strip()
+        password = request.form.get('password', '').strip()
+        smtp_server = request.form.get('smtp_server', '').strip() or app.config['SMTP_SERVER']
+        try:
+            smtp_port = int(request.form.get('smtp_port') or app.config['SMTP_PORT'])
+            daily_quota = int(request.form['daily_quota']) if request.form.get('daily_quota') else None
+            rate_per_minute = float(request.form['rate_per_minute']) if request.form.get('rate_per_minute') else None
+        except ValueError:
+            flash('Port, daily quota and rate must be numbers', 'error')
+            return redirect(url_for('senders'))
+        if not email or not password or not is_valid_email(email):
+            flash('Please provide a valid email and password', 'error')
+            return redirect(url_for('senders'))
+        
+        account = SenderAccount(
+            owner_email=session['sender_email'].lower(), email=email, password=encrypt_password(password),
+            smtp_server=smtp_server, smtp_port=smtp_port, daily_quota=daily_quota,
+            rate_per_minute=rate_per_minute,
+        )
+        try:
+            # Logging in tests the credentials; the warm connection is kept for the next campaign
+            connection_cache.run(account_config(session_smtp_config(), account, password),
+                                 lambda server: server.noop())
+        except smtplib.SMTPAuthenticationError:
+            flash(f'Invalid email or app password for {email}', 'error')
+            return redirect(url_for('senders'))
+        except Exception as e:
+            flash(f'Could not connect to {smtp_server}:{smtp_port} as {email}: {str(e)}', 'error')
+            return redirect(url_for('senders'))
+        
+        db.session.add(account)
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            flash(f'{email} on {smtp_server} is already registered', 'error')
+            return redirect(url_for('senders'))
+        flash(f'Added sender account {email}', 'success')
+        return redirect(url_for('senders'))
+    
+    return render_template('senders.html', accounts=account_overview(session['sender_email']))
+
+@app.route('/senders/<int:account_id>/toggle', methods=['POST'])
+def toggle_sender(account_id):
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    account = owned_sender_account(account_id)
+    if account is not None:
+        account.enabled = not account.enabled
+        account.disabled_reason = None
+        db.session.commit()
+    return redirect(url_for('senders'))
+
+@app.route('/senders/<int:account_id>/delete', methods=['POST'])
+def delete_sender(account_id):
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    account = owned_sender_account(account_id)
+    if account is not None:
+        db.session.delete(account)
+        db.session.commit()
+        flash(f'Removed sender account {account.email}', 'success')
+    return redirect(url_for('senders'))
+
 @app.route('/process_campaign', methods=['POST'])
 def process_campaign():
+    # Before request.form, which would read (and ingest) the upload
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    csv_file = csv_path = recipients = None
     try:
         # Get form data
         subject = request.form.get('subject', '').strip()
@@ -116,99 +328,148 @@ def process_campaign():
         template = request.form.get('template', '').strip()
         template_file = request.files.get('template_file')
         
+        csv_file = request.files.get('csv_file')
+        
+        template_filename = ''
         if template_file and allowed_file(template_file.filename, ['txt', 'html']):
             template = template_file.read().decode('utf-8')
+            template_filename = template_file.filename
         
         if not subject or not template:
+            discard_upload(csv_file)
             flash('Subject and template are required', 'error')
             return redirect(url_for('index'))
         
-        # Handle CSV file upload
-        csv_file = request.files.get('csv_file')
-        if not csv_file or not allowed_file(csv_file.filename, ['csv']):
-            flash('Please upload a valid CSV file', 'error')
+        # Handle CSV file upload (plain, gzip or zip)
+        if not csv_file or not allowed_file(csv_file.filename, CSV_UPLOAD_EXTENSIONS):
+            discard_upload(csv_file)
+            flash('Please upload a valid CSV file (.csv, .csv.gz or .zip)', 'error')
             return redirect(url_for('index'))
         
-        # Save CSV file
-        csv_filename = secure_filename(f"temp_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{csv_file.filename}")
-        csv_path = os.path.join(app.config['UPLOAD_FOLDER'], csv_filename)
-        csv_file.save(csv_path)
+        # Clear out uploads (and their cached recipient sets) from earlier sessions
+        cleanup_stale_uploads()
         
         # Process template and CSV
         all_placeholders, unique_placeholders = extract_placeholders(template)
         
         # Validate for bulk mode
         if mode == 'bulk' and len(unique_placeholders) > 0:
+            discard_upload(csv_file)
             flash('Template contains placeholders, but Bulk mode does not support them', 'error')
             return redirect(url_for('index'))
         
-        # Read and validate CSV
-        df = pd.read_csv(csv_path)
-        
-        if 'Email' not in df.columns:
-            flash('CSV must contain an "Email" column', 'error')
+        # The upload was validated and cached as it arrived; preview, test sends
+        # and the worker reuse the cached rows
+        try:
+            with metrics.timed('upload_validate'):
+                if isinstance(csv_file.stream, UploadIngest):
+                    csv_path = csv_file.stream.path
+                    recipients = csv_file.stream.result()
+                else:
+                    csv_path = upload_path(csv_file.filename)
+                    csv_file.save(csv_path)
+                    recipients = cache_recipients(csv_path)
+        except ValueError as e:
+            discard_upload(csv_file, csv_path)
+            flash(str(e), 'error')
             return redirect(url_for('index'))
-        
-        # Add missing placeholder columns
-        for ph in unique_placeholders:
-            if ph not in df.columns:
-                df[ph] = ''
-        
-        # Validate data
-        df['valid'] = df['Email'].apply(is_valid_email)
-        df_valid = df[df['valid'] == True]
-        df_invalid = df[df['valid'] == False]
-        
-        if len(df_valid) == 0:
+        if recipients['valid_count'] == 0:
+            discard_upload(csv_file, csv_path, recipients)
             flash('No valid email addresses found in CSV', 'error')
             return redirect(url_for('index'))
         
-        # Store in session for preview
-        session['campaign_data'] = {
-            'subject': subject,
-            'template': template,
-            'mode': mode,
-            'csv_path': csv_path,
-            'placeholders': unique_placeholders,
-            'valid_count': len(df_valid),
-            'invalid_count': len(df_invalid),
-            'sample_data': df_valid.iloc[0].to_dict() if len(df_valid) > 0 else {}
-        }
+        # Duplicates were dropped while caching; rows blank in one of this template's
+        # placeholders and suppressed addresses are counted for every campaign
+        counts = count_recipients(recipients['key'], unique_placeholders, suppression_index())
+        valid_count = recipients['valid_count'] - counts['missing'] - counts['suppressed']
+        if valid_count == 0:
+            discard_upload(csv_file, csv_path, recipients)
+            if counts['missing'] == recipients['valid_count']:
+                flash('No row has a value for every placeholder in the template', 'error')
+            else:
+                flash('Every valid address in the CSV is on the suppression list', 'error')
+            return redirect(url_for('index'))
+        
+        # The first row that will be sent, with missing placeholder columns as ''
+        sample_data = first_recipient(recipients['key'], unique_placeholders)
+        
+        # Keep the processed campaign server-side; the session only holds its ID
+        session.pop('campaign_data', None)
+        session['campaign_id'] = store.create_draft(
+            session['sender_email'],
+            subject=subject,
+            template=template,
+            template_filename=template_filename,
+            csv_filename=os.path.basename(csv_path),
+            mode=mode,
+            csv_path=csv_path,
+            recipients_key=recipients['key'],
+            placeholders=unique_placeholders,
+            total_emails=valid_count,
+            validation_counts={
+                'invalid': recipients['invalid_count'] + counts['missing'],
+                'missing_fields': counts['missing_fields'],
+                'duplicate': recipients['duplicate_count'],
+                'suppressed': counts['suppressed'],
+            },
+            sample_data=sample_data,
+        )
         
         return redirect(url_for('preview'))
         
     except Exception as e:
+        discard_upload(csv_file, csv_path, recipients)
         flash(f'Error processing files: {str(e)}', 'error')
         return redirect(url_for('index'))
 
 @app.route('/preview')
 def preview():
-    if 'campaign_data' not in session or 'email_configured' not in session:
+    if 'email_configured' not in session:
         return redirect(url_for('index'))
     
-    campaign_data = session['campaign_data']
+    campaign_data = current_campaign()
+    if campaign_data is None:
+        return redirect(url_for('index'))
     
     # Generate preview
-    preview_text = campaign_data['template']
-    if campaign_data['placeholders'] and campaign_data['sample_data']:
-        for ph in campaign_data['placeholders']:
-            value = campaign_data['sample_data'].get(ph, f'<{ph}>')
-            preview_text = preview_text.replace(f'<{ph}>', str(value))
+    preview_text = compile_template(campaign_data['template']).render(campaign_data['sample_data'])
     
     return render_template('preview.html', 
                          campaign_data=campaign_data,
                          preview_text=preview_text)
 
+@app.route('/preview/invalid_rows.csv')
+def export_invalid_rows():
+    """Stream the rows the current draft skips, each with the fields it is missing"""
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    campaign_data = current_campaign()
+    if campaign_data is None or not campaign_data['recipients_key']:
+        return redirect(url_for('index'))
+    
+    def generate():
+        header = True
+        for chunk in iter_invalid_rows(campaign_data['recipients_key'], campaign_data['placeholders']):
+            chunk['MissingFields'] = chunk['MissingFields'].str.join('; ')
+            yield chunk.to_csv(index=False, header=header)
+            header = False
+    
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename="invalid_rows.csv"'})
+
 @app.route('/send_test', methods=['POST'])
 def send_test():
     if 'email_configured' not in session:
         return jsonify({'success': False, 'message': 'Email not configured'})
     
     data = request.json or {}
+    campaign_data = current_campaign() or {}
     test_email = data.get('test_email', '').strip()
-    subject = data.get('subject', '').strip()
-    template = data.get('template', '').strip()
-    csv_data = data.get('csv_data', [])  # First row data for testing
+    # The preview page only sends the address; fall back to the processed campaign
+    subject = (data.get('subject') or campaign_data.get('subject', '')).strip()
+    template = (data.get('template') or campaign_data.get('template', '')).strip()
+    csv_data = data.get('csv_data') or campaign_data.get('sample_data', {})  # First row data for testing
     
     if not test_email or not is_valid_email(test_email):
         return jsonify({'success': False, 'message': 'Invalid test email address'})
@@ -218,28 +479,19 @@ def send_test():
     
     try:
         # Process template with first row data if available
-        test_body = template
-        if csv_data:
-            # Extract placeholders and replace with first row data
-            import re
-            placeholders = re.findall(r'<([^<>]+)>', template)
-            for placeholder in placeholders:
-                if placeholder in csv_data:
-                    test_body = test_body.replace(f'<{placeholder}>', str(csv_data[placeholder]))
-        
-        # Send test email
-        server = smtplib.SMTP(app.config['SMTP_SERVER'], app.config['SMTP_PORT'])
-        server.starttls()
-        server.login(session['sender_email'], session['sender_password'])
+        test_body = compile_template(template).render(csv_data or {})
         
+        # Send test email over the sender's warm connection
         msg = MIMEMultipart()
         msg['From'] = session['sender_email']
         msg['To'] = test_email
         msg['Subject'] = f"[TEST] {subject}"
         msg.attach(MIMEText(test_body, 'plain'))
         
-        server.send_message(msg)
-        server.quit()
+        # Queued ahead of any campaign running from the same account
+        smtp_config = session_smtp_config()
+        with rate_limited(limiter_for(smtp_config), INTERACTIVE):
+            connection_cache.run(smtp_config, lambda server: server.send_message(msg))
         
         return jsonify({'success': True, 'message': 'Test email sent successfully!'})
         
@@ -248,100 +500,136 @@ def send_test():
 
 @app.route('/send_campaign', methods=['POST'])
 def send_campaign():
-    if 'campaign_data' not in session or 'email_configured' not in session:
+    campaign_data = current_campaign() if 'email_configured' in session else None
+    if campaign_data is None:
         flash('Session expired', 'error')
         return redirect(url_for('index'))
     
     try:
-        campaign_data = session['campaign_data']
-        
-        # Read CSV data
-        df = pd.read_csv(campaign_data['csv_path'])
-        df['valid'] = df['Email'].apply(is_valid_email)
-        df_valid = df[df['valid'] == True]
-        
-        # Send emails
-        server = smtplib.SMTP(app.config['SMTP_SERVER'], app.config['SMTP_PORT'])
-        server.starttls()
-        server.login(session['sender_email'], session['sender_password'])
-        
-        sent_count = 0
-        failed_count = 0
-        
-        if campaign_data['mode'] == 'personalized':
-            # Send personalized emails
-            for _, row in df_valid.iterrows():
-                try:
-                    learner = row.to_dict()
-                    email_addr = str(learner.get('Email', ''))
-                    
-                    body = campaign_data['template']
-                    for ph in campaign_data['placeholders']:
-                        body = body.replace(f'<{ph}>', str(learner.get(ph, '')))
-                    
-                    msg = MIMEMultipart()
-                    msg['From'] = session['sender_email']
-                    msg['To'] = email_addr
-                    msg['Subject'] = campaign_data['subject']
-                    msg.attach(MIMEText(body, 'plain'))
-                    
-                    server.send_message(msg)
-                    sent_count += 1
-                    
-                except Exception as e:
-                    failed_count += 1
-                    print(f"Failed to send to {email_addr}: {e}")
-                
-                time.sleep(1)  # Rate limiting
-        
+        if request.form.get('dry_run') == '1':
+            # Rehearse the draft into the spool; it stays a draft to send for real
+            campaign = enqueue_dry_run(
+                campaign_data['id'],
+                app.config['DRY_RUN_TRANSPORT'],
+                smtp_server=app.config['SMTP_SERVER'],
+                smtp_port=app.config['SMTP_PORT'],
+            )
         else:
-            # Bulk BCC mode
-            try:
-                msg = MIMEMultipart()
-                msg['From'] = session['sender_email']
-                msg['To'] = session['sender_email']
-                msg['Subject'] = campaign_data['subject']
-                msg.attach(MIMEText(campaign_data['template'], 'plain'))
-                
-                bcc_list = df_valid['Email'].tolist()
-                server.sendmail(session['sender_email'], bcc_list, msg.as_string())
-                sent_count = len(bcc_list)
-                
-            except Exception as e:
-                failed_count = len(df_valid)
-                print(f"Bulk BCC failed: {e}")
-        
-        server.quit()
-        
-        # Save campaign to history
-        import datetime
-        campaign_result = {
-            'subject': campaign_data['subject'],
-            'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'total_recipients': len(df_valid),
-            'sent_successfully': sent_count,
-            'failed_to_send': failed_count,
-            'success_rate': (sent_count / len(df_valid) * 100) if len(df_valid) > 0 else 0
-        }
-        
-        # Add to session history
-        campaign_history = session.get('campaign_history', [])
-        campaign_history.insert(0, campaign_result)  # Add to beginning
-        session['campaign_history'] = campaign_history[:10]  # Keep last 10 campaigns
-        
-        # Store results for completion page
-        session['campaign_result'] = campaign_result
-        
-        return redirect(url_for('campaign_completed'))
+            # Queue the draft for the background workers
+            campaign = enqueue_campaign(
+                campaign_data['id'],
+                smtp_server=app.config['SMTP_SERVER'],
+                smtp_port=app.config['SMTP_PORT'],
+                sender_password=encrypt_campaign_password(session['sender_password']),
+            )
+        if campaign is None:
+            # Already queued, e.g. the form was submitted twice
+            return redirect(url_for('sending_progress', campaign_id=campaign_data['id']))
+        
+        return redirect(url_for('sending_progress', campaign_id=campaign.id))
         
     except Exception as e:
         flash(f'Error sending emails: {str(e)}', 'error')
         return redirect(url_for('preview'))
 
-@app.route('/campaign_completed')
-def campaign_completed():
-    if 'campaign_result' not in session:
+def get_sender_campaign(campaign_id):
+    """Campaign owned by the configured sender, or 404"""
+    return EmailCampaign.query.filter_by(id=campaign_id, sender_email=session.get('sender_email')).first_or_404()
+
+@app.route('/sending/<int:campaign_id>')
+def sending_progress(campaign_id):
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    campaign = get_sender_campaign(campaign_id)
+    return render_template('sending.html', campaign=campaign)
+
+@app.route('/campaign_status/<int:campaign_id>')
+def campaign_status(campaign_id):
+    if 'email_configured' not in session:
+        return jsonify({'success': False, 'message': 'Email not configured'}), 401
+    
+    campaign = get_sender_campaign(campaign_id)
+    state = campaign_state(campaign)
+    total = state['total_emails']
+    done = state['sent_emails'] + state['failed_emails']
+    
+    return jsonify(dict(state, progress=(done / total * 100) if total > 0 else 0))
+
+@app.route('/campaign_events/<int:campaign_id>')
+def campaign_events(campaign_id):
+    """Server-Sent Events stream of a campaign's progress"""
+    if 'email_configured' not in session:
+        return jsonify({'success': False, 'message': 'Email not configured'}), 401
+    
+    get_sender_campaign(campaign_id)
+    db.session.rollback()
+    
+    def load_state():
+        campaign = db.session.get(EmailCampaign, campaign_id, populate_existing=True)
+        state = campaign_state(campaign)
+        db.session.rollback()  # End the read so the next one sees new commits
+        return state
+    
+    events = progress_events(
+        campaign_id, load_state,
+        last_event_id=request.headers.get('Last-Event-ID'),
+        poll_interval=app.config['PROGRESS_POLL_INTERVAL'],
+        min_interval=app.config['PROGRESS_MIN_INTERVAL'],
+        timeout=app.config['PROGRESS_STREAM_TIMEOUT'] if can_hold_streams() else 0,
+    )
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/report/<int:campaign_id>')
+def view_report(campaign_id):
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    get_sender_campaign(campaign_id)
+    report = generate_report(
+        campaign_id,
+        status=request.args.get('status'),
+        after_id=request.args.get('after', type=int),
+        before_id=request.args.get('before', type=int),
+    )
+    return render_template('report.html', **report)
+
+@app.route('/report/<int:campaign_id>/export.csv')
+def export_report(campaign_id):
+    """Stream the campaign's logs as CSV, one keyset batch in memory at a time"""
+    if 'email_configured' not in session:
+        return redirect(url_for('index'))
+    
+    campaign = get_sender_campaign(campaign_id)
+    status = request.args.get('status')
+    filename = f"campaign_report_{campaign.id}_{campaign.created_at.strftime('%Y%m%d')}.csv"
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['Email Address', 'Status', 'Timestamp', 'Error Message'])
+        for count, (email_addr, log_status, sent_at, error_message) in enumerate(
+                iter_log_rows(campaign_id, status), 1):
+            writer.writerow([
+                email_addr, log_status,
+                sent_at.strftime('%Y-%m-%d %H:%M:%S') if sent_at else '',
+                error_message or '',
+            ])
+            if count % 1000 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/campaign_completed/<int:campaign_id>')
+def campaign_completed(campaign_id):
+    if 'email_configured' not in session:
         return redirect(url_for('index'))
     
-    result = session['campaign_result']
-    return render_template('campaign_completed.html', result=result)
\ No newline at end of file
+    campaign = get_sender_campaign(campaign_id)
+    session.pop('campaign_history', None)  # History now comes from the campaign store
+    return render_template('campaign_completed.html', result=history_entry(campaign))
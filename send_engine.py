@@ -0,0 +1,299 @@
+import contextvars
+import re
+import smtplib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+
+from metrics import timed
+from rate_limiter import THROTTLE_CODES, rate_limited, reply_code
+from sender_pool import SenderRotation, is_failover_error
+from smtp_pool import is_connection_error
+
+DEFAULT_CONNECTION_CONCURRENCY = 2
+TRANSIENT_RETRIES = 3  # Tries per message after a throttle, 4xx or dropped connection
+DEFAULT_BCC_CHUNK_SIZE = 500  # Office 365 accepts about 500 recipients per message
+DEFAULT_BCC_CHUNK_RETRIES = 2
+
+ENHANCED_STATUS_RE = re.compile(r"\s*([245]\.\d{1,3}\.\d{1,3})\b")  # RFC 3463, at the start of the reply text
+
+def is_transient_error(exc):
+    """True for failures worth retrying: dropped connections and 4xx replies"""
+    code = reply_code(exc)
+    return is_connection_error(exc) or (code is not None and 400 <= code < 500)
+
+def _reply_text(resp):
+    return resp.decode('utf-8', 'replace') if isinstance(resp, bytes) else str(resp)
+
+def format_refusal(refusal):
+    code, resp = refusal
+    return f"{code} {_reply_text(resp)}"
+
+class SendFailure(Exception):
+    """Why one recipient was not sent to, with the SMTP reply behind it if any.
+
+    ``code`` is the reply code, ``status`` its enhanced status code
+    ('5.1.1') when the server gave one, and ``phase`` the command it
+    answered: 'rcpt' when this recipient was refused, 'mail' or 'data'
+    when the whole message was. Picklable whatever the original error was,
+    so shards can report it.
+    """
+
+    def __init__(self, message, code=None, status=None, phase=None):
+        super().__init__(message, code, status, phase)
+        self.message = message
+        self.code = code
+        self.status = status
+        self.phase = phase
+
+    def __str__(self):
+        return self.message
+
+    @classmethod
+    def refusal(cls, refusal):
+        """A recipient's own refusal, ``(code, resp)`` as in SMTPRecipientsRefused"""
+        code, resp = refusal
+        return cls(format_refusal(refusal), code, _enhanced_status(resp), 'rcpt')
+
+    @classmethod
+    def from_error(cls, error):
+        """The SendFailure for ``error``, as raised by a send to one recipient"""
+        if isinstance(error, cls):
+            return error
+        if isinstance(error, smtplib.SMTPRecipientsRefused) and len(error.recipients) == 1:
+            (code, resp), = error.recipients.values()
+            return cls(str(error), code, _enhanced_status(resp), 'rcpt')
+        if isinstance(error, smtplib.SMTPResponseException):
+            if isinstance(error, smtplib.SMTPSenderRefused):
+                phase = 'mail'
+            elif isinstance(error, smtplib.SMTPDataError):
+                phase = 'data'
+            else:
+                phase = None
+            return cls(str(error), error.smtp_code, _enhanced_status(error.smtp_error), phase)
+        return cls(str(error))
+
+def _enhanced_status(resp):
+    match = ENHANCED_STATUS_RE.match(_reply_text(resp))
+    return match.group(1) if match else None
+
+def run_windowed(items, task, workers, on_done):
+    """Run ``task`` over ``items`` on a thread pool, keeping a bounded window in flight.
+
+    ``on_done`` receives each task's result on the calling thread. Items
+    are pulled lazily, so a streamed input is never fully materialised.
+    Each task runs in a copy of the caller's context, so context variables
+    such as the campaign's metrics.campaign_timings carry over. If a task
+    raises, no further items are started; the tasks in flight finish and
+    are reported before the first error is re-raised.
+    """
+    error = None
+
+    def report(done):
+        nonlocal error
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = error or e
+            else:
+                on_done(result)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(contextvars.copy_context().run, task, item))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                report(done)
+                if error is not None:
+                    break
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            report(done)
+    if error is not None:
+        raise error
+
+def send_personalized(rows, build_message, smtp_config, on_result, senders=None):
+    """Send one message per row across a pool of SMTP connections.
+
+    ``build_message(row, sender)`` returns ``(email_addr, msg)`` for the
+    sending account's address and runs on a worker thread; ``msg`` is
+    either an email Message or wire bytes from a
+    message_builder.MessageSkeleton. ``on_result(email_addr, error)`` runs
+    on the calling thread once per row, with ``error`` set to None on
+    success, so callers can keep recording outcomes through their own
+    database session.
+
+    Messages are spread over ``senders``, a sender_pool.SenderRotation
+    (by default one built from ``smtp_config``). Each account's
+    ``pool_size`` bounds its open connections and
+    ``smtp_config['connection_concurrency']`` sets how many workers share
+    each connection, so rendering overlaps with in-flight SMTP exchanges.
+    Sends are paced by the account's shared rate limiter. A message the
+    relay throttles is retried after the limiter backs off, and one that
+    fails with another 4xx or a dropped connection is retried on a fresh
+    connection, up to TRANSIENT_RETRIES times. A message
+    whose account fails to log in or is over quota moves to another
+    account; sender_pool.NoSenderAvailable is raised when none is left.
+    With ``smtp_config['transport']`` set for a dry run, the same sends go
+    to a local spool or nowhere, unpaced (see transports.py).
+    Returns ``(sent_count, failed_count)``.
+    """
+    senders = senders or SenderRotation.from_config(smtp_config)
+    concurrency = int(smtp_config.get('connection_concurrency', DEFAULT_CONNECTION_CONCURRENCY))
+    workers = max(1, senders.size * max(1, concurrency))
+
+    def deliver(row):
+        email_addr = str(row.get('Email', ''))
+        failed_over = set()
+        retries = 0
+        while True:
+            lane = senders.acquire(exclude=failed_over)
+            try:
+                email_addr, msg = build_message(row, lane.email)
+            except Exception as e:
+                senders.release(lane, unused=1)
+                return email_addr, e
+
+            try:
+                with rate_limited(lane.limiter), lane.pool.connection() as server, timed('smtp_send'):
+                    if isinstance(msg, bytes):
+                        server.sendmail(lane.email, [email_addr], msg)
+                    else:
+                        server.send_message(msg)
+            except Exception as e:
+                if is_failover_error(e):
+                    senders.release(lane, unused=1)
+                    senders.disable(lane, e)
+                    failed_over.add(lane)
+                    continue
+                if not is_transient_error(e) or retries == TRANSIENT_RETRIES:
+                    senders.release(lane, failed=1)
+                    return email_addr, e
+                # The pool has discarded a dead connection, so the retry opens a new one
+                senders.release(lane, unused=1)
+                retries += 1
+                continue
+            senders.release(lane, sent=1)
+            return email_addr, None
+
+    sent_count = 0
+    failed_count = 0
+
+    def collect(result):
+        nonlocal sent_count, failed_count
+        email_addr, error = result
+        if error is None:
+            sent_count += 1
+        else:
+            failed_count += 1
+        on_result(email_addr, error)
+
+    try:
+        senders.warm()
+        run_windowed(rows, deliver, workers, collect)
+    finally:
+        senders.close()
+
+    return sent_count, failed_count
+
+def send_bcc(email_addrs, build_message, smtp_config, on_result, senders=None):
+    """Send one message to many recipients, in parallel BCC chunks.
+
+    ``build_message(sender)`` returns the message (wire bytes or a string)
+    as sent from that account. Recipients are split into chunks of
+    ``smtp_config['bcc_chunk_size']`` (relays cap recipients per message)
+    and the chunks are spread over ``senders`` as in send_personalized,
+    counting a chunk's recipients against its account's daily budget.
+    Recipients the server refuses for good (5xx) are reported individually
+    with their reply. Those refused with a 4xx reply (throttling, too many
+    recipients) are sent again in a smaller chunk, and a chunk that fails
+    as a whole with a transient error is sent again; either is retried up
+    to ``smtp_config['bcc_chunk_retries']`` times, without resending the
+    recipients that went through. Throttling refusals slow the account's
+    limiter down even when the rest of the chunk was accepted.
+    ``on_result`` is called once per recipient on the calling thread.
+    Returns ``(sent_count, failed_count)``.
+    """
+    chunk_size = max(1, int(smtp_config.get('bcc_chunk_size', DEFAULT_BCC_CHUNK_SIZE)))
+    retries = int(smtp_config.get('bcc_chunk_retries', DEFAULT_BCC_CHUNK_RETRIES))
+    senders = senders or SenderRotation.from_config(smtp_config)
+
+    def chunks():
+        addrs = iter(email_addrs)
+        while True:
+            chunk = list(islice(addrs, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def deliver(chunk):
+        # Returns the chunk and its failures, {email_addr: error or SendFailure}
+        failures = {}
+        pending = chunk
+        failed_over = set()
+        attempt = 0
+        while True:
+            lane = senders.acquire(len(pending), exclude=failed_over)
+            try:
+                msg = build_message(lane.email)
+                with rate_limited(lane.limiter), lane.pool.connection() as server, timed('smtp_send'):
+                    refused = server.sendmail(lane.email, pending, msg)
+            except Exception as e:
+                if is_failover_error(e):
+                    senders.release(lane, unused=len(pending))
+                    senders.disable(lane, e)
+                    failed_over.add(lane)
+                    continue
+                if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                    if attempt < retries and is_transient_error(e):
+                        senders.release(lane, unused=len(pending))
+                        attempt += 1
+                        continue
+                    senders.release(lane, failed=len(pending))
+                    failures.update((email_addr, e) for email_addr in pending)
+                    return chunk, failures
+                # Every recipient refused; the limiter has seen the reply
+                refused = e.recipients
+            else:
+                throttled = [code for code, _ in refused.values() if code in THROTTLE_CODES]
+                if throttled:
+                    # The chunk went through, but the relay asked to slow down
+                    lane.limiter.record_reply(throttled[0])
+
+            # 4xx refusals (throttling, too many recipients) go out again in a smaller chunk
+            retry = [email_addr for email_addr in pending
+                     if email_addr in refused and 400 <= refused[email_addr][0] < 500]
+            if attempt >= retries:
+                retry = []
+            for email_addr, refusal in refused.items():
+                if email_addr not in retry:
+                    failures[email_addr] = SendFailure.refusal(refusal)
+            senders.release(lane, sent=len(pending) - len(refused), failed=len(refused) - len(retry),
+                            unused=len(retry))
+            if not retry:
+                return chunk, failures
+            pending = retry
+            attempt += 1
+
+    sent_count = 0
+    failed_count = 0
+
+    def collect(result):
+        nonlocal sent_count, failed_count
+        chunk, failures = result
+        for email_addr in chunk:
+            error = failures.get(email_addr)
+            if error is None:
+                sent_count += 1
+            else:
+                failed_count += 1
+            on_result(email_addr, error)
+
+    try:
+        senders.warm()
+        run_windowed(chunks(), deliver, senders.size, collect)
+    finally:
+        senders.close()
+
+    return sent_count, failed_count
@@ -0,0 +1,174 @@
+"""Sender accounts a campaign rotates through, and their daily usage.
+
+A user signs in with one sender (the main account) and may register
+further accounts or relays on the Senders page. A campaign sends from
+the main account and every enabled account registered under it; see
+sender_pool for how sends are spread over them.
+
+Daily quotas count the recipients each address was sent to (or failed
+for) today, across campaigns, in sender_usage. The main account's quota
+is ``SMTP_DAILY_QUOTA``; registered accounts carry their own. An account
+whose login fails during a send is disabled until the user enables it
+again.
+
+Registered accounts' passwords are stored encrypted with
+``SENDER_SECRET_KEY``, which lives outside the database. Without it no
+account can be registered and campaigns send from the main account only;
+an account whose password no longer decrypts (a lost key) is disabled and
+has to be added again.
+
+A queued campaign's password is encrypted the same way until its worker
+is done with it. Without ``SENDER_SECRET_KEY`` it falls back to a key
+derived from ``SESSION_SECRET``, which is outside the database too.
+"""
+import base64
+import hashlib
+import logging
+from datetime import date
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import SenderAccount, SenderUsage
+
+logger = logging.getLogger(__name__)
+
+def password_encryption_configured():
+    return bool(app.config['SENDER_SECRET_KEY'])
+
+def _fernet(session_fallback=False):
+    keys = [key.strip() for key in app.config['SENDER_SECRET_KEY'].split(',') if key.strip()]
+    if not keys and session_fallback:
+        keys = [base64.urlsafe_b64encode(hashlib.sha256(app.secret_key.encode('utf-8')).digest())]
+    if not keys:
+        raise RuntimeError("SENDER_SECRET_KEY is not set")
+    return MultiFernet([Fernet(key) for key in keys])
+
+def encrypt_password(password, session_fallback=False):
+    return _fernet(session_fallback).encrypt(password.encode('utf-8')).decode('ascii')
+
+def decrypt_password(token, session_fallback=False):
+    """The stored password, or None if none of the keys decrypts it"""
+    try:
+        return _fernet(session_fallback).decrypt(token.encode('ascii')).decode('utf-8')
+    except InvalidToken:
+        return None
+
+def encrypt_campaign_password(password):
+    """A queued campaign's password as stored in ``EmailCampaign.sender_password``"""
+    return encrypt_password(password, session_fallback=True)
+
+def decrypt_campaign_password(token):
+    password = decrypt_password(token, session_fallback=True)
+    if password is None:
+        raise RuntimeError("The campaign's password no longer decrypts; send it again")
+    return password
+
+def used_today(emails=None):
+    """``{sender_email: recipients sent or failed today}``"""
+    query = db.session.query(SenderUsage.sender_email, SenderUsage.sent + SenderUsage.failed).filter(
+        SenderUsage.day == date.today()
+    )
+    if emails is not None:
+        query = query.filter(SenderUsage.sender_email.in_([email.lower() for email in emails]))
+    return dict(query.all())
+
+def _remaining(quota, used):
+    return max(0, quota - used) if quota else None
+
+def registered_accounts(owner_email, enabled_only=False):
+    query = SenderAccount.query.filter(SenderAccount.owner_email == owner_email.lower())
+    if enabled_only:
+        query = query.filter(SenderAccount.enabled.is_(True))
+    return query.order_by(SenderAccount.id).all()
+
+def account_config(smtp_config, account, password):
+    """``smtp_config`` with the registered account's relay and its (decrypted) ``password``"""
+    config = dict(smtp_config, server=account.smtp_server, port=account.smtp_port,
+                  email=account.email, password=password, account_id=account.id)
+    config.pop('accounts', None)
+    if account.pool_size:
+        config['pool_size'] = account.pool_size
+    if account.rate_per_minute:
+        config['rate_per_minute'] = account.rate_per_minute
+    return config
+
+def campaign_accounts(smtp_config):
+    """smtp_configs for the main account and its enabled registered accounts.
+
+    Each carries ``account_id`` (None for the main account) and
+    ``daily_remaining``, the recipients its quota still allows today
+    (None without a quota).
+    """
+    accounts = registered_accounts(smtp_config['email'], enabled_only=True)
+    if accounts and not password_encryption_configured():
+        logger.warning("SENDER_SECRET_KEY is not set; sending from %s only", smtp_config['email'])
+        accounts = []
+    used = used_today([smtp_config['email']] + [account.email for account in accounts])
+
+    main = dict(smtp_config, account_id=None)
+    main.pop('accounts', None)
+    main['daily_remaining'] = _remaining(app.config['SMTP_DAILY_QUOTA'], used.get(smtp_config['email'].lower(), 0))
+    configs = [main]
+    for account in accounts:
+        password = decrypt_password(account.password)
+        if password is None:
+            account.enabled = False
+            account.disabled_reason = 'Stored password could not be decrypted; add the account again'
+            db.session.commit()
+            continue
+        config = account_config(smtp_config, account, password)
+        config['daily_remaining'] = _remaining(account.daily_quota, used.get(account.email.lower(), 0))
+        configs.append(config)
+    return configs
+
+def _add_usage(email, sent, failed):
+    today = date.today()
+    row = SenderUsage.query.filter_by(sender_email=email, day=today).first()
+    if row is None:
+        db.session.add(SenderUsage(sender_email=email, day=today, sent=sent, failed=failed))
+    else:
+        row.sent = SenderUsage.sent + sent
+        row.failed = SenderUsage.failed + failed
+    db.session.commit()
+
+def record_usage(usage):
+    """Add a send's sender_pool usage to today's counts and disable accounts that failed to log in"""
+    for email, entry in usage.items():
+        if entry['sent'] or entry['failed']:
+            try:
+                _add_usage(email.lower(), entry['sent'], entry['failed'])
+            except IntegrityError:
+                # Another worker created today's row first
+                db.session.rollback()
+                _add_usage(email.lower(), entry['sent'], entry['failed'])
+        if entry['auth_failed'] and entry['account_id'] is not None:
+            account = db.session.get(SenderAccount, entry['account_id'])
+            if account is not None:
+                account.enabled = False
+                account.disabled_reason = entry['disabled']
+                db.session.commit()
+
+def account_overview(owner_email):
+    """The main account and registered accounts, with today's usage and quota left"""
+    accounts = registered_accounts(owner_email)
+    used = used_today([owner_email] + [account.email for account in accounts])
+    overview = [{
+        'account': None,
+        'email': owner_email,
+        'smtp_server': app.config['SMTP_SERVER'],
+        'daily_quota': app.config['SMTP_DAILY_QUOTA'] or None,
+        'used_today': used.get(owner_email.lower(), 0),
+        'remaining': _remaining(app.config['SMTP_DAILY_QUOTA'], used.get(owner_email.lower(), 0)),
+    }]
+    for account in accounts:
+        overview.append({
+            'account': account,
+            'email': account.email,
+            'smtp_server': account.smtp_server,
+            'daily_quota': account.daily_quota,
+            'used_today': used.get(account.email.lower(), 0),
+            'remaining': _remaining(account.daily_quota, used.get(account.email.lower(), 0)),
+        })
+    return overview
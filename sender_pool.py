@@ -0,0 +1,170 @@
+"""Rotation of a campaign's sends across several sender accounts and relays.
+
+``smtp_config['accounts']``, when present, lists one smtp_config per
+account (see sender_accounts.campaign_accounts); otherwise the campaign
+has the single account ``smtp_config`` describes. Each account gets a
+lane with its own connection pool (``pool_size`` connections), its
+process-wide rate limiter and, if ``daily_remaining`` is set, a budget
+of recipients it may still send today. A dry run's lanes deliver to its
+transport instead (see transports.py), with no limiter or budget.
+
+Every send asks the rotation for a lane: the least busy one, relative to
+its pool size, that is enabled and has budget left. An account that
+fails to log in, or that the server says is over its sending quota, is
+disabled for the rest of the send and the message moves to another
+lane. When no lane is left, ``NoSenderAvailable`` is raised and the
+campaign fails, with each account's reason in its error message.
+"""
+import re
+import smtplib
+import threading
+
+from rate_limiter import UNPACED, limiter_for, reply_code
+from smtp_pool import DEFAULT_POOL_SIZE
+from transports import open_transport
+
+# Replies relays use for exhausted sending quotas (Office 365, Gmail, Exchange)
+QUOTA_ERROR_RE = re.compile(r'quota|sending limit|5\.4\.5|SubmissionQuotaExceeded|RecipientRateLimit', re.I)
+# ...but a recipient's full mailbox is the recipient's problem
+MAILBOX_FULL_RE = re.compile(r'mailbox|5\.2\.2', re.I)
+
+class NoSenderAvailable(Exception):
+    """Every account of the campaign is disabled or out of quota"""
+
+def is_auth_error(exc):
+    return isinstance(exc, smtplib.SMTPAuthenticationError)
+
+def _is_quota_reply(text):
+    return QUOTA_ERROR_RE.search(text) is not None and MAILBOX_FULL_RE.search(text) is None
+
+def is_quota_error(exc):
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        # Only when every recipient was refused for the sender's quota
+        return bool(exc.recipients) and all(_is_quota_reply(str(resp)) for _, resp in exc.recipients.values())
+    return reply_code(exc) is not None and _is_quota_reply(str(exc))
+
+def is_failover_error(exc):
+    """True when the account, rather than the message, is the problem"""
+    return is_auth_error(exc) or is_quota_error(exc)
+
+def account_configs(smtp_config):
+    return smtp_config.get('accounts') or [smtp_config]
+
+def combine_usage(*usages):
+    """Sum SenderRotation.usage() reports, e.g. of a campaign's runs"""
+    combined = {}
+    for usage in usages:
+        for email, entry in (usage or {}).items():
+            total = combined.setdefault(email, {
+                'account_id': entry['account_id'], 'sent': 0, 'failed': 0, 'disabled': None, 'auth_failed': False,
+            })
+            total['sent'] += entry['sent']
+            total['failed'] += entry['failed']
+            total['disabled'] = entry['disabled'] or total['disabled']
+            total['auth_failed'] = entry['auth_failed'] or total['auth_failed']
+    return combined
+
+class SenderLane:
+    """One account's connection pool, rate limiter, budget and tallies"""
+
+    def __init__(self, smtp_config):
+        self.smtp_config = smtp_config
+        self.email = smtp_config['email']
+        self.account_id = smtp_config.get('account_id')
+        self.size = max(1, int(smtp_config.get('pool_size', DEFAULT_POOL_SIZE)))
+        self.pool = open_transport(smtp_config, size=self.size)
+        paced = self.pool.paced
+        self.remaining = smtp_config.get('daily_remaining') if paced else None  # None: no budget to keep
+        self.limiter = limiter_for(smtp_config) if paced else UNPACED
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.disabled = None  # Why the lane stopped being used
+        self.auth_failed = False
+
+class SenderRotation:
+    """Picks an account for each send and tracks what each one sent"""
+
+    def __init__(self, configs):
+        self.lanes = [SenderLane(config) for config in configs]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, smtp_config):
+        return cls(account_configs(smtp_config))
+
+    @property
+    def size(self):
+        """Connections across every lane"""
+        return sum(lane.size for lane in self.lanes)
+
+    def _unavailable(self):
+        reasons = [f"{lane.email}: {lane.disabled or 'daily quota used up'}" for lane in self.lanes]
+        return NoSenderAvailable("No sender account available (" + '; '.join(reasons) + ")")
+
+    def warm(self):
+        """Open each lane's first connection, disabling accounts that cannot connect"""
+        for lane in self.lanes:
+            try:
+                lane.pool.warm()
+            except Exception as e:
+                self.disable(lane, e)
+        if all(lane.disabled for lane in self.lanes):
+            raise self._unavailable()
+
+    def acquire(self, count=1, exclude=()):
+        """Reserve ``count`` recipients of budget on the least busy usable lane"""
+        with self._lock:
+            candidates = [
+                lane for lane in self.lanes
+                if lane.disabled is None and lane not in exclude
+                and (lane.remaining is None or lane.remaining >= count)
+            ]
+            if not candidates:
+                raise self._unavailable()
+            lane = min(candidates, key=lambda lane: lane.in_flight / lane.size)
+            lane.in_flight += 1
+            if lane.remaining is not None:
+                lane.remaining -= count
+            return lane
+
+    def release(self, lane, sent=0, failed=0, unused=0):
+        """Return a lane after a send, refunding budget it did not spend"""
+        with self._lock:
+            lane.in_flight -= 1
+            lane.sent += sent
+            lane.failed += failed
+            if lane.remaining is not None:
+                lane.remaining += unused
+
+    def disable(self, lane, reason):
+        with self._lock:
+            if lane.disabled is None:
+                lane.disabled = str(reason)[:500]
+                lane.auth_failed = is_auth_error(reason)
+
+    def usage(self):
+        """``{email: {account_id, sent, failed, disabled, auth_failed}}``"""
+        with self._lock:
+            reports = [{lane.email: {
+                'account_id': lane.account_id, 'sent': lane.sent, 'failed': lane.failed,
+                'disabled': lane.disabled, 'auth_failed': lane.auth_failed,
+            }} for lane in self.lanes]
+        return combine_usage(*reports)
+
+    def merge_usage(self, usage):
+        """Add in another rotation's ``usage()``, e.g. from a campaign shard"""
+        with self._lock:
+            lanes = {lane.email: lane for lane in self.lanes}
+            for email, entry in usage.items():
+                lane = lanes.get(email)
+                if lane is None:
+                    continue
+                lane.sent += entry['sent']
+                lane.failed += entry['failed']
+                lane.disabled = lane.disabled or entry['disabled']
+                lane.auth_failed = lane.auth_failed or entry['auth_failed']
+
+    def close(self):
+        for lane in self.lanes:
+            lane.pool.close()
@@ -0,0 +1,192 @@
+"""Send a personalized campaign from several processes at once.
+
+Rendering and MIME building are pure Python, so one process sends at
+most one core's worth of messages. With ``CAMPAIGN_SHARDS`` above 1 the
+worker forks that many shard processes. Each shard reads the whole
+recipient stream but keeps only the addresses whose 64-bit hash (see
+suppression.email_hashes) falls in its shard. Each shard renders and
+sends its part over its own connection pool, and streams the outcomes
+back in batches.
+
+The parent process is the only one that touches the database. It logs
+every outcome through its EmailLogWriter, so progress, counters and
+resume work as for an unsharded send, and it merges the shards' phase
+timings into the campaign's summary.
+
+A sender's limits are shared: each shard gets ``1/shards`` of every
+account's rate budget, connection pool (at least one connection) and
+remaining daily quota, and reports what each account sent. Duplicate
+addresses hash alike and so land in the same shard, where the shard's
+RecipientFilter drops them.
+"""
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+import pandas as pd
+
+from metrics import campaign_timings, merge_phases
+from send_engine import SendFailure, send_personalized
+from sender_pool import SenderRotation
+from smtp_pool import DEFAULT_POOL_SIZE
+from suppression import RecipientFilter, _isin_sorted, email_hashes
+
+RESULT_BATCH_SIZE = 200  # Outcomes per message to the parent
+RESULT_BATCH_INTERVAL = 0.5  # Max seconds an outcome waits in a shard
+POLL_INTERVAL = 1.0  # Seconds between checks for shards that died
+
+class ShardedRecipients:
+    """A recipient list to split across ``shards`` processes.
+
+    ``open_rows(recipient_filter)`` returns the campaign's row dicts with
+    ``recipient_filter.apply`` run on every chunk, like
+    recipients.iter_recipients; each shard calls it with its own filter.
+    ``removed`` counts what the shards dropped, as RecipientFilter does.
+    """
+
+    def __init__(self, open_rows, shards, suppression=None):
+        self.open_rows = open_rows
+        self.shards = max(1, int(shards))
+        self.suppression = suppression
+        self.removed = {'duplicate': 0, 'suppressed': 0}
+
+class ShardFilter:
+    """Keeps one shard's rows: not suppressed, not duplicates and not already sent"""
+
+    def __init__(self, index, shards, suppression=None, skip_hashes=None):
+        self.index = index
+        self.shards = shards
+        self.recipient_filter = RecipientFilter(suppression)
+        self.skip_hashes = skip_hashes if skip_hashes is not None else np.empty(0, dtype=np.int64)
+
+    @property
+    def removed(self):
+        return self.recipient_filter.removed
+
+    def apply(self, chunk):
+        hashes = email_hashes(chunk['Email'])
+        chunk = chunk[hashes.view(np.uint64) % self.shards == self.index]
+        chunk = self.recipient_filter.apply(chunk)
+        if len(self.skip_hashes):
+            chunk = chunk[~_isin_sorted(self.skip_hashes, email_hashes(chunk['Email']))]
+        return chunk
+
+def _share(smtp_config, shards):
+    config = dict(smtp_config)
+    config['pool_size'] = max(1, int(smtp_config.get('pool_size', DEFAULT_POOL_SIZE)) // shards)
+    for key in ('rate_per_second', 'rate_per_minute'):
+        if smtp_config.get(key):
+            config[key] = float(smtp_config[key]) / shards
+    if smtp_config.get('daily_remaining') is not None:
+        config['daily_remaining'] = smtp_config['daily_remaining'] // shards
+    return config
+
+def shard_config(smtp_config, shards):
+    """The share of each sender account's rate budget, connections and quota one shard may use"""
+    config = _share(smtp_config, shards)
+    if smtp_config.get('accounts'):
+        config['accounts'] = [_share(account, shards) for account in smtp_config['accounts']]
+    return config
+
+def _run_shard(recipients, index, build_message, smtp_config, skip_hashes, results):
+    """Shard process: send this shard's rows and report outcomes to the parent"""
+    shard_filter = ShardFilter(index, recipients.shards, recipients.suppression, skip_hashes)
+    batch = []
+    last_put = time.monotonic()
+    senders = SenderRotation.from_config(smtp_config)
+
+    def report(email_addr, error):
+        nonlocal batch, last_put
+        batch.append((email_addr, None if error is None else SendFailure.from_error(error)))
+        if len(batch) >= RESULT_BATCH_SIZE or time.monotonic() - last_put >= RESULT_BATCH_INTERVAL:
+            results.put(('results', index, batch))
+            batch = []
+            last_put = time.monotonic()
+
+    try:
+        with campaign_timings() as timings:
+            send_personalized(recipients.open_rows(shard_filter), build_message, smtp_config, report, senders)
+        if batch:
+            results.put(('results', index, batch))
+        results.put(('done', index, (timings.snapshot(), shard_filter.removed, senders.usage())))
+    except Exception as e:
+        if batch:
+            results.put(('results', index, batch))
+        results.put(('error', index, (str(e), senders.usage())))
+
+def send_sharded(recipients, build_message, smtp_config, on_result, skip=(), senders=None):
+    """Send a ShardedRecipients list from ``recipients.shards`` forked processes.
+
+    ``build_message`` and ``smtp_config`` are as for
+    send_engine.send_personalized; ``skip`` holds addresses already sent.
+    What each account sent in the shards is added to ``senders``, a
+    sender_pool.SenderRotation for ``smtp_config``, if given.
+    ``on_result(email_addr, error)`` runs in this process for every
+    recipient, with ``error`` as a send_engine.SendFailure. Raises
+    RuntimeError once every shard has finished if any of them failed.
+    Returns ``(sent_count, failed_count)``.
+    """
+    shards = recipients.shards
+    skip_hashes = np.sort(email_hashes(pd.Series(list(skip), dtype=object))) if skip else None
+    config = shard_config(smtp_config, shards)
+
+    # Forked, so the shards inherit build_message and the recipient source as they are
+    context = multiprocessing.get_context('fork')
+    results = context.Queue(maxsize=shards * 8)
+    processes = [
+        context.Process(target=_run_shard, name=f'shard-{index}', daemon=True,
+                        args=(recipients, index, build_message, config, skip_hashes, results))
+        for index in range(shards)
+    ]
+
+    sent_count = 0
+    failed_count = 0
+    finished = set()
+    errors = []
+    try:
+        for process in processes:
+            process.start()
+        while len(finished) < shards:
+            try:
+                kind, index, payload = results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                for index, process in enumerate(processes):
+                    if index not in finished and not process.is_alive():
+                        # Died without reporting; what it did report is already logged
+                        finished.add(index)
+                        errors.append(f"shard {index} exited with code {process.exitcode}")
+                continue
+
+            if kind == 'results':
+                for email_addr, error in payload:
+                    if error is None:
+                        sent_count += 1
+                    else:
+                        failed_count += 1
+                    on_result(email_addr, error)
+            elif kind == 'done':
+                finished.add(index)
+                phases, removed, usage = payload
+                merge_phases(phases)
+                for reason, count in removed.items():
+                    recipients.removed[reason] += count
+                if senders is not None:
+                    senders.merge_usage(usage)
+            else:
+                finished.add(index)
+                error, usage = payload
+                errors.append(f"shard {index}: {error}")
+                if senders is not None:
+                    senders.merge_usage(usage)
+    finally:
+        for process in processes:
+            if process.pid is None:
+                continue
+            if process.is_alive() and len(finished) < shards:
+                process.terminate()
+            process.join()
+
+    if errors:
+        raise RuntimeError('; '.join(errors))
+    return sent_count, failed_count
@@ -0,0 +1,229 @@
+import hashlib
+import os
+import queue
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import inc, timed
+from smtp_transport import PipeliningSMTP
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_NOOP_AFTER = 30  # Seconds idle before a cached connection is checked with NOOP
+DEFAULT_MAX_IDLE = 120  # Seconds idle before a cached connection is closed
+DEFAULT_IDLE_PER_SENDER = 4
+
+def open_smtp_connection(smtp_config):
+    """Open an SMTP connection, upgrade it with STARTTLS and log in
+
+    Uses the PIPELINING transport unless ``smtp_config['pipelining']`` is
+    False; it falls back to lock-step commands on servers without it.
+    """
+    smtp_class = PipeliningSMTP if smtp_config.get('pipelining', True) else smtplib.SMTP
+    with timed('smtp_connect'):
+        server = smtp_class(smtp_config['server'], smtp_config['port'])
+    if smtp_config.get('starttls', True):
+        with timed('smtp_starttls'):
+            server.starttls()
+    with timed('smtp_login'):
+        server.login(smtp_config['email'], smtp_config['password'])
+    return server
+
+def close_quietly(server):
+    """Close an SMTP connection, ignoring errors from an already dead socket"""
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+def is_connection_error(exc):
+    """True when an error means the connection itself can no longer be used.
+
+    Recipient and message level SMTP errors (refused recipient, rejected data)
+    leave the session usable, so the connection goes back to the pool;
+    a 421 refusal of a recipient does not, as the client has closed it.
+    """
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return any(code == 421 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code == 421:
+        return True
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+def connection_key(smtp_config):
+    """Cache key: the relay, the sender and a digest of the password it logged in with"""
+    password = hashlib.sha256(str(smtp_config.get('password', '')).encode('utf-8')).hexdigest()
+    return (
+        smtp_config['server'], smtp_config['port'], smtp_config['email'].lower(), password,
+        smtp_config.get('pipelining', True), smtp_config.get('starttls', True),
+    )
+
+def is_alive(server):
+    try:
+        return server.noop()[0] == 250
+    except Exception:
+        return False
+
+class SMTPConnectionCache:
+    """Process-wide cache of idle, authenticated SMTP connections per sender.
+
+    Requests and campaign pools check connections out and hand them back
+    instead of quitting, so the next use skips connect, STARTTLS and login.
+    A connection idle for ``noop_after`` seconds is checked with NOOP before
+    reuse and replaced if the server has dropped it; ones idle for
+    ``max_idle`` seconds are closed on the next access. At most
+    ``idle_per_sender`` idle connections are kept per key. Thread-safe.
+    """
+
+    def __init__(self, noop_after=DEFAULT_NOOP_AFTER, max_idle=DEFAULT_MAX_IDLE,
+                 idle_per_sender=DEFAULT_IDLE_PER_SENDER, clock=time.monotonic):
+        self.configure(noop_after, max_idle, idle_per_sender)
+        self._clock = clock
+        self._idle = {}  # key -> [(server, last_used)], most recently used last
+        self._lock = threading.Lock()
+
+    def configure(self, noop_after, max_idle, idle_per_sender):
+        self.noop_after = noop_after
+        self.max_idle = max_idle
+        self.idle_per_sender = max(0, int(idle_per_sender))
+
+    def _sweep(self, now):
+        expired = []
+        with self._lock:
+            for key, idle in list(self._idle.items()):
+                keep = [(server, used) for server, used in idle if now - used < self.max_idle]
+                expired.extend(server for server, used in idle if now - used >= self.max_idle)
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for server in expired:
+            close_quietly(server)
+
+    def _checkout(self, smtp_config):
+        """``(server, reused)``: a live cached connection, or a new one"""
+        key = connection_key(smtp_config)
+        now = self._clock()
+        self._sweep(now)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                inc('smtp_connections_total', source='new')
+                return open_smtp_connection(smtp_config), False
+            server, last_used = entry
+            if now - last_used < self.noop_after or is_alive(server):
+                inc('smtp_connections_total', source='cached')
+                return server, True
+            close_quietly(server)
+
+    def acquire(self, smtp_config):
+        return self._checkout(smtp_config)[0]
+
+    def release(self, smtp_config, server):
+        """Hand a healthy connection back for reuse"""
+        key = connection_key(smtp_config)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.idle_per_sender:
+                idle.append((server, self._clock()))
+                return
+        close_quietly(server)
+
+    def run(self, smtp_config, operation):
+        """Return ``operation(server)`` run on a cached connection.
+
+        If a reused connection turns out to be dead, the operation is
+        retried once on a fresh one.
+        """
+        while True:
+            server, reused = self._checkout(smtp_config)
+            try:
+                result = operation(server)
+            except Exception as e:
+                if not is_connection_error(e):
+                    self.release(smtp_config, server)
+                    raise
+                close_quietly(server)
+                if not reused:
+                    raise
+                continue
+            self.release(smtp_config, server)
+            return result
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for entries in idle.values():
+            for server, _ in entries:
+                close_quietly(server)
+
+    def forget(self):
+        """Drop every cached connection without closing it, in a forked child.
+
+        The sockets are the parent's; quitting them here would end its sessions.
+        """
+        self._lock = threading.Lock()
+        self._idle = {}
+
+connection_cache = SMTPConnectionCache()
+os.register_at_fork(after_in_child=connection_cache.forget)
+
+class SMTPConnectionPool:
+    """Bounded pool of authenticated SMTP connections for one sender.
+
+    At most ``size`` connections are open at once. Connections are taken
+    from the process-wide connection cache (or opened) lazily on first
+    checkout, reused LIFO so idle ones stay warm, and discarded when they
+    fail with a connection-level error so the next checkout reconnects.
+    ``close`` hands them back to the cache.
+    """
+    paced = True  # Sends wait for the sender's rate limiter and count against its quota
+
+    def __init__(self, smtp_config, size=DEFAULT_POOL_SIZE, cache=None):
+        self.smtp_config = smtp_config
+        self.size = max(1, int(size))
+        self.cache = cache or connection_cache
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def warm(self):
+        """Open one connection up front so bad credentials fail fast"""
+        with self.connection():
+            pass
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                server = self.cache.acquire(self.smtp_config)
+
+            try:
+                yield server
+            except Exception as e:
+                if is_connection_error(e):
+                    close_quietly(server)
+                else:
+                    self._idle.put(server)
+                raise
+            else:
+                self._idle.put(server)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.cache.release(self.smtp_config, server)
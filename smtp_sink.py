@@ -0,0 +1,238 @@
+"""Local SMTP stand-in for exercising the send paths without mailing anyone.
+
+    sink = SMTPSink(latency=0.05)
+    sink.start()
+    smtp_config = {**smtp_config, **sink.smtp_config()}
+    ...
+    sink.stop()
+
+or ``python smtp_sink.py --port 1025``. It accepts any AUTH PLAIN login,
+stores what it receives in ``sink.messages`` and does not offer STARTTLS,
+so point the send paths at it with ``'starttls': False``.
+
+``latency`` simulates the network round trip: the sink waits that long
+after every read from the socket before answering everything the client
+has sent so far, so pipelined commands share one round trip while
+lock-step commands pay one each.
+
+Failures can be injected to exercise retry and refusal handling:
+``refuse_rate`` permanently refuses that fraction of recipients (550,
+chosen by address so a retry is refused again), ``transient_rate`` answers
+that fraction of RCPTs with a 451 throttle reply, ``max_recipients`` caps
+recipients per message (452 beyond it) and ``drop_after`` ends each
+connection with a 421 after that many messages.
+"""
+import argparse
+import random
+import socketserver
+import threading
+import time
+import zlib
+
+CRLF = b'\r\n'
+
+class _Session:
+    def __init__(self):
+        self.delivered = 0
+        self.reset()
+
+    def reset(self):
+        self.mail_from = None
+        self.rcpts = []
+
+class _SinkHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sink = self.server.sink
+        sock = self.request
+        session = _Session()
+        with sink._lock:
+            sink.connection_count += 1
+        in_data = False
+        buf = b''
+
+        sock.sendall(b'220 smtp-sink ESMTP ready' + CRLF)
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            if sink.latency:
+                time.sleep(sink.latency)
+            buf += data
+
+            replies = []
+            closing = False
+            while not closing:
+                if in_data:
+                    framed = CRLF + buf
+                    end = framed.find(b'\r\n.\r\n')
+                    if end < 0:
+                        break
+                    content = framed[2:end + 2] if end else b''
+                    buf = framed[end + 5:]
+                    lines = content.split(CRLF)
+                    content = CRLF.join(line[1:] if line.startswith(b'..') else line for line in lines)
+                    replies.append(sink._deliver(session, content))
+                    session.reset()
+                    in_data = False
+                    if sink.drop_after and session.delivered >= sink.drop_after:
+                        replies.append(b'421 4.4.2 Connection limit reached, closing' + CRLF)
+                        closing = True
+                    continue
+
+                end = buf.find(CRLF)
+                if end < 0:
+                    break
+                line, buf = buf[:end], buf[end + 2:]
+                reply, in_data, closing = sink._command(session, line.decode('utf-8', 'replace'))
+                replies.append(reply)
+
+            if replies:
+                sock.sendall(b''.join(replies))
+            if closing:
+                return
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class SMTPSink:
+    """In-process SMTP server that accepts and records everything it is sent"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, pipelining=True, keep_messages=True,
+                 max_recipients=None, refuse_rate=0.0, transient_rate=0.0, drop_after=None, seed=None):
+        self.latency = latency
+        self.pipelining = pipelining
+        self.keep_messages = keep_messages
+        self.max_recipients = max_recipients
+        self.refuse_rate = refuse_rate
+        self.transient_rate = transient_rate
+        self.drop_after = drop_after
+        self._random = random.Random(seed)
+        self.messages = []
+        self.message_count = 0
+        self.recipient_count = 0
+        self.refused_count = 0
+        self.connection_count = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingServer((host, port), _SinkHandler)
+        self._server.sink = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def smtp_config(self):
+        """Connection settings to merge into an smtp_config dict"""
+        host, port = self.address
+        return {'server': host, 'port': port, 'starttls': False}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def ehlo_lines(self):
+        lines = ['smtp-sink', 'SIZE 52428800', '8BITMIME', 'AUTH PLAIN']
+        if self.pipelining:
+            lines.insert(1, 'PIPELINING')
+        return lines
+
+    def _command(self, session, line):
+        """Reply to one command line: ``(reply_bytes, starts_data, closes)``"""
+        verb, _, arg = line.partition(' ')
+        verb = verb.upper()
+
+        if verb == 'EHLO':
+            lines = self.ehlo_lines()
+            text = ''.join(f'250-{item}\r\n' for item in lines[:-1]) + f'250 {lines[-1]}\r\n'
+            return text.encode('ascii'), False, False
+        if verb == 'HELO':
+            return b'250 smtp-sink' + CRLF, False, False
+        if verb == 'AUTH':
+            return b'235 2.7.0 Authentication successful' + CRLF, False, False
+        if verb == 'MAIL':
+            session.reset()
+            session.mail_from = arg.partition(':')[2].split(' ')[0].strip('<>')
+            return b'250 2.1.0 Sender OK' + CRLF, False, False
+        if verb == 'RCPT':
+            if session.mail_from is None:
+                return b'503 5.5.1 Need MAIL command' + CRLF, False, False
+            rcpt = arg.partition(':')[2].split(' ')[0].strip('<>')
+            refusal = self._refusal(session, rcpt)
+            if refusal is not None:
+                with self._lock:
+                    self.refused_count += 1
+                return refusal + CRLF, False, False
+            session.rcpts.append(rcpt)
+            return b'250 2.1.5 Recipient OK' + CRLF, False, False
+        if verb == 'DATA':
+            if session.mail_from is None or not session.rcpts:
+                return b'554 5.5.1 No valid recipients' + CRLF, False, False
+            return b'354 End data with <CR><LF>.<CR><LF>' + CRLF, True, False
+        if verb == 'RSET':
+            session.reset()
+            return b'250 2.0.0 Reset' + CRLF, False, False
+        if verb == 'NOOP':
+            return b'250 2.0.0 OK' + CRLF, False, False
+        if verb == 'QUIT':
+            return b'221 2.0.0 Bye' + CRLF, False, True
+        return b'502 5.5.2 Command not implemented' + CRLF, False, False
+
+    def _refusal(self, session, rcpt):
+        """The injected reply refusing ``rcpt``, or None to accept it"""
+        if self.max_recipients is not None and len(session.rcpts) >= self.max_recipients:
+            return b'452 4.5.3 Too many recipients'
+        if self.refuse_rate and zlib.crc32(rcpt.lower().encode('utf-8')) % 10000 < self.refuse_rate * 10000:
+            return b'550 5.1.1 Recipient address rejected: user unknown'
+        if self.transient_rate:
+            with self._lock:
+                throttled = self._random.random() < self.transient_rate
+            if throttled:
+                return b'451 4.7.0 Temporary failure, try again later'
+        return None
+
+    def _deliver(self, session, content):
+        session.delivered += 1
+        with self._lock:
+            self.message_count += 1
+            self.recipient_count += len(session.rcpts)
+            if self.keep_messages:
+                self.messages.append((session.mail_from, list(session.rcpts), content))
+        return b'250 2.0.0 Queued' + CRLF
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local SMTP sink")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per round trip")
+    parser.add_argument('--no-pipelining', action='store_true')
+    parser.add_argument('--max-recipients', type=int, help="recipients accepted per message")
+    parser.add_argument('--refuse-rate', type=float, default=0.0, help="fraction of recipients refused with 550")
+    parser.add_argument('--transient-rate', type=float, default=0.0, help="fraction of RCPTs answered with 451")
+    parser.add_argument('--drop-after', type=int, help="messages per connection before a 421")
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, latency=args.latency,
+                    pipelining=not args.no_pipelining, keep_messages=False,
+                    max_recipients=args.max_recipients, refuse_rate=args.refuse_rate,
+                    transient_rate=args.transient_rate, drop_after=args.drop_after)
+    print(f"SMTP sink listening on {args.host}:{args.port}")
+    try:
+        sink._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
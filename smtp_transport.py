@@ -0,0 +1,101 @@
+import re
+import smtplib
+
+# smtplib's own versions of these are private (_fix_eols, _quote_periods)
+EOL_RE = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+LEADING_PERIOD_RE = re.compile(br'(?m)^\.')
+
+def fix_eols(data):
+    return EOL_RE.sub(smtplib.CRLF, data)
+
+def quote_periods(data):
+    """Dot-stuff message content (RFC 5321 4.5.2)"""
+    return LEADING_PERIOD_RE.sub(b'..', data)
+
+class PipeliningSMTP(smtplib.SMTP):
+    """SMTP client that pipelines each message's envelope (RFC 2920).
+
+    When the server advertises PIPELINING in its EHLO reply, ``sendmail``
+    writes MAIL FROM, every RCPT TO and DATA in one go and then reads the
+    replies in order, so a message costs two round trips (envelope and
+    content) instead of one per command. Servers without PIPELINING, and
+    SMTPUTF8 sends, fall back to the standard ``smtplib`` exchange. Errors
+    are raised exactly as ``smtplib.SMTP.sendmail`` raises them.
+    """
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if (not self.has_extn('pipelining')
+                or any(option.lower() == 'smtputf8' for option in mail_options)):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        if isinstance(msg, str):
+            msg = fix_eols(msg).encode('ascii')
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+
+        esmtp_opts = []
+        if self.has_extn('size'):
+            esmtp_opts.append("size=%d" % len(msg))
+        esmtp_opts.extend(mail_options)
+        mail_args = ''.join(' ' + option for option in esmtp_opts)
+        rcpt_args = ''.join(' ' + option for option in rcpt_options)
+
+        commands = [f"mail from:{smtplib.quoteaddr(from_addr)}{mail_args}"]
+        commands.extend(f"rcpt to:{smtplib.quoteaddr(addr)}{rcpt_args}" for addr in to_addrs)
+        commands.append("data")
+        for command in commands:
+            if '\r' in command or '\n' in command:
+                raise ValueError(f'command and arguments contain prohibited newline characters: {command!r}')
+        self.send(''.join(command + smtplib.CRLF for command in commands))
+
+        # Read every reply in order, even after a failure, to keep the stream in sync;
+        # after a 421 the server has hung up and sends nothing more
+        mail_code, mail_resp = self.getreply()
+        if mail_code == 421:
+            self.close()
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        senderrs = {}
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(senderrs)
+        data_code, data_resp = self.getreply()
+
+        if data_code == 354 and (mail_code != 250 or len(senderrs) == len(to_addrs)):
+            # Server opened DATA although the envelope failed; end it empty
+            self.send(b'.' + smtplib.bCRLF)
+            data_code, data_resp = self.getreply()
+
+        if mail_code != 250:
+            self._abort(mail_code)
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if len(senderrs) == len(to_addrs):
+            self._abort(data_code)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        if data_code != 354:
+            self._abort(data_code)
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        content = quote_periods(msg)
+        if content[-2:] != smtplib.bCRLF:
+            content += smtplib.bCRLF
+        self.send(content + b'.' + smtplib.bCRLF)
+        code, resp = self.getreply()
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+    def _abort(self, code):
+        """End a failed transaction: close on 421, else RSET if the server is still there"""
+        if code == 421:
+            self.close()
+            return
+        try:
+            self.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
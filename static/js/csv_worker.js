@@ -0,0 +1,174 @@
+// Recipient CSV inspection for the campaign page, off the UI thread.
+//
+// Post {file, sampleRows} to the worker. It reads the file as a stream
+// (a .csv, a .csv.gz, or the first .csv in a .zip) and parses it
+// incrementally. Only the header and the first `sampleRows` data rows are
+// kept, so memory does not grow with the size of the list. It posts
+// {type: 'progress', loaded, total, rows, emails} while reading, then
+// {type: 'done', headers, sample, rows, emails} or {type: 'error', message}.
+// `emails` counts the data rows with a non-empty Email cell.
+
+const QUOTE = 34, COMMA = 44, LF = 10, CR = 13;
+const PROGRESS_INTERVAL_MS = 200;
+
+// RFC 4180 fields, fed one decoded chunk at a time. Quoted fields may hold
+// commas, newlines and doubled quotes, and may span chunks. A stray quote
+// inside an unquoted field is kept as text, as pandas does.
+class CSVParser {
+    constructor(onRow) {
+        this.onRow = onRow;
+        this.row = [];
+        this.field = '';
+        this.inQuotes = false;
+        this.afterQuote = false;  // The previous character closed a quoted field
+    }
+
+    push(text) {
+        let start = 0;
+        for (let i = 0; i < text.length; i++) {
+            const c = text.charCodeAt(i);
+            if (this.inQuotes) {
+                if (c === QUOTE) {
+                    this.field += text.slice(start, i);
+                    this.inQuotes = false;
+                    this.afterQuote = true;
+                    start = i + 1;
+                }
+            } else if (c === QUOTE) {
+                if (this.afterQuote && i === start) {
+                    // "" inside a quoted field
+                    this.field += '"';
+                    this.inQuotes = true;
+                    start = i + 1;
+                } else if (i === start && this.field === '') {
+                    this.inQuotes = true;
+                    start = i + 1;
+                }
+                this.afterQuote = false;
+            } else if (c === COMMA || c === LF || c === CR) {
+                this.row.push(this.field + text.slice(start, i));
+                this.field = '';
+                this.afterQuote = false;
+                start = i + 1;
+                if (c !== COMMA) this.endRow();
+            }
+        }
+        this.afterQuote = this.afterQuote && start === text.length;
+        this.field += text.slice(start);
+    }
+
+    finish() {
+        if (this.field !== '' || this.row.length) {
+            this.row.push(this.field);
+            this.field = '';
+            this.endRow();
+        }
+    }
+
+    endRow() {
+        const row = this.row;
+        this.row = [];
+        // Blank lines, including the empty one between \r and \n
+        if (row.length === 1 && row[0].trim() === '') return;
+        this.onRow(row);
+    }
+}
+
+// Byte stream and compressed size of the first .csv entry in a zip archive
+async function zipCSVEntry(file) {
+    // Find the end of central directory record, then the first .csv entry in the directory
+    const tail = new DataView(await file.slice(Math.max(0, file.size - 65557)).arrayBuffer());
+    let eocd = -1;
+    for (let i = tail.byteLength - 22; i >= 0; i--) {
+        if (tail.getUint32(i, true) === 0x06054b50) { eocd = i; break; }
+    }
+    if (eocd < 0) throw new Error('Not a zip file');
+    const dirSize = tail.getUint32(eocd + 12, true);
+    const dirOffset = tail.getUint32(eocd + 16, true);
+    const dir = new DataView(await file.slice(dirOffset, dirOffset + dirSize).arrayBuffer());
+    const decoder = new TextDecoder();
+    for (let pos = 0; pos + 46 <= dir.byteLength && dir.getUint32(pos, true) === 0x02014b50;) {
+        const method = dir.getUint16(pos + 10, true);
+        const compressedSize = dir.getUint32(pos + 20, true);
+        const nameLen = dir.getUint16(pos + 28, true);
+        const extraLen = dir.getUint16(pos + 30, true);
+        const commentLen = dir.getUint16(pos + 32, true);
+        const localOffset = dir.getUint32(pos + 42, true);
+        const entryName = decoder.decode(new Uint8Array(dir.buffer, pos + 46, nameLen));
+        pos += 46 + nameLen + extraLen + commentLen;
+        if (!entryName.toLowerCase().endsWith('.csv') || entryName.startsWith('__MACOSX/')) continue;
+
+        const local = new DataView(await file.slice(localOffset, localOffset + 30).arrayBuffer());
+        const dataStart = localOffset + 30 + local.getUint16(26, true) + local.getUint16(28, true);
+        if (method !== 0 && method !== 8) throw new Error('Unsupported zip compression');
+        return {
+            blob: file.slice(dataStart, dataStart + compressedSize),
+            decompress: method === 8 ? 'deflate-raw' : null,
+        };
+    }
+    throw new Error('The zip file has no .csv file in it');
+}
+
+// Decoded text stream of the CSV, reporting raw bytes read to `onBytes`
+async function csvTextStream(file, onBytes) {
+    const name = file.name.toLowerCase();
+    let blob = file, decompress = null;
+    if (name.endsWith('.gz')) {
+        decompress = 'gzip';
+    } else if (name.endsWith('.zip')) {
+        ({ blob, decompress } = await zipCSVEntry(file));
+    }
+    let stream = blob.stream().pipeThrough(new TransformStream({
+        transform(chunk, controller) {
+            onBytes(chunk.byteLength, blob.size);
+            controller.enqueue(chunk);
+        }
+    }));
+    if (decompress) stream = stream.pipeThrough(new DecompressionStream(decompress));
+    return stream.pipeThrough(new TextDecoderStream());
+}
+
+async function inspect(file, sampleRows) {
+    let headers = null, emailIndex = -1, rows = 0, emails = 0;
+    let loaded = 0, total = file.size, lastProgress = 0;
+    const sample = [];
+
+    const parser = new CSVParser(row => {
+        if (headers === null) {
+            headers = row.map(h => h.trim());
+            emailIndex = headers.indexOf('Email');
+            return;
+        }
+        rows++;
+        if (emailIndex >= 0 && emailIndex < row.length && row[emailIndex].trim() !== '') emails++;
+        if (sample.length < sampleRows) sample.push(row.map(cell => cell.trim()));
+    });
+
+    const reader = (await csvTextStream(file, (count, size) => {
+        loaded += count;
+        total = size;
+    })).getReader();
+    for (;;) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        parser.push(value);
+        if (headers !== null && emailIndex < 0) {
+            // Nothing more to learn; the page reports the missing column
+            reader.cancel();
+            break;
+        }
+        const now = Date.now();
+        if (now - lastProgress >= PROGRESS_INTERVAL_MS) {
+            lastProgress = now;
+            self.postMessage({ type: 'progress', loaded, total, rows, emails });
+        }
+    }
+    parser.finish();
+    return { type: 'done', headers: headers || [], sample, rows, emails };
+}
+
+self.onmessage = function(e) {
+    inspect(e.data.file, e.data.sampleRows || 5)
+        .then(result => self.postMessage(result))
+        .catch(error => self.postMessage({ type: 'error', message: error.message }));
+};
@@ -0,0 +1,186 @@
+"""Recipient deduplication and the suppression list.
+
+Addresses are compared in normalized form (trimmed, lower-cased) by their
+64-bit pandas hash. The suppression list lives in the
+``suppressed_addresses`` table; each process keeps its hashes in a sorted
+numpy array, so checking a chunk of recipients is one vectorized binary
+search however many millions of addresses are suppressed. The array is
+refreshed incrementally when rows are added. Two different addresses
+sharing a hash is possible but vanishingly rare (about one chance in 20
+million for a million-address list checked against a million recipients).
+
+Addresses are suppressed when an earlier campaign got a permanent (5xx)
+refusal of the address itself at RCPT, with an enhanced status of 5.1.x
+(bad mailbox or domain) when the server gave one, or from an uploaded CSV
+of addresses (unsubscribes, complaints). ``python suppression.py
+--from-logs`` backfills from the logs of every campaign; failures logged
+before the SMTP reply code and phase were recorded (no ``smtp_code`` or
+``smtp_phase``) cannot be told apart and are skipped. ``--import
+list.csv`` loads a file.
+"""
+import argparse
+import threading
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, insert, select
+
+from app import app, db
+from models import EmailLog, SuppressedAddress
+
+INSERT_BATCH_SIZE = 5000
+
+def normalize_emails(emails):
+    return emails.astype(str).str.strip().str.lower()
+
+def email_hashes(emails):
+    """Signed 64-bit hashes of the normalized addresses, as stored in the table"""
+    hashes = pd.util.hash_pandas_object(normalize_emails(emails), index=False).to_numpy()
+    return hashes.view(np.int64)
+
+def _insert_sorted(sorted_hashes, hashes):
+    """Merge new hashes into a sorted array; one memmove rather than a re-sort"""
+    hashes = np.unique(hashes)
+    return np.insert(sorted_hashes, np.searchsorted(sorted_hashes, hashes), hashes)
+
+def _isin_sorted(sorted_hashes, hashes):
+    if len(sorted_hashes) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    pos = np.searchsorted(sorted_hashes, hashes)
+    pos[pos == len(sorted_hashes)] = 0
+    return sorted_hashes[pos] == hashes
+
+class SuppressionIndex:
+    """Sorted array of suppressed address hashes"""
+
+    def __init__(self, hashes=None):
+        self.hashes = np.sort(np.asarray(hashes if hashes is not None else [], dtype=np.int64))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def contains(self, hashes):
+        """Boolean mask of which ``hashes`` are suppressed"""
+        return _isin_sorted(self.hashes, hashes)
+
+    def merge(self, hashes):
+        return SuppressionIndex(np.union1d(self.hashes, hashes))
+
+_index = SuppressionIndex()
+_index_version = (0, 0)  # (row count, max id) the array was loaded at
+_index_lock = threading.Lock()
+
+def _load_hashes(min_id=0):
+    query = select(SuppressedAddress.email_hash).where(SuppressedAddress.id > min_id)
+    return np.fromiter(db.session.execute(query).scalars(), dtype=np.int64)
+
+def suppression_index():
+    """This process's index, refreshed from the table if it changed"""
+    global _index, _index_version
+    count, max_id = db.session.execute(
+        select(func.count(SuppressedAddress.id), func.coalesce(func.max(SuppressedAddress.id), 0))
+    ).one()
+    with _index_lock:
+        if (count, max_id) == _index_version:
+            return _index
+        old_count, old_max_id = _index_version
+        added = _load_hashes(old_max_id) if count >= old_count else None
+        if added is not None and old_count + len(added) == count:
+            # Only appends since the last load
+            _index = _index.merge(added)
+        else:
+            _index = SuppressionIndex(_load_hashes())
+        _index_version = (count, max_id)
+        return _index
+
+def suppress(emails, reason, detail=None, campaign_id=None):
+    """Add addresses to the suppression list, skipping ones already on it.
+
+    ``detail`` may be a single value or a sequence aligned with ``emails``.
+    Returns the number of addresses added.
+    """
+    emails = pd.Series(list(emails), dtype=object)
+    details = pd.Series(list(detail) if isinstance(detail, (list, tuple, pd.Series)) else [detail] * len(emails),
+                        dtype=object)
+    hashes = email_hashes(emails)
+    keep = ~suppression_index().contains(hashes) & ~pd.Series(hashes).duplicated().to_numpy()
+
+    rows = [
+        {'email_hash': int(h), 'email': email, 'reason': reason, 'detail': d, 'campaign_id': campaign_id}
+        for h, email, d in zip(hashes[keep], normalize_emails(emails[keep]), details[keep])
+    ]
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(insert(SuppressedAddress), rows[start:start + INSERT_BATCH_SIZE])
+    db.session.commit()
+    return len(rows)
+
+def suppress_bounces(campaign_id=None):
+    """Suppress addresses with permanent failures in the logs of one or all campaigns.
+
+    Only the recipient's own RCPT refusals count: a 5xx for the sender
+    (MAIL) or the message (DATA) says nothing about the address.
+    """
+    query = db.session.query(EmailLog.recipient_email, EmailLog.error_message).filter(
+        EmailLog.status == 'failed',
+        EmailLog.smtp_phase == 'rcpt',
+        EmailLog.smtp_code.between(500, 599),
+        db.or_(EmailLog.smtp_status.is_(None), EmailLog.smtp_status.like('5.1.%')),
+    )
+    if campaign_id is not None:
+        query = query.filter(EmailLog.campaign_id == campaign_id)
+    bounced = pd.DataFrame(query.all(), columns=['email', 'error'])
+    if bounced.empty:
+        return 0
+    return suppress(bounced['email'], 'bounce', detail=bounced['error'].str.slice(0, 500).tolist(),
+                    campaign_id=campaign_id)
+
+def import_suppression_csv(path, reason='manual', chunksize=100000):
+    """Suppress every address in a CSV's ``Email`` column (or its first column)"""
+    added = 0
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=str):
+        column = 'Email' if 'Email' in chunk.columns else chunk.columns[0]
+        added += suppress(chunk[column].dropna(), reason)
+    return added
+
+class RecipientFilter:
+    """Drops duplicate and suppressed rows from a stream of recipient chunks.
+
+    ``removed`` counts what was dropped, by reason. A duplicate of a
+    suppressed address counts as suppressed.
+    """
+
+    def __init__(self, suppression=None, dedupe=True):
+        self.suppression = suppression
+        self.dedupe = dedupe
+        self.removed = {'duplicate': 0, 'suppressed': 0}
+        self._seen = np.empty(0, dtype=np.int64)
+
+    def apply(self, chunk, hashes=None):
+        """The rows of ``chunk`` to keep; ``hashes`` are its email_hashes if already computed"""
+        if hashes is None:
+            hashes = email_hashes(chunk['Email'])
+        keep = np.ones(len(chunk), dtype=bool)
+        if self.suppression is not None and len(self.suppression):
+            suppressed = self.suppression.contains(hashes)
+            self.removed['suppressed'] += int(suppressed.sum())
+            keep &= ~suppressed
+        if self.dedupe:
+            duplicate = keep & (pd.Series(hashes).duplicated().to_numpy() | _isin_sorted(self._seen, hashes))
+            self.removed['duplicate'] += int(duplicate.sum())
+            keep &= ~duplicate
+            self._seen = _insert_sorted(self._seen, hashes[keep])
+        return chunk[keep]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the suppression list")
+    parser.add_argument('--from-logs', action='store_true', help="suppress recipients refused at RCPT in every campaign's logs")
+    parser.add_argument('--import', dest='import_path', help="CSV of addresses to suppress")
+    parser.add_argument('--reason', default='manual')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.from_logs:
+            print(f"Suppressed {suppress_bounces()} bounced addresses")
+        if args.import_path:
+            print(f"Suppressed {import_suppression_csv(args.import_path, args.reason)} addresses")
+        print(f"{len(suppression_index())} addresses suppressed")
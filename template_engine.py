@@ -0,0 +1,59 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+PLACEHOLDER_RE = re.compile(r'<([^<>]+)>')
+CACHE_SIZE = 128
+
+class CompiledTemplate:
+    """A template parsed once into literal text and placeholder slots.
+
+    Rendering fills the slots and joins the parts in a single pass, instead
+    of rescanning the whole body once per placeholder with ``str.replace``.
+    Substituted values are never rescanned, so a value that happens to look
+    like ``<Name>`` is sent as-is.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        # re.split with one group alternates literal, name, literal, ...
+        self._parts = PLACEHOLDER_RE.split(source)
+        self._slots = [(i, self._parts[i]) for i in range(1, len(self._parts), 2)]
+        self.all_placeholders = [name for _, name in self._slots]
+        self.placeholders = list(dict.fromkeys(self.all_placeholders))
+
+    def render(self, values, default=None):
+        """Fill placeholders from ``values``.
+
+        Placeholders missing from ``values`` are replaced with ``default``,
+        or left as ``<Name>`` when ``default`` is None.
+        """
+        parts = self._parts[:]
+        for i, name in self._slots:
+            if name in values:
+                parts[i] = str(values[name])
+            elif default is None:
+                parts[i] = f'<{name}>'
+            else:
+                parts[i] = str(default)
+        return ''.join(parts)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def compile_template(source):
+    """Compiled template for ``source``, cached by content hash"""
+    key = hashlib.sha256(source.encode('utf-8')).digest()
+    with _cache_lock:
+        compiled = _cache.get(key)
+        if compiled is not None:
+            _cache.move_to_end(key)
+            return compiled
+
+    compiled = CompiledTemplate(source)
+    with _cache_lock:
+        _cache[key] = compiled
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
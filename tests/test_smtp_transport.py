@@ -0,0 +1,77 @@
+import smtplib
+
+import pytest
+
+from smtp_pool import is_connection_error
+from smtp_sink import SMTPSink
+from smtp_transport import PipeliningSMTP
+
+MESSAGE = "Subject: Hi\n\nHello\n.leading period\n"
+
+@pytest.fixture
+def sink():
+    with SMTPSink() as sink:
+        yield sink
+
+@pytest.fixture
+def lockstep_calls(monkeypatch):
+    """Count the sends that went through smtplib's own (non-pipelined) sendmail"""
+    calls = []
+    original = smtplib.SMTP.sendmail
+
+    def sendmail(self, *args, **kwargs):
+        calls.append(args)
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(smtplib.SMTP, 'sendmail', sendmail)
+    return calls
+
+def connect(sink):
+    host, port = sink.address
+    return PipeliningSMTP(host, port)
+
+def test_pipelined_send(sink, lockstep_calls):
+    with connect(sink) as server:
+        refused = server.sendmail('me@x.com', ['a@x.com', 'b@x.com'], MESSAGE)
+        assert server.has_extn('pipelining')
+    assert refused == {}
+    assert lockstep_calls == []
+    (mail_from, rcpts, content), = sink.messages
+    assert (mail_from, rcpts) == ('me@x.com', ['a@x.com', 'b@x.com'])
+    assert content == b"Subject: Hi\r\n\r\nHello\r\n.leading period\r\n"
+
+def test_falls_back_without_pipelining(lockstep_calls):
+    with SMTPSink(pipelining=False) as sink, connect(sink) as server:
+        assert server.sendmail('me@x.com', 'a@x.com', MESSAGE) == {}
+    assert len(lockstep_calls) == 1
+    assert [rcpts for _, rcpts, _ in sink.messages] == [['a@x.com']]
+
+def test_some_recipients_refused():
+    with SMTPSink(max_recipients=1) as sink, connect(sink) as server:
+        refused = server.sendmail('me@x.com', ['a@x.com', 'b@x.com'], MESSAGE)
+    assert list(refused) == ['b@x.com']
+    assert refused['b@x.com'][0] == 452
+    assert [rcpts for _, rcpts, _ in sink.messages] == [['a@x.com']]
+
+def test_every_recipient_refused_keeps_the_session():
+    with SMTPSink(refuse_rate=1.0) as sink, connect(sink) as server:
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as refused:
+            server.sendmail('me@x.com', ['a@x.com', 'b@x.com'], MESSAGE)
+        assert {code for code, _ in refused.value.recipients.values()} == {550}
+        assert not is_connection_error(refused.value)
+        sink.refuse_rate = 0.0
+        assert server.sendmail('me@x.com', ['a@x.com'], MESSAGE) == {}
+    assert len(sink.messages) == 1
+
+def test_closed_connection():
+    with SMTPSink(drop_after=1) as sink, connect(sink) as server:
+        server.sendmail('me@x.com', ['a@x.com'], MESSAGE)
+        with pytest.raises(smtplib.SMTPSenderRefused) as refused:
+            server.sendmail('me@x.com', ['b@x.com'], MESSAGE)
+        assert refused.value.smtp_code == 421
+        assert is_connection_error(refused.value)
+        assert server.sock is None
+
+def test_recipient_421_is_a_connection_error():
+    error = smtplib.SMTPRecipientsRefused({'a@x.com': (421, b'closing')})
+    assert is_connection_error(error)
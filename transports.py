@@ -0,0 +1,201 @@
+"""Where a campaign's messages go.
+
+``smtp_config['transport']`` picks the backend each sender lane delivers
+through (see sender_pool.SenderLane):
+
+- ``smtp`` (the default): the account's relay, over pooled connections
+  (see smtp_pool.SMTPConnectionPool).
+- ``maildir``: one file per message in the Maildir at
+  ``smtp_config['spool_path']``, delivered to ``new/`` through ``tmp/``.
+- ``mbox``: every message appended to the mbox file at ``spool_path``.
+- ``null``: messages are built and dropped.
+
+Every backend has the pool interface the send engine uses: ``warm()``,
+``connection()`` yielding an object with ``sendmail`` and
+``send_message``, and ``close()``. The spools and the null sink are for
+dry runs: a campaign is rendered and built for every row exactly as it
+would be sent, so template errors show up in its log and its timings
+profile the local work, but nothing leaves the machine. They are not
+``paced``: no rate limiter or daily quota applies to them, so a dry run
+goes at full local speed. ``cleanup_spools`` deletes old spools.
+"""
+import abc
+import itertools
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import getaddresses
+
+from smtp_pool import DEFAULT_POOL_SIZE, SMTPConnectionPool
+
+SMTP = 'smtp'
+MAILDIR = 'maildir'
+MBOX = 'mbox'
+NULL = 'null'
+TRANSPORTS = (SMTP, MAILDIR, MBOX, NULL)
+DRY_RUN_TRANSPORTS = (MAILDIR, MBOX, NULL)
+
+FROM_LINE_RE = re.compile(rb'^(>*From )', re.M)  # Quoted with one more '>' in mbox (mboxrd)
+
+def transport_name(smtp_config):
+    name = smtp_config.get('transport') or SMTP
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {name!r}")
+    return name
+
+def _message_bytes(msg):
+    """``(from_addr, to_addrs, content)`` of an email Message, as send_message would send it"""
+    from_addr = getaddresses(msg.get_all('Sender', []) or msg.get_all('From', []))[0][1]
+    to_addrs = [addr for _, addr in getaddresses(msg.get_all('To', []) + msg.get_all('Cc', [])
+                                                 + msg.get_all('Bcc', []))]
+    return from_addr, to_addrs, msg.as_bytes()
+
+def _local_content(from_addr, to_addrs, msg):
+    """The message with its envelope as headers and LF line endings, as local mailboxes store it"""
+    if isinstance(msg, str):
+        msg = msg.encode('utf-8')
+    envelope = f"Return-Path: <{from_addr}>\n" + ''.join(f"X-Envelope-To: {addr}\n" for addr in to_addrs)
+    return envelope.encode('utf-8') + msg.replace(b'\r\n', b'\n')
+
+class _Spool(abc.ABC):
+    """Base for the non-SMTP transports: the connection is the spool itself"""
+    paced = False
+
+    def __init__(self, smtp_config):
+        self.smtp_config = smtp_config
+
+    def warm(self):
+        pass
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def deliver(self, from_addr, to_addrs, msg):
+        """Store one message (wire bytes or a string) for ``to_addrs``"""
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        self.deliver(from_addr, to_addrs, msg)
+        return {}
+
+    def send_message(self, msg):
+        return self.sendmail(*_message_bytes(msg))
+
+class NullTransport(_Spool):
+    """Accepts and drops every message"""
+
+    def deliver(self, from_addr, to_addrs, msg):
+        pass
+
+class MaildirTransport(_Spool):
+    """Delivers each message as a file in a Maildir.
+
+    Names follow the Maildir convention (time, a per-process unique part,
+    host), so the threads of a campaign and its forked shards can write to
+    the same folder.
+    """
+    _counter = itertools.count()
+
+    def __init__(self, smtp_config):
+        super().__init__(smtp_config)
+        self.path = smtp_config['spool_path']
+        self._host = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+
+    def warm(self):
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(self.path, sub), exist_ok=True)
+
+    def deliver(self, from_addr, to_addrs, msg):
+        name = f"{time.time_ns() // 1000}.P{os.getpid()}Q{next(self._counter)}.{self._host}"
+        tmp_path = os.path.join(self.path, 'tmp', name)
+        with open(tmp_path, 'wb') as f:
+            f.write(_local_content(from_addr, to_addrs, msg))
+        os.replace(tmp_path, os.path.join(self.path, 'new', name))
+
+class MboxTransport(_Spool):
+    """Appends each message to an mbox file.
+
+    Each message goes out in one write to a file opened for appending, so
+    messages from several threads or shard processes do not interleave.
+    """
+
+    def __init__(self, smtp_config):
+        super().__init__(smtp_config)
+        self.path = smtp_config['spool_path']
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def warm(self):
+        with self._lock:
+            if self._fd is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def deliver(self, from_addr, to_addrs, msg):
+        content = FROM_LINE_RE.sub(rb'>\1', _local_content(from_addr, to_addrs, msg))
+        if not content.endswith(b'\n'):
+            content += b'\n'
+        separator = f"From {from_addr or 'MAILER-DAEMON'} {time.asctime()}\n".encode('utf-8')
+        if self._fd is None:
+            self.warm()
+        os.write(self._fd, separator + content + b'\n')
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+_SPOOLS = {MAILDIR: MaildirTransport, MBOX: MboxTransport, NULL: NullTransport}
+
+def open_transport(smtp_config, size=DEFAULT_POOL_SIZE):
+    """The pool a sender lane delivers through, for ``smtp_config['transport']``"""
+    name = transport_name(smtp_config)
+    if name == SMTP:
+        return SMTPConnectionPool(smtp_config, size=size)
+    return _SPOOLS[name](smtp_config)
+
+def is_dry_run(smtp_config):
+    return transport_name(smtp_config) != SMTP
+
+def _last_written(path):
+    # A Maildir's own mtime only changes when its subfolders are made
+    new = os.path.join(path, 'new')
+    return os.path.getmtime(new if os.path.isdir(new) else path)
+
+def cleanup_spools(folder, max_age_seconds, keep_paths=()):
+    """Delete the spools in ``folder`` not written to for ``max_age_seconds``.
+
+    Spools in ``keep_paths`` (those of dry runs still queued or running)
+    are kept. Returns how many were deleted.
+    """
+    if not os.path.isdir(folder):
+        return 0
+    keep = {os.path.abspath(path) for path in keep_paths}
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if not name.startswith('campaign_') or os.path.abspath(path) in keep:
+            continue
+        try:
+            if _last_written(path) >= cutoff:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
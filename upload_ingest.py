@@ -0,0 +1,303 @@
+"""Streamed ingestion of recipient CSV uploads.
+
+Werkzeug hands each uploaded file to a stream from the request class's
+``_get_file_stream`` as the multipart body arrives. For the endpoints in
+``INGEST_ENDPOINTS`` that stream is an ``UploadIngest``. It saves the raw
+upload under ``INCOMING_FOLDER`` and passes each block through a bounded
+queue to a parser thread. The thread decompresses the upload (gzip, or the
+first ``.csv`` in a zip archive, recognised by their magic bytes), reads
+it with pandas in chunks and validates each chunk into the recipient cache
+(see recipient_cache.RecipientCacheBuilder). The preview is ready when the
+last byte arrives, and memory use stays fixed whatever the file size: at
+most ``QUEUE_BLOCKS`` blocks wait to be parsed, and a slow parser holds
+back the upload rather than buffering it.
+
+The cache key is the SHA-256 of the decompressed CSV, so a list uploaded
+compressed and plain shares one entry. The saved upload keeps its
+extension, so pandas can still read it directly if the entry is evicted
+(unless it is a zip archive holding several files).
+"""
+import hashlib
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+from datetime import datetime
+
+import pandas as pd
+from flask import Request, session
+from werkzeug.utils import secure_filename
+
+from app import app
+from recipient_cache import RecipientCacheBuilder
+from recipients import CHUNK_SIZE
+
+INGEST_ENDPOINTS = {'process_campaign'}
+CSV_UPLOAD_EXTENSIONS = ['csv', 'gz', 'zip']
+QUEUE_BLOCKS = 64  # Upload blocks (werkzeug reads 64 KB at a time) waiting for the parser
+READ_BUFFER = 256 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+_END = object()
+_ABORT = object()
+
+class UploadAborted(Exception):
+    """The request ended before the upload was complete"""
+
+class _GzipDecoder:
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(wbits=31)
+
+    def feed(self, data):
+        out = self._decompressor.decompress(data)
+        while self._decompressor.eof and self._decompressor.unused_data.startswith(GZIP_MAGIC):
+            # Concatenated gzip members
+            rest = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(wbits=31)
+            out += self._decompressor.decompress(rest)
+        return out
+
+    def flush(self):
+        if not self._decompressor.eof:
+            raise ValueError('The gzip file is truncated')
+        return b''
+
+class _ZipDecoder:
+    """The first ``.csv`` member of a zip archive, decoded from its local headers"""
+    LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+    LOCAL_SIGNATURE = 0x04034b50
+    DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+    def __init__(self):
+        self._buffer = b''
+        self._member = None  # [decompressor or None, stored bytes left, keep, has descriptor]
+        self._found = False
+        self._done = False
+
+    def _start_member(self):
+        if len(self._buffer) < self.LOCAL_HEADER.size:
+            return False
+        signature, _, flags, method, _, _, _, size, _, name_len, extra_len = self.LOCAL_HEADER.unpack_from(self._buffer)
+        if signature != self.LOCAL_SIGNATURE:
+            # The central directory: no more members
+            self._done = True
+            return False
+        data_start = self.LOCAL_HEADER.size + name_len + extra_len
+        if len(self._buffer) < data_start:
+            return False
+        name = self._buffer[self.LOCAL_HEADER.size:self.LOCAL_HEADER.size + name_len].decode('utf-8', 'replace')
+        self._buffer = self._buffer[data_start:]
+        if method == 8:
+            decompressor = zlib.decompressobj(wbits=-15)
+        elif method == 0 and not flags & 0x08:
+            decompressor = None
+        else:
+            raise ValueError('Unsupported zip compression; save the archive with standard (deflate) compression')
+        keep = not self._found and name.lower().endswith('.csv') and not name.startswith('__MACOSX/')
+        self._found = self._found or keep
+        self._member = [decompressor, size, keep, bool(flags & 0x08)]
+        return True
+
+    def feed(self, data):
+        self._buffer += data
+        out = []
+        while not self._done:
+            if self._member is None and not self._start_member():
+                break
+            decompressor, left, keep, has_descriptor = self._member
+            if decompressor is None:
+                block = self._buffer[:left]
+                self._buffer = self._buffer[len(block):]
+                self._member[1] -= len(block)
+                if keep:
+                    out.append(block)
+                if self._member[1]:
+                    break
+            elif not decompressor.eof:
+                block = decompressor.decompress(self._buffer)
+                self._buffer = decompressor.unused_data
+                if keep:
+                    out.append(block)
+                if not decompressor.eof:
+                    break
+            if has_descriptor:
+                # crc and sizes follow the data, with or without a signature
+                size = 16 if self._buffer.startswith(self.DESCRIPTOR_SIGNATURE) else 12
+                if len(self._buffer) < size:
+                    break
+                self._buffer = self._buffer[size:]
+            self._member = None
+        if self._done:
+            self._buffer = b''
+        return b''.join(out)
+
+    def flush(self):
+        if self._member is not None:
+            raise ValueError('The zip file is truncated')
+        if not self._found:
+            raise ValueError('The zip file has no .csv file in it')
+        return b''
+
+class _PlainDecoder:
+    def feed(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+class _CSVPipe(io.RawIOBase):
+    """The decompressed CSV, read by pandas from the upload blocks as they are queued"""
+
+    def __init__(self, blocks, max_bytes):
+        self._blocks = blocks
+        self._max_bytes = max_bytes
+        self._decoder = None
+        self._prefix = b''
+        self._pending = b''
+        self._pos = 0
+        self._eof = False
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def _decode(self, block, final=False):
+        if self._decoder is None:
+            # Pick the format from the first bytes
+            self._prefix += block
+            if len(self._prefix) < len(ZIP_MAGIC) and not final:
+                return b''
+            block, self._prefix = self._prefix, b''
+            if block.startswith(GZIP_MAGIC):
+                self._decoder = _GzipDecoder()
+            elif block.startswith(ZIP_MAGIC):
+                self._decoder = _ZipDecoder()
+            else:
+                self._decoder = _PlainDecoder()
+        data = self._decoder.feed(block)
+        return data + self._decoder.flush() if final else data
+
+    def _next_block(self):
+        block = self._blocks.get()
+        if block is _ABORT:
+            raise UploadAborted()
+        if block is _END:
+            self._eof = True
+            return self._decode(b'', final=True)
+        return self._decode(block)
+
+    def readinto(self, buffer):
+        while self._pos == len(self._pending):
+            if self._eof:
+                return 0
+            self._pending = self._next_block()
+            self._pos = 0
+            self.digest.update(self._pending)
+            self.size += len(self._pending)
+            if self.size > self._max_bytes:
+                raise ValueError(f'The CSV is larger than {self._max_bytes // (1024 * 1024)} MB uncompressed')
+        count = min(len(buffer), len(self._pending) - self._pos)
+        buffer[:count] = self._pending[self._pos:self._pos + count]
+        self._pos += count
+        return count
+
+class UploadIngest:
+    """Writable file for werkzeug: saves an upload and validates it into the recipient cache.
+
+    ``result()`` waits for the parser and returns the cache metadata, as
+    recipient_cache.cache_recipients does, or raises what went wrong. Reads
+    and seeks go to the saved file, so it also works as a FileStorage stream.
+    """
+
+    def __init__(self, path, chunksize=CHUNK_SIZE, max_bytes=None):
+        self.path = path
+        self.chunksize = chunksize
+        self.max_bytes = max_bytes or app.config['MAX_CSV_SIZE']
+        self.meta = None
+        self.error = None
+        self._file = open(path, 'w+b')
+        self._blocks = queue.Queue(QUEUE_BLOCKS)
+        self._ended = False
+        self._thread = threading.Thread(target=self._parse, name='upload-ingest', daemon=True)
+        self._thread.start()
+
+    def _parse(self):
+        pipe = _CSVPipe(self._blocks, self.max_bytes)
+        builder = RecipientCacheBuilder(self.path)
+        try:
+            reader = pd.read_csv(io.BufferedReader(pipe, READ_BUFFER), chunksize=self.chunksize, dtype=str)
+            with reader:
+                for chunk in reader:
+                    builder.add(chunk)
+            self.meta = builder.finish(pipe.digest.hexdigest())
+        except Exception as e:
+            builder.abort()
+            self.error = e
+
+    def _put(self, block):
+        # Blocks while the parser is behind; gives up once it has stopped
+        while self._thread.is_alive():
+            try:
+                self._blocks.put(block, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self._file.write(data)
+        if self.error is None:
+            self._put(bytes(data))
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # Werkzeug rewinds the stream once the part is complete
+        if not self._ended:
+            self._ended = True
+            self._file.flush()
+            self._put(_END)
+        return self._file.seek(offset, whence)
+
+    def result(self):
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.meta
+
+    def close(self):
+        if not self._ended:
+            self._ended = True
+            self._put(_ABORT)
+        self._thread.join()
+        self._file.close()
+        if self.error is not None:
+            # Incomplete or unusable: nothing will read it
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __getattr__(self, name):
+        # read, readline, tell, ... on the saved upload
+        return getattr(self._file, name)
+
+def upload_path(filename):
+    return os.path.join(app.config['INCOMING_FOLDER'], secure_filename(
+        f"temp_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{filename}"
+    ))
+
+class IngestingRequest(Request):
+    """Flask request whose CSV uploads to ``INGEST_ENDPOINTS`` stream into an UploadIngest.
+
+    Only for signed-in users; anyone else's upload is not saved or parsed.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if (self.endpoint in INGEST_ENDPOINTS and session.get('email_configured')
+                and filename and '.' in filename
+                and filename.rsplit('.', 1)[1].lower() in CSV_UPLOAD_EXTENSIONS):
+            return UploadIngest(upload_path(filename))
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
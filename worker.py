@@ -0,0 +1,263 @@
+"""Background campaign workers.
+
+Campaigns are queued as ``EmailCampaign`` rows with ``status='queued'``.
+Workers claim them with a conditional UPDATE, so any number of worker
+threads and processes can poll the same table without sending a campaign
+twice. Progress is committed to the campaign row as the send runs, which
+is what the ``campaign_status`` endpoint serves.
+
+While a campaign runs its worker refreshes ``heartbeat_at``. A 'sending'
+campaign whose heartbeat is older than ``WORKER_STALE_AFTER`` belongs to a
+worker that died, and is claimed again like a queued one; the send then
+resumes from the logged outcomes instead of starting over.
+
+Run dedicated worker processes with ``python worker.py --processes N``
+(and ``EMBEDDED_WORKERS=0`` for the web app), or let the web app start
+``EMBEDDED_WORKERS`` worker threads itself. With ``CAMPAIGN_SHARDS`` above
+1 a worker sends each personalized campaign from that many forked
+processes (see sharding.py).
+
+A campaign with ``transport`` set is a dry run of a draft (see
+``enqueue_dry_run``): it goes through the same send engine into a spool
+under ``SPOOL_FOLDER``, or nowhere, instead of the relay. Spools are
+deleted ``SPOOL_RETENTION_HOURS`` after their last write.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_
+
+from app import app, db
+from email_service import send_bulk_emails
+from models import EmailCampaign
+from progress_bus import bus, campaign_state
+from recipient_cache import iter_cached_recipients, load_meta
+from recipients import iter_recipients
+from sender_accounts import decrypt_campaign_password
+from sharding import ShardedRecipients
+from suppression import RecipientFilter, suppress_bounces, suppression_index
+from transports import DRY_RUN_TRANSPORTS, MAILDIR, MBOX, SMTP
+
+logger = logging.getLogger(__name__)
+
+def enqueue_campaign(campaign_id=None, **fields):
+    """Queue a campaign and return it.
+
+    With ``campaign_id`` the existing draft is moved to 'queued' with a
+    conditional UPDATE, so submitting the same draft twice queues it once;
+    None is returned if it is no longer a draft. Otherwise a new queued row
+    is created from ``fields``.
+    """
+    if campaign_id is None:
+        campaign = EmailCampaign(status='queued', **fields)
+        db.session.add(campaign)
+        db.session.commit()
+        return campaign
+
+    queued = EmailCampaign.query.filter_by(id=campaign_id, status='draft').update(
+        dict(fields, status='queued'), synchronize_session=False
+    )
+    db.session.commit()
+    return db.session.get(EmailCampaign, campaign_id) if queued else None
+
+# What a dry run copies from the draft it rehearses
+DRAFT_FIELDS = (
+    'user_id', 'sender_email', 'subject', 'template', 'template_filename', 'csv_filename', 'mode',
+    'csv_path', 'recipients_key', 'placeholders', 'total_emails', 'validation_counts', 'sample_data',
+)
+
+def enqueue_dry_run(campaign_id, transport, **fields):
+    """Queue a dry run of a draft as a new campaign and return it.
+
+    The draft stays a draft, so it can still be sent for real afterwards.
+    None is returned if it is no longer a draft.
+    """
+    if transport not in DRY_RUN_TRANSPORTS:
+        raise ValueError(f"A dry run cannot use the {transport!r} transport")
+    draft = db.session.get(EmailCampaign, campaign_id)
+    if draft is None or draft.status != 'draft':
+        return None
+    copied = {name: getattr(draft, name) for name in DRAFT_FIELDS}
+    return enqueue_campaign(transport=transport, **copied, **fields)
+
+def claimable():
+    """Queued campaigns, and 'sending' ones whose worker stopped heartbeating"""
+    cutoff = datetime.now() - timedelta(seconds=app.config['WORKER_STALE_AFTER'])
+    return or_(
+        EmailCampaign.status == 'queued',
+        and_(
+            EmailCampaign.status == 'sending',
+            func.coalesce(EmailCampaign.heartbeat_at, EmailCampaign.started_at) < cutoff,
+        ),
+    )
+
+def claim_next_campaign(worker_id):
+    """Atomically move the oldest claimable campaign to 'sending' for this worker"""
+    while True:
+        candidate = db.session.query(EmailCampaign.id).filter(claimable()).order_by(EmailCampaign.id).first()
+        if candidate is None:
+            return None
+
+        now = datetime.now()
+        claimed = EmailCampaign.query.filter(EmailCampaign.id == candidate.id, claimable()).update(
+            {
+                'status': 'sending',
+                'worker_id': worker_id,
+                'started_at': func.coalesce(EmailCampaign.started_at, now),
+                'heartbeat_at': now,
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if claimed:
+            campaign = db.session.get(EmailCampaign, candidate.id)
+            bus.publish(campaign.id, campaign_state(campaign))
+            return campaign
+        # Another worker won the race, try the next one
+
+def heartbeat(campaign_id, stop_event):
+    """Refresh the campaign's ``heartbeat_at`` until ``stop_event`` is set"""
+    with app.app_context():
+        while not stop_event.wait(app.config['WORKER_HEARTBEAT_INTERVAL']):
+            try:
+                EmailCampaign.query.filter_by(id=campaign_id, status='sending').update(
+                    {'heartbeat_at': datetime.now()}, synchronize_session=False
+                )
+                db.session.commit()
+            except Exception:
+                logger.exception("Could not record heartbeat for campaign %s", campaign_id)
+                db.session.rollback()
+        db.session.remove()
+
+def spool_path(campaign):
+    """Where a dry run writes its messages: a Maildir folder or an mbox file"""
+    name = f"campaign_{campaign.id}" + ('.mbox' if campaign.transport == MBOX else '')
+    return os.path.join(app.config['SPOOL_FOLDER'], name)
+
+def campaign_smtp_config(campaign):
+    return {
+        'transport': campaign.transport or SMTP,
+        'spool_path': spool_path(campaign) if campaign.transport in (MAILDIR, MBOX) else None,
+        'server': campaign.smtp_server,
+        'port': campaign.smtp_port,
+        'email': campaign.sender_email,
+        'password': decrypt_campaign_password(campaign.sender_password) if campaign.sender_password else None,
+        'pool_size': app.config['SMTP_POOL_SIZE'],
+        'connection_concurrency': app.config['SMTP_CONNECTION_CONCURRENCY'],
+        'rate_per_second': app.config['SMTP_RATE_PER_SECOND'],
+        'rate_per_minute': app.config['SMTP_RATE_PER_MINUTE'],
+        'pipelining': app.config['SMTP_PIPELINING'],
+        'starttls': app.config['SMTP_STARTTLS'],
+        'bcc_chunk_size': app.config['BCC_CHUNK_SIZE'],
+        'bcc_chunk_retries': app.config['BCC_CHUNK_RETRIES'],
+    }
+
+def run_campaign(campaign):
+    """Load the campaign's recipients and send it"""
+    placeholders = campaign.placeholders or []
+    if campaign.sent_emails or campaign.failed_emails:
+        logger.info("Resuming campaign %s after %s sent", campaign.id, campaign.sent_emails)
+
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=heartbeat, args=(campaign.id, stop_heartbeat), daemon=True).start()
+    try:
+        cached = bool(campaign.recipients_key) and load_meta(campaign.recipients_key) is not None
+        
+        def open_rows(recipient_filter):
+            if cached:
+                return iter_cached_recipients(campaign.recipients_key, placeholders, recipient_filter)
+            return iter_recipients(campaign.csv_path, placeholders, recipient_filter=recipient_filter)
+        
+        # Drop duplicates and addresses suppressed since the list was validated
+        shards = app.config['CAMPAIGN_SHARDS']
+        if campaign.mode == 'personalized' and shards > 1:
+            # Each shard process reads the list and filters its own part
+            recipients = recipient_filter = ShardedRecipients(open_rows, shards, suppression_index())
+        else:
+            recipient_filter = RecipientFilter(suppression_index())
+            recipients = open_rows(recipient_filter)
+        success, message = send_bulk_emails(
+            campaign.id, campaign.template, placeholders, recipients,
+            campaign.subject, campaign.mode, campaign_smtp_config(campaign)
+        )
+        if not success:
+            campaign.error_message = message
+        logger.info("Campaign %s skipped %s duplicate and %s suppressed addresses", campaign.id,
+                    recipient_filter.removed['duplicate'], recipient_filter.removed['suppressed'])
+    except Exception as e:
+        logger.exception("Campaign %s failed", campaign.id)
+        db.session.rollback()
+        campaign.status = 'failed'
+        campaign.error_message = str(e)
+    finally:
+        stop_heartbeat.set()
+        campaign.sender_password = None
+        db.session.commit()
+        bus.publish(campaign.id, campaign_state(campaign))
+
+    if campaign.transport:
+        # A dry run never reached a server; its failures are not bounces
+        return
+    try:
+        bounced = suppress_bounces(campaign.id)
+        if bounced:
+            logger.info("Campaign %s added %s bounced addresses to the suppression list", campaign.id, bounced)
+    except Exception:
+        logger.exception("Could not update the suppression list from campaign %s", campaign.id)
+        db.session.rollback()
+
+def run_worker(worker_id=None, stop_event=None):
+    """Poll the queue and run campaigns until ``stop_event`` is set"""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    stop_event = stop_event or threading.Event()
+
+    with app.app_context():
+        while not stop_event.is_set():
+            try:
+                campaign = claim_next_campaign(worker_id)
+            except Exception:
+                logger.exception("Worker %s could not poll the campaign queue", worker_id)
+                db.session.rollback()
+                campaign = None
+
+            if campaign is None:
+                stop_event.wait(app.config['WORKER_POLL_INTERVAL'])
+                continue
+
+            logger.info("Worker %s running campaign %s", worker_id, campaign.id)
+            run_campaign(campaign)
+            db.session.remove()
+
+def run_worker_process():
+    with app.app_context():
+        # Connections inherited from the forking parent must not be shared
+        db.engine.dispose(close=False)
+    run_worker()
+
+def start_embedded_workers(count):
+    """Start worker threads inside the web process"""
+    threads = []
+    for _ in range(count):
+        thread = threading.Thread(target=run_worker, daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run background campaign workers")
+    parser.add_argument('--processes', type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker()
+    else:
+        processes = [multiprocessing.Process(target=run_worker_process) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()